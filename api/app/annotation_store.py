@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from app.config import settings
+from app.models import Annotation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    video TEXT NOT NULL,
+    frame INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    updated_ns INTEGER NOT NULL,
+    PRIMARY KEY (video, frame)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS imported_videos (
+    video TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+
+class AnnotationStore:
+    # Annotations of every video in one SQLite database, keyed by video and
+    # frame number so that the annotated frames of a range are found with one
+    # index lookup. The JSON files of the previous layout are imported the
+    # first time a video is accessed and are left in place.
+    def __init__(self, path: Path, legacy_directory: Path):
+        self.path = path
+        self.legacy_directory = legacy_directory
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._imported: set[str] = set()
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Worker processes open a connection of their own, a connection cannot
+        # be shared across processes.
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, timeout=30
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+            self._imported = set()
+        return self._connection
+
+    def _transaction(self, connection: sqlite3.Connection):
+        # Taken as a write transaction from the start, a read-modify-write in
+        # another process waits instead of failing on upgrade.
+        connection.execute("BEGIN IMMEDIATE")
+
+    def _ensure_imported(self, connection: sqlite3.Connection, video_name: str) -> bool:
+        # Returns whether the video was imported by this call.
+        if video_name in self._imported:
+            return False
+        if connection.execute(
+            "SELECT 1 FROM imported_videos WHERE video = ?", (video_name,)
+        ).fetchone():
+            self._imported.add(video_name)
+            return False
+
+        self._transaction(connection)
+        try:
+            self._import_directory(connection, video_name)
+            connection.execute(
+                "INSERT OR IGNORE INTO imported_videos (video) VALUES (?)",
+                (video_name,),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self._imported.add(video_name)
+        return True
+
+    def _import_directory(self, connection: sqlite3.Connection, video_name: str):
+        directory = self.legacy_directory / video_name
+        if not directory.is_dir():
+            return
+
+        rows = []
+        for annotation_file in directory.glob("*.json"):
+            if not annotation_file.stem.isdigit():
+                continue
+            try:
+                with open(annotation_file, "r") as f:
+                    annotation = Annotation.model_validate(json.load(f))
+            except ValueError as e:
+                print(f"Skipping invalid annotation {annotation_file}: {e}")
+                continue
+            rows.append(
+                (
+                    video_name,
+                    int(annotation_file.stem),
+                    annotation.model_dump_json(),
+                    annotation_file.stat().st_mtime_ns,
+                )
+            )
+        # Annotations written to the database take precedence over the files.
+        connection.executemany(
+            "INSERT OR IGNORE INTO annotations (video, frame, data, updated_ns) "
+            "VALUES (?, ?, ?, ?)",
+            rows,
+        )
+
+    def _open(self, video_name: str) -> sqlite3.Connection:
+        connection = self._connect()
+        self._ensure_imported(connection, video_name)
+        return connection
+
+    def get(self, video_name: str, frame_number: int) -> Optional[Annotation]:
+        with self._lock:
+            row = (
+                self._open(video_name)
+                .execute(
+                    "SELECT data FROM annotations WHERE video = ? AND frame = ?",
+                    (video_name, frame_number),
+                )
+                .fetchone()
+            )
+        return Annotation.model_validate_json(row[0]) if row else None
+
+    def _select_range(
+        self,
+        columns: str,
+        video_name: str,
+        start_frame: int,
+        end_frame: Optional[int],
+    ) -> list[tuple]:
+        # Frames in [start_frame, end_frame), up to the last one if end_frame
+        # is None.
+        query = f"SELECT {columns} FROM annotations WHERE video = ? AND frame >= ?"
+        parameters: tuple = (video_name, start_frame)
+        if end_frame is not None:
+            query += " AND frame < ?"
+            parameters += (end_frame,)
+        with self._lock:
+            rows = self._open(video_name).execute(query + " ORDER BY frame", parameters)
+            return rows.fetchall()
+
+    def get_range(
+        self, video_name: str, start_frame: int = 0, end_frame: Optional[int] = None
+    ) -> dict[int, Annotation]:
+        return {
+            frame: Annotation.model_validate_json(data)
+            for frame, data in self._select_range(
+                "frame, data", video_name, start_frame, end_frame
+            )
+        }
+
+    def put_many(self, video_name: str, annotations: dict[int, Annotation]):
+        # All the annotations are written in one transaction, either all of
+        # them are saved or none is.
+        updated_ns = time.time_ns()
+        rows = [
+            (video_name, frame, annotation.model_dump_json(), updated_ns)
+            for frame, annotation in annotations.items()
+        ]
+        with self._lock:
+            connection = self._open(video_name)
+            self._transaction(connection)
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO annotations "
+                    "(video, frame, data, updated_ns) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def put(self, video_name: str, frame_number: int, annotation: Annotation):
+        self.put_many(video_name, {frame_number: annotation})
+
+    def update(
+        self,
+        video_name: str,
+        frame_number: int,
+        update: Callable[[Optional[Annotation]], Annotation],
+    ) -> Annotation:
+        # Reads the annotation and writes the result of update in the same
+        # transaction, so that concurrent edits of a frame are not lost.
+        with self._lock:
+            connection = self._open(video_name)
+            self._transaction(connection)
+            try:
+                row = connection.execute(
+                    "SELECT data FROM annotations WHERE video = ? AND frame = ?",
+                    (video_name, frame_number),
+                ).fetchone()
+                annotation = update(
+                    Annotation.model_validate_json(row[0]) if row else None
+                )
+                connection.execute(
+                    "INSERT OR REPLACE INTO annotations "
+                    "(video, frame, data, updated_ns) VALUES (?, ?, ?, ?)",
+                    (
+                        video_name,
+                        frame_number,
+                        annotation.model_dump_json(),
+                        time.time_ns(),
+                    ),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return annotation
+
+    def import_all(self) -> list[str]:
+        # Imports every video of the previous layout at once, instead of on
+        # first access. Returns the videos that were not imported yet.
+        if not self.legacy_directory.is_dir():
+            return []
+        video_names = [
+            directory.name
+            for directory in self.legacy_directory.iterdir()
+            if directory.is_dir()
+        ]
+        with self._lock:
+            connection = self._connect()
+            return [
+                video_name
+                for video_name in video_names
+                if self._ensure_imported(connection, video_name)
+            ]
+
+
+annotation_store = AnnotationStore(
+    settings.annotation_directory / "annotations.sqlite3",
+    settings.annotation_directory,
+)
+
+
+if __name__ == "__main__":
+    for video_name in annotation_store.import_all():
+        print(f"Imported annotations for {video_name}")
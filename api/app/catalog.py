@@ -0,0 +1,203 @@
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+import cv2
+from pydantic import BaseModel
+
+from app.config import settings
+
+
+class VideoEntry(BaseModel):
+    name: str
+    stem: str
+    path: Path
+    is_video: bool
+    mtime_ns: int
+    frame_count: int
+    width: int
+    height: int
+    size: int
+    fps: Optional[float] = None
+    frame_names: list[str] = []
+
+    def frame_name(self, frame_number: int) -> Optional[str]:
+        if frame_number < 0 or frame_number >= self.frame_count:
+            return None
+        if self.is_video:
+            return f"{frame_number}.jpg"
+        return self.frame_names[frame_number]
+
+    def frame_path(self, frame_number: int) -> Optional[Path]:
+        frame_name = self.frame_name(frame_number)
+        if frame_name is None:
+            return None
+        if self.is_video:
+            return self.path
+        return self.path / frame_name
+
+
+def index_video(path: Path, mtime_ns: int) -> VideoEntry:
+    capture = cv2.VideoCapture(str(path))
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+
+    return VideoEntry(
+        name=path.name,
+        stem=path.name.replace(".mp4", ""),
+        path=path,
+        is_video=True,
+        mtime_ns=mtime_ns,
+        frame_count=frame_count,
+        width=width,
+        height=height,
+        size=path.stat().st_size,
+        fps=fps or None,
+    )
+
+
+def index_images(path: Path, mtime_ns: int) -> VideoEntry:
+    frame_names = []
+    size = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".jpg") and entry.is_file():
+                frame_names.append(entry.name)
+                size += entry.stat().st_size
+    frame_names.sort()
+
+    width, height = 0, 0
+    if frame_names:
+        first_frame = cv2.imread(str(path / frame_names[0]))
+        if first_frame is not None:
+            height, width = first_frame.shape[:2]
+
+    return VideoEntry(
+        name=path.name,
+        stem=path.name,
+        path=path,
+        is_video=False,
+        mtime_ns=mtime_ns,
+        frame_count=len(frame_names),
+        width=width,
+        height=height,
+        size=size,
+        frame_names=frame_names,
+    )
+
+
+class VideoCatalog:
+    # Entries are indexed once and re-indexed only when the mtime of the video
+    # file or image directory changes, the listing itself is refreshed when the
+    # mtime of video_dir or images_dir changes.
+    def __init__(self, video_dir: Path, images_dir: Path):
+        self.video_dir = video_dir
+        self.images_dir = images_dir
+        self._videos: dict[str, Optional[VideoEntry]] = {}
+        self._images: dict[str, Optional[VideoEntry]] = {}
+        self._listing_mtimes: dict[Path, int] = {}
+        self._lock = threading.RLock()
+
+    def _refresh_listing(
+        self, directory: Path, names: dict[str, Optional[VideoEntry]], is_video: bool
+    ):
+        mtime = directory.stat().st_mtime_ns
+        if self._listing_mtimes.get(directory) == mtime:
+            return
+        self._listing_mtimes[directory] = mtime
+
+        with os.scandir(directory) as entries:
+            if is_video:
+                found = {
+                    entry.name
+                    for entry in entries
+                    if entry.name.endswith(".mp4") and entry.is_file()
+                }
+            else:
+                found = {entry.name for entry in entries if entry.is_dir()}
+
+        for name in list(names):
+            if name not in found:
+                del names[name]
+        for name in found:
+            names.setdefault(name, None)
+
+    def _refresh(self):
+        self._refresh_listing(self.video_dir, self._videos, True)
+        self._refresh_listing(self.images_dir, self._images, False)
+
+    def _mtime(
+        self, names: dict[str, Optional[VideoEntry]], name: str, path: Path
+    ) -> Optional[int]:
+        # Called with the lock held.
+        try:
+            return path.stat().st_mtime_ns
+        except FileNotFoundError:
+            names.pop(name, None)
+            return None
+
+    def _entry(
+        self, names: dict[str, Optional[VideoEntry]], name: str, is_video: bool
+    ) -> Optional[VideoEntry]:
+        # Indexing opens the video or every image of a sequence, it is done
+        # without the lock so that other videos are served meanwhile. The new
+        # entry is kept only if the video was not modified while it was indexed.
+        path = (self.video_dir if is_video else self.images_dir) / name
+        with self._lock:
+            if name not in names:
+                return None
+            mtime = self._mtime(names, name, path)
+            if mtime is None:
+                return None
+            entry = names[name]
+            if entry is not None and entry.mtime_ns == mtime:
+                return entry
+
+        entry = index_video(path, mtime) if is_video else index_images(path, mtime)
+
+        with self._lock:
+            if name in names and self._mtime(names, name, path) == mtime:
+                names[name] = entry
+        return entry
+
+    def get(self, name: str) -> Optional[VideoEntry]:
+        with self._lock:
+            self._refresh()
+            if name in self._images:
+                names, is_video = self._images, False
+            elif name in self._videos:
+                names, is_video = self._videos, True
+            else:
+                return None
+        return self._entry(names, name, is_video)
+
+    def entries(self) -> tuple[list[VideoEntry], list[VideoEntry]]:
+        with self._lock:
+            self._refresh()
+            video_names = sorted(self._videos)
+            image_names = sorted(self._images)
+        videos = [self._entry(self._videos, name, True) for name in video_names]
+        images_videos = [self._entry(self._images, name, False) for name in image_names]
+        return (
+            [entry for entry in videos if entry is not None],
+            [entry for entry in images_videos if entry is not None],
+        )
+
+    def invalidate(self, name: Optional[str] = None):
+        with self._lock:
+            if name is None:
+                self._videos.clear()
+                self._images.clear()
+                self._listing_mtimes.clear()
+                return
+            if name in self._videos:
+                self._videos[name] = None
+            if name in self._images:
+                self._images[name] = None
+
+
+video_catalog = VideoCatalog(settings.video_dir, settings.images_dir)
@@ -13,7 +13,60 @@ class Settings(BaseSettings):
 
     video_dir: Path = Path("./data/videos")
     images_dir: Path = Path("./data/images")
-    input_dir: Path = Path("./data/input")
+    proxy_directory: Path = Path("./data/proxies")
+    proxy_heights: list[int] = [480, 240]
+    upload_directory: Path = Path("./data/uploads")
+    manifest_path: Path = Path("./data/manifest.json")
+    upload_chunk_size: int = 1024 * 1024
+    upload_session_max_age: float = 24 * 3600
+    image_conversion_workers: int = 0
+
+    frame_cache_max_bytes: int = 512 * 1024 * 1024
+    video_reader_max_open: int = 8
+    video_reader_idle_seconds: float = 60.0
+    video_reader_backfill_frames: int = 16
+    frame_cache_control: str = "private, max-age=3600"
+    overlay_cache_control: str = "no-cache"
+    max_batch_frames: int = 120
+    mask_polygon_tolerance: float = 1.0
+
+    frame_workers: int = 4
+    frame_max_pending: int = 64
+    io_workers: int = 4
+    io_max_pending: int = 64
+    background_workers: int = 1
+    background_max_pending: int = 1024
+
+    mask_writer_workers: int = 2
+    mask_writer_max_pending: int = 16
+
+    sam2_model_variants: list[str] = [
+        "facebook/sam2-hiera-large",
+        "facebook/sam2-hiera-base-plus",
+        "facebook/sam2-hiera-small",
+        "facebook/sam2-hiera-tiny",
+    ]
+    sam2_warm_up: bool = True
+    sam2_idle_unload_seconds: float = 0.0
+    sam2_max_loaded_models: int = 2
+    sam2_offload_video_to_cpu: bool = False
+    sam2_offload_state_to_cpu: bool = False
+    inference_state_cache_size: int = 2
+    inference_state_cache_max_bytes: int = 8 * 1024 * 1024 * 1024
+    embedding_cache_max_bytes: int = 4 * 1024 * 1024 * 1024
+    embedding_cache_offload: bool = False
+
+    segmentation_workers: int = 1
+    segmentation_queue_size: int = 32
+    segmentation_job_history: int = 100
+    segmentation_chunk_size: int = 200
+    segmentation_chunk_overlap: int = 4
+    segmentation_worker_processes: bool = False
+    segmentation_torch_threads: int = 0
+    segmentation_job_events: int = 1024
+    segmentation_stream_masks: bool = True
+
+    server_timing: bool = False
 
     @model_validator(mode="after")
     def validate_directories(self):
@@ -24,7 +77,8 @@ class Settings(BaseSettings):
             self.annotation_directory,
             self.video_dir,
             self.images_dir,
-            self.input_dir,
+            self.proxy_directory,
+            self.upload_directory,
         ]:
             if not directory.exists():
                 directory.mkdir(exist_ok=True, parents=True)
@@ -1,14 +1,49 @@
-from collections import defaultdict
 from functools import lru_cache
+from typing import Callable, Optional
 
 from sam2.sam2_video_predictor import SAM2VideoPredictor
 
+from app.config import settings
+from app.model_manager import ModelManager
+from app.predictor_pool import PredictorProcess, get_torch_threads
+from app.scheduler import PredictorRunner, SegmentationScheduler
 
-@lru_cache
-def get_sam2_predictor():
-    return SAM2VideoPredictor.from_pretrained("facebook/sam2-hiera-large")
+
+def load_sam2_predictor(model_name: str) -> SAM2VideoPredictor:
+    return SAM2VideoPredictor.from_pretrained(model_name)
+
+
+def create_model_manager(
+    on_status: Optional[Callable[[dict], None]] = None,
+) -> ModelManager:
+    return ModelManager(
+        load_sam2_predictor,
+        settings.sam2_model_name,
+        idle_seconds=settings.sam2_idle_unload_seconds,
+        max_loaded=settings.sam2_max_loaded_models,
+        warm_up=settings.sam2_warm_up,
+        on_status=on_status,
+    )
+
+
+def create_segmentation_runner():
+    if settings.segmentation_worker_processes:
+        return PredictorProcess(
+            create_model_manager,
+            get_torch_threads(
+                settings.segmentation_workers, settings.segmentation_torch_threads
+            ),
+        )
+    return PredictorRunner(create_model_manager())
 
 
 @lru_cache
-def get_task_queue():
-    return defaultdict(list)
+def get_scheduler():
+    scheduler = SegmentationScheduler(
+        create_segmentation_runner,
+        settings.segmentation_workers,
+        settings.segmentation_queue_size,
+        settings.segmentation_job_history,
+    )
+    scheduler.start()
+    return scheduler
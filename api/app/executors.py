@@ -0,0 +1,65 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+from app.config import settings
+
+T = TypeVar("T")
+
+_end = object()
+
+
+class BoundedExecutor:
+    # A thread pool for one kind of work with at most max_pending calls queued
+    # or running. Callers over the limit wait on the event loop without holding
+    # a thread, and the work of one pool never waits for the threads of
+    # another, e.g. a proxy being generated does not delay frame requests.
+    def __init__(self, name: str, max_workers: int, max_pending: int):
+        self.name = name
+        self.max_workers = max(max_workers, 1)
+        self.max_pending = max(max_pending, self.max_workers)
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=name
+        )
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        # The context is copied so that spans recorded in the thread end up in
+        # the timings of the request.
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        async with self._semaphore:
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, call
+                )
+            finally:
+                self.pending -= 1
+
+    async def iterate(self, iterator: Iterator[T]) -> AsyncIterator[T]:
+        # Advances a blocking iterator in the pool, one item per call, e.g. to
+        # stream frames as they are decoded.
+        try:
+            while (item := await self.run(next, iterator, _end)) is not _end:
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                await self.run(close)
+
+
+# Decoding, resizing and encoding of the frames served to the annotators.
+frame_executor = BoundedExecutor(
+    "frame", settings.frame_workers, settings.frame_max_pending
+)
+# Annotation reads and writes and upload file copies.
+io_executor = BoundedExecutor("io", settings.io_workers, settings.io_max_pending)
+# Work started after a request returns: proxies, keyframe indexes and exports.
+background_executor = BoundedExecutor(
+    "background", settings.background_workers, settings.background_max_pending
+)
+
+executors = [frame_executor, io_executor, background_executor]
@@ -0,0 +1,243 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Hashable, Iterator, Optional
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.keyframes import keyframe_index
+
+# A seek costs about as much as decoding this many frames on top of the frames
+# from the keyframe, short forward jumps read on instead.
+SEEK_COST_FRAMES = 8
+
+
+class FrameCache:
+    # Frames handed out by the cache are shared between requests, callers must
+    # not modify them in place.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._frames: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key: Hashable, frame: np.ndarray):
+        if frame.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._frames.pop(key, None)
+            if previous is not None:
+                self._size -= previous.nbytes
+            self._frames[key] = frame
+            self._size += frame.nbytes
+
+            while self._size > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+
+def frame_key(
+    source_path: Path,
+    mtime_ns: int,
+    frame_number: int,
+    size: Optional[tuple[int, int]] = None,
+) -> tuple:
+    return (source_path, mtime_ns, frame_number, size)
+
+
+class PooledVideoReader:
+    def __init__(self, video_path: Path):
+        self.video_path = video_path
+        self.mtime = video_path.stat().st_mtime_ns
+        self.capture = cv2.VideoCapture(str(video_path))
+        self.position = 0
+        self.last_used = time.monotonic()
+
+    def _seek_cost(self, frame_number: int) -> int:
+        # A seek decodes from the keyframe before the frame, plus the fixed
+        # cost of flushing the decoder counted as SEEK_COST_FRAMES.
+        keyframe = keyframe_index.keyframe_before(self.video_path, frame_number)
+        if keyframe is None:
+            return SEEK_COST_FRAMES
+        return frame_number - keyframe + SEEK_COST_FRAMES
+
+    def cost(self, frame_number: int) -> int:
+        # Frames to decode to reach frame_number, reading on from the current
+        # position when that is cheaper than a seek.
+        seek_cost = self._seek_cost(frame_number)
+        if 0 <= self.position <= frame_number:
+            return min(frame_number - self.position, seek_cost)
+        return seek_cost
+
+    def _seek(self, frame_number: int, backfill: int) -> bool:
+        if not 0 <= self.position <= frame_number or (
+            frame_number - self.position > self._seek_cost(frame_number)
+        ):
+            # Landing on the keyframe is exact, the frames up to the requested
+            # one are then decoded below.
+            keyframe = keyframe_index.keyframe_before(self.video_path, frame_number)
+            target = frame_number if keyframe is None else keyframe
+            moving_back = frame_number < self.position
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, target)
+            self.position = target
+        else:
+            moving_back = False
+
+        # Frames between the keyframe and the requested one are decoded
+        # anyway. When stepping back the last ones are cached, so that the
+        # previous frames do not need another seek.
+        while self.position < frame_number:
+            if moving_back and frame_number - self.position <= backfill:
+                success, frame = self.capture.read()
+                if success:
+                    frame_cache.put(
+                        frame_key(self.video_path, self.mtime, self.position), frame
+                    )
+            else:
+                success = self.capture.grab()
+            if not success:
+                return False
+            self.position += 1
+        return True
+
+    def read(self, frame_number: int, backfill: int = 0) -> Optional[np.ndarray]:
+        if frame_number != self.position and not self._seek(frame_number, backfill):
+            self.position = -1
+            return None
+
+        success, frame = self.capture.read()
+        if not success:
+            self.position = -1
+            return None
+
+        self.position = frame_number + 1
+        return frame
+
+    def release(self):
+        self.capture.release()
+
+
+class VideoReaderPool:
+    def __init__(self, max_readers: int, idle_timeout: float):
+        self.max_readers = max_readers
+        self.idle_timeout = idle_timeout
+        self._idle: defaultdict[Path, list[PooledVideoReader]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def read(
+        self, video_path: Path, frame_number: int, backfill: int = 0
+    ) -> Optional[np.ndarray]:
+        with self.lease(video_path, frame_number) as reader:
+            return reader.read(frame_number, backfill)
+
+    @contextmanager
+    def lease(
+        self, video_path: Path, frame_number: int = 0
+    ) -> Iterator[PooledVideoReader]:
+        reader = self._acquire(video_path, frame_number)
+        try:
+            yield reader
+        finally:
+            self._release(reader)
+
+    def _acquire(self, video_path: Path, frame_number: int) -> PooledVideoReader:
+        mtime = video_path.stat().st_mtime_ns
+        stale = []
+        reader = None
+        with self._lock:
+            readers = self._idle[video_path]
+            for candidate in list(readers):
+                if candidate.mtime != mtime:
+                    readers.remove(candidate)
+                    stale.append(candidate)
+
+            # The reader closest before the requested frame decodes it with
+            # the fewest frames, without seeking if it is in the same GOP.
+            if readers:
+                reader = min(
+                    reversed(readers),
+                    key=lambda candidate: candidate.cost(frame_number),
+                )
+                readers.remove(reader)
+
+        for candidate in stale:
+            candidate.release()
+
+        if reader is None:
+            reader = PooledVideoReader(video_path)
+        return reader
+
+    def _release(self, reader: PooledVideoReader):
+        reader.last_used = time.monotonic()
+        with self._lock:
+            if reader.position >= 0:
+                self._idle[reader.video_path].append(reader)
+                reader = None
+            evicted = self._evict()
+
+        if reader is not None:
+            reader.release()
+        for candidate in evicted:
+            candidate.release()
+
+    def _evict(self) -> list[PooledVideoReader]:
+        now = time.monotonic()
+        evicted = []
+        for video_path, readers in list(self._idle.items()):
+            for reader in list(readers):
+                if now - reader.last_used > self.idle_timeout:
+                    readers.remove(reader)
+                    evicted.append(reader)
+            if not readers:
+                del self._idle[video_path]
+
+        idle = sorted(
+            (reader for readers in self._idle.values() for reader in readers),
+            key=lambda reader: reader.last_used,
+        )
+        for reader in idle[: max(0, len(idle) - self.max_readers)]:
+            self._idle[reader.video_path].remove(reader)
+            evicted.append(reader)
+
+        return evicted
+
+    def close(self, video_path: Optional[Path] = None):
+        with self._lock:
+            if video_path is None:
+                readers = [r for rs in self._idle.values() for r in rs]
+                self._idle.clear()
+            else:
+                readers = self._idle.pop(video_path, [])
+
+        for reader in readers:
+            reader.release()
+
+
+frame_cache = FrameCache(settings.frame_cache_max_bytes)
+video_reader_pool = VideoReaderPool(
+    settings.video_reader_max_open, settings.video_reader_idle_seconds
+)
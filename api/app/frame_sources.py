@@ -0,0 +1,200 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import cv2
+import numpy as np
+import sam2.sam2_video_predictor as sam2_video_predictor
+import torch
+from sam2.sam2_video_predictor import SAM2VideoPredictor
+
+from app.catalog import VideoEntry
+from app.metrics import record_span
+
+IMG_MEAN = torch.tensor((0.485, 0.456, 0.406), dtype=torch.float32)[:, None, None]
+IMG_STD = torch.tensor((0.229, 0.224, 0.225), dtype=torch.float32)[:, None, None]
+
+
+class FrameSource(ABC):
+    # Drop-in replacement for the frames loaded by SAM2's load_video_frames.
+    # The first frame is decoded synchronously, the others on a background
+    # thread, and frames are kept as resized uint8 RGB until SAM2 asks for them.
+    def __init__(self, frame_count: int):
+        self.frame_count = frame_count
+        self.image_size = 1024
+        self.device = torch.device("cpu")
+        self.offload_video_to_cpu = False
+        self.video_height = 0
+        self.video_width = 0
+        self._frames: list[Optional[np.ndarray]] = [None] * frame_count
+        self._loaded = 0
+        self._error: Optional[Exception] = None
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @abstractmethod
+    def read_frames(self) -> Iterator[np.ndarray]:
+        # Yields the BGR frames of the video in order.
+        ...
+
+    def start(self, image_size: int, device: torch.device, offload_video_to_cpu: bool):
+        self.image_size = image_size
+        self.device = device
+        self.offload_video_to_cpu = offload_video_to_cpu
+
+        frames = self.read_frames()
+        first_frame = next(frames, None)
+        if first_frame is None:
+            raise ValueError("Failed to read frame")
+        self.video_height, self.video_width = first_frame.shape[:2]
+        self._store(0, first_frame)
+
+        self._thread = threading.Thread(target=self._load, args=(frames,), daemon=True)
+        self._thread.start()
+
+    def _store(self, index: int, frame: np.ndarray):
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame = cv2.resize(
+            frame, (self.image_size, self.image_size), interpolation=cv2.INTER_CUBIC
+        )
+        with self._condition:
+            self._frames[index] = frame
+            self._loaded = index + 1
+            self._condition.notify_all()
+
+    def _load(self, frames: Iterator[np.ndarray]):
+        index = 1
+        try:
+            started = time.perf_counter()
+            for frame in frames:
+                if index >= self.frame_count:
+                    break
+                self._store(index, frame)
+                record_span("load_frames", time.perf_counter() - started)
+                index += 1
+                started = time.perf_counter()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+            return
+
+        if index < self.frame_count:
+            # The container reported more frames than could be decoded.
+            print(f"Only {index} of {self.frame_count} frames could be decoded")
+            with self._condition:
+                for missing in range(index, self.frame_count):
+                    self._frames[missing] = self._frames[index - 1]
+                self._loaded = self.frame_count
+                self._condition.notify_all()
+
+    def __len__(self) -> int:
+        return self.frame_count
+
+    @property
+    def nbytes(self) -> int:
+        return self.frame_count * self.image_size * self.image_size * 3
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._loaded > index or self._error is not None
+            )
+            frame = self._frames[index]
+        if frame is None:
+            raise ValueError(f"Failed to load frame {index}") from self._error
+
+        image = torch.from_numpy(frame).permute(2, 0, 1).float() / 255.0
+        image = (image - IMG_MEAN) / IMG_STD
+        if not self.offload_video_to_cpu:
+            image = image.to(self.device, non_blocking=True)
+        return image
+
+
+class VideoFrameSource(FrameSource):
+    def __init__(self, video_path: Path, start_frame: int, frame_count: int):
+        super().__init__(frame_count)
+        self.video_path = video_path
+        self.start_frame = start_frame
+
+    def read_frames(self) -> Iterator[np.ndarray]:
+        video_capture = cv2.VideoCapture(str(self.video_path))
+        video_capture.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+        try:
+            for _ in range(self.frame_count):
+                success, frame = video_capture.read()
+                if not success:
+                    return
+                yield frame
+        finally:
+            video_capture.release()
+
+
+class ImagesFrameSource(FrameSource):
+    def __init__(self, image_paths: list[Path]):
+        super().__init__(len(image_paths))
+        self.image_paths = image_paths
+
+    def read_frames(self) -> Iterator[np.ndarray]:
+        for image_path in self.image_paths:
+            frame = cv2.imread(str(image_path))
+            if frame is None:
+                raise ValueError(f"Failed to read {image_path}")
+            yield frame
+
+
+class ArrayFrameSource(FrameSource):
+    def __init__(self, frames: list[np.ndarray]):
+        super().__init__(len(frames))
+        self.frames = frames
+
+    def read_frames(self) -> Iterator[np.ndarray]:
+        yield from self.frames
+
+
+def get_frame_range(entry: VideoEntry, start_frame: int, end_frame: int) -> range:
+    # end_frame is included for videos and excluded for image sequences, a
+    # negative end_frame means the end of the video for both.
+    if end_frame < 0:
+        return range(start_frame, entry.frame_count)
+    if entry.is_video:
+        return range(start_frame, end_frame + 1)
+    return range(start_frame, min(end_frame, entry.frame_count))
+
+
+def open_frame_range(entry: VideoEntry, frames: range) -> FrameSource:
+    if entry.is_video:
+        return VideoFrameSource(entry.path, frames.start, max(len(frames), 0))
+
+    frame_names = entry.frame_names[frames.start : frames.stop]
+    return ImagesFrameSource([entry.path / frame_name for frame_name in frame_names])
+
+
+init_state_lock = threading.Lock()
+
+
+def init_state(
+    sam2_predictor: SAM2VideoPredictor, frame_source: FrameSource, **kwargs
+) -> Any:
+    # SAM2 only knows how to load frames from a path, so its loader is swapped
+    # for one returning the frame source while the state is initialized.
+    def load_video_frames(*args, **load_kwargs):
+        device = load_kwargs.get("compute_device") or getattr(
+            sam2_predictor, "device", torch.device("cpu")
+        )
+        frame_source.start(
+            image_size=load_kwargs.get("image_size", sam2_predictor.image_size),
+            device=device,
+            offload_video_to_cpu=load_kwargs.get("offload_video_to_cpu", False),
+        )
+        return frame_source, frame_source.video_height, frame_source.video_width
+
+    with init_state_lock:
+        original_load_video_frames = sam2_video_predictor.load_video_frames
+        sam2_video_predictor.load_video_frames = load_video_frames
+        try:
+            return sam2_predictor.init_state("", **kwargs)
+        finally:
+            sam2_video_predictor.load_video_frames = original_load_video_frames
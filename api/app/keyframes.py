@@ -0,0 +1,169 @@
+import struct
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+
+def iter_boxes(data: bytes, offset: int = 0, end: Optional[int] = None):
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, min(offset + size, end)
+        offset += size
+
+
+def find_box(data: bytes, start: int, end: int, box_type: bytes):
+    for found_type, box_start, box_end in iter_boxes(data, start, end):
+        if found_type == box_type:
+            return box_start, box_end
+    return None
+
+
+def read_moov(path: Path) -> Optional[bytes]:
+    # The moov box may be at the start or at the end of the file, the media
+    # data in between is skipped.
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, box_type = struct.unpack(">I4s", header)
+            header_size = 8
+            if size == 1:
+                (size,) = struct.unpack(">Q", f.read(8))
+                header_size = 16
+            if box_type == b"moov":
+                return f.read(size - header_size) if size else f.read()
+            if size == 0:
+                return None
+            f.seek(size - header_size, 1)
+
+
+def table(data: bytes, box: Optional[tuple[int, int]], fields: str) -> np.ndarray:
+    # Full box tables: version and flags, an entry count, then the entries.
+    if box is None:
+        return np.zeros((0, len(fields)), dtype=np.int64)
+    start, _ = box
+    (count,) = struct.unpack_from(">I", data, start + 4)
+    dtype = np.dtype([(f"f{i}", ">" + field) for i, field in enumerate(fields)])
+    entries = np.frombuffer(data, dtype=dtype, count=count, offset=start + 8)
+    return np.stack([entries[name].astype(np.int64) for name in dtype.names], axis=1)
+
+
+def video_sample_table(moov: bytes) -> Optional[tuple[int, int]]:
+    for box_type, start, end in iter_boxes(moov):
+        if box_type != b"trak":
+            continue
+        mdia = find_box(moov, start, end, b"mdia")
+        if mdia is None:
+            continue
+        hdlr = find_box(moov, *mdia, b"hdlr")
+        if hdlr is None or moov[hdlr[0] + 8 : hdlr[0] + 12] != b"vide":
+            continue
+        minf = find_box(moov, *mdia, b"minf")
+        stbl = find_box(moov, *minf, b"stbl") if minf else None
+        if stbl is not None:
+            return stbl
+    return None
+
+
+def read_keyframes(path: Path) -> Optional[list[int]]:
+    # Frame numbers of the keyframes of an mp4, in presentation order, from the
+    # sync sample table of its video track. None when the file has no usable
+    # sample tables, e.g. fragmented mp4s.
+    moov = read_moov(path)
+    if moov is None:
+        return None
+    stbl = video_sample_table(moov)
+    if stbl is None:
+        return None
+
+    stsz = find_box(moov, *stbl, b"stsz")
+    if stsz is None:
+        return None
+    (sample_count,) = struct.unpack_from(">I", moov, stsz[0] + 8)
+    if sample_count == 0:
+        return None
+
+    stss = find_box(moov, *stbl, b"stss")
+    if stss is None:
+        # Every sample is a sync sample.
+        return list(range(sample_count))
+    sync_samples = table(moov, stss, "I")[:, 0] - 1
+
+    # Samples are stored in decoding order, B-frames make it differ from the
+    # presentation order the frame numbers of OpenCV follow.
+    stts = table(moov, find_box(moov, *stbl, b"stts"), "II")
+    decode_times = np.zeros(sample_count, dtype=np.int64)
+    if len(stts):
+        deltas = np.repeat(stts[:, 1], stts[:, 0])[: sample_count - 1]
+        decode_times[1 : len(deltas) + 1] = np.cumsum(deltas)
+    ctts_box = find_box(moov, *stbl, b"ctts")
+    if ctts_box is not None:
+        signed = moov[ctts_box[0]] == 1
+        ctts = table(moov, ctts_box, "Ii" if signed else "II")
+        offsets = np.repeat(ctts[:, 1], ctts[:, 0])[:sample_count]
+        decode_times[: len(offsets)] += offsets
+
+    presentation_order = np.empty(sample_count, dtype=np.int64)
+    presentation_order[np.argsort(decode_times, kind="stable")] = np.arange(
+        sample_count
+    )
+    sync_samples = sync_samples[(sync_samples >= 0) & (sync_samples < sample_count)]
+    return sorted(int(frame) for frame in presentation_order[sync_samples])
+
+
+class KeyframeIndex:
+    # Keyframes of the videos read so far, built from the container on first
+    # access and rebuilt when the file changes.
+    def __init__(self, max_videos: int = 64):
+        self.max_videos = max_videos
+        self._keyframes: OrderedDict[Path, tuple[int, Optional[list[int]]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, video_path: Path) -> Optional[list[int]]:
+        try:
+            mtime = video_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._keyframes.get(video_path)
+            if cached is not None and cached[0] == mtime:
+                self._keyframes.move_to_end(video_path)
+                return cached[1]
+
+        try:
+            keyframes = read_keyframes(video_path)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Could not index the keyframes of {video_path}: {e}")
+            keyframes = None
+
+        with self._lock:
+            self._keyframes[video_path] = (mtime, keyframes)
+            while len(self._keyframes) > self.max_videos:
+                self._keyframes.popitem(last=False)
+        return keyframes
+
+    def keyframe_before(self, video_path: Path, frame_number: int) -> Optional[int]:
+        keyframes = self.get(video_path)
+        if not keyframes:
+            return None
+        index = bisect_right(keyframes, frame_number) - 1
+        return keyframes[max(index, 0)]
+
+
+keyframe_index = KeyframeIndex()
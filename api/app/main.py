@@ -1,12 +1,62 @@
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
 
-from app.routes import upload, videos
+from fastapi import FastAPI, Request
 
-app = FastAPI()
+from app.config import settings
+from app.dependencies import get_scheduler
+from app.metrics import metrics, request_timings, server_timing_header
+from app.routes import jobs, metrics as metrics_routes, upload, videos
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Starting the scheduler starts its workers, which load and warm up the
+    # default model in the background.
+    get_scheduler()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(videos.router)
 app.include_router(upload.router)
+app.include_router(jobs.router)
+app.include_router(metrics_routes.router)
+
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    # The stages timed while handling the request are collected through a
+    # context variable, they are only complete for responses that are not
+    # streamed.
+    timings: list[tuple[str, float]] = []
+    token = request_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    elapsed = time.perf_counter() - started
+
+    route = request.scope.get("route")
+    metrics.observe(
+        "monet_request_duration_seconds",
+        elapsed,
+        method=request.method,
+        route=getattr(route, "path", "unmatched"),
+    )
+    if settings.server_timing:
+        response.headers["Server-Timing"] = server_timing_header(
+            timings + [("total", elapsed)]
+        )
+    return response
 
 
 @app.get("/")
 def read_root():
-    return {"alive": True}
+    workers = get_scheduler().model_status()
+    return {
+        "alive": True,
+        "ready": bool(workers) and all(worker["ready"] for worker in workers),
+        "workers": workers,
+    }
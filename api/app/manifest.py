@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from pydantic import BaseModel
+
+from app.catalog import VideoEntry, video_catalog
+from app.config import settings
+from app.mask_store import get_mask_frame_numbers
+from app.models import VideoMetadata
+
+
+class Manifest(BaseModel):
+    videos: dict[str, VideoMetadata] = {}
+    images: dict[str, VideoMetadata] = {}
+
+
+def get_metadata(entry: VideoEntry) -> VideoMetadata:
+    return VideoMetadata(
+        name=entry.name,
+        is_video=entry.is_video,
+        mtime_ns=entry.mtime_ns,
+        size=entry.size,
+        frame_count=entry.frame_count,
+        width=entry.width,
+        height=entry.height,
+        fps=entry.fps,
+    )
+
+
+class VideoManifest:
+    # Metadata of every video, persisted so that listing the videos after a
+    # restart does not index every image sequence again. A listing costs one
+    # stat per video, entries are re-indexed only when their mtime changes.
+    def __init__(self, path: Path, video_dir: Path, images_dir: Path):
+        self.path = path
+        self.video_dir = video_dir
+        self.images_dir = images_dir
+        self._manifest: Optional[Manifest] = None
+        self._lock = threading.RLock()
+
+    def _load(self) -> Manifest:
+        if self._manifest is None:
+            self._manifest = Manifest()
+            if self.path.exists():
+                try:
+                    with open(self.path, "r") as f:
+                        self._manifest = Manifest.model_validate_json(f.read())
+                except ValueError as e:
+                    print(f"Ignoring invalid manifest {self.path}: {e}")
+        return self._manifest
+
+    def _save(self):
+        temporary_path = self.path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            f.write(self._load().model_dump_json(indent=2))
+        os.replace(temporary_path, self.path)
+
+    def _list(self, directory: Path, is_video: bool) -> dict[str, int]:
+        with os.scandir(directory) as entries:
+            if is_video:
+                return {
+                    entry.name: entry.stat().st_mtime_ns
+                    for entry in entries
+                    if entry.name.endswith(".mp4") and entry.is_file()
+                }
+            return {
+                entry.name: entry.stat().st_mtime_ns
+                for entry in entries
+                if entry.is_dir()
+            }
+
+    def _index(
+        self, entry: VideoEntry, previous: Optional[VideoMetadata]
+    ) -> VideoMetadata:
+        metadata = get_metadata(entry)
+        if (
+            previous is not None
+            and previous.mtime_ns == entry.mtime_ns
+            and previous.size == entry.size
+        ):
+            metadata.mask_frame_count = previous.mask_frame_count
+            metadata.masks_updated_ns = previous.masks_updated_ns
+            return metadata
+
+        # A modified video may have lost frames, e.g. a shorter file uploaded
+        # under the same name, so its masks are counted again.
+        metadata.mask_frame_count = len(get_mask_frame_numbers(entry))
+        if previous is not None:
+            metadata.masks_updated_ns = previous.masks_updated_ns
+            if metadata.mask_frame_count != previous.mask_frame_count:
+                metadata.masks_updated_ns = time.time_ns()
+        return metadata
+
+    def _sync(
+        self, directory: Path, entries: dict[str, VideoMetadata], is_video: bool
+    ) -> bool:
+        changed = False
+        found = self._list(directory, is_video)
+        for name in list(entries):
+            if name not in found:
+                del entries[name]
+                changed = True
+        for name, mtime_ns in found.items():
+            previous = entries.get(name)
+            if previous is not None and previous.mtime_ns == mtime_ns:
+                continue
+            entry = video_catalog.get(name)
+            if entry is not None:
+                entries[name] = self._index(entry, previous)
+                changed = True
+        return changed
+
+    def entries(self) -> tuple[list[VideoMetadata], list[VideoMetadata]]:
+        with self._lock:
+            manifest = self._load()
+            videos_changed = self._sync(self.video_dir, manifest.videos, True)
+            images_changed = self._sync(self.images_dir, manifest.images, False)
+            if videos_changed or images_changed:
+                self._save()
+            return (
+                [manifest.videos[name] for name in sorted(manifest.videos)],
+                [manifest.images[name] for name in sorted(manifest.images)],
+            )
+
+    def _entries_for(self, name: str) -> list[dict[str, VideoMetadata]]:
+        manifest = self._load()
+        return [
+            entries for entries in (manifest.videos, manifest.images) if name in entries
+        ]
+
+    def update(self, name: str):
+        with self._lock:
+            video_catalog.invalidate(name)
+            entry = video_catalog.get(name)
+            if entry is None:
+                return
+            manifest = self._load()
+            entries = manifest.videos if entry.is_video else manifest.images
+            entries[name] = self._index(entry, entries.get(name))
+            self._save()
+
+    def update_masks(self, name: str):
+        with self._lock:
+            entry = video_catalog.get(name)
+            if entry is None:
+                return
+            entries = self._entries_for(name)
+            if not entries:
+                self.update(name)
+                entries = self._entries_for(name)
+            for metadata_entries in entries:
+                metadata = metadata_entries[name]
+                metadata.mask_frame_count = len(get_mask_frame_numbers(entry))
+                metadata.masks_updated_ns = time.time_ns()
+            self._save()
+
+    def remove(self, name: str):
+        with self._lock:
+            for entries in self._entries_for(name):
+                del entries[name]
+            self._save()
+
+
+video_manifest = VideoManifest(
+    settings.manifest_path, settings.video_dir, settings.images_dir
+)
@@ -0,0 +1,487 @@
+import fcntl
+import os
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+import cv2
+import numpy as np
+
+from app.catalog import VideoEntry, video_catalog
+from app.config import settings
+from app.metrics import span
+
+# A volume file starts with a header and is followed by one record per written
+# mask. Records are only ever appended, the last record of a frame wins.
+HEADER = struct.Struct("<4sQ")
+RECORD = struct.Struct("<IIII")
+MAGIC = b"MSK1"
+
+
+def encode_rle(mask: np.ndarray) -> np.ndarray:
+    # Alternating run lengths in row-major order, starting with a background
+    # run which is empty when the first pixel is foreground.
+    flat = np.ascontiguousarray(mask, dtype=bool).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size > 0 and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype("<u4")
+
+
+def decode_rle(runs: np.ndarray, width: int, height: int) -> np.ndarray:
+    values = np.arange(len(runs)) % 2 == 1
+    return np.repeat(values, runs).reshape(height, width)
+
+
+class MaskVolume:
+    # Segmentation workers, possibly in other processes, append to a volume
+    # while the API reads it. Writers hold an exclusive flock of the file while
+    # they append or compact it. Readers never change the file and ignore a
+    # record that is still being appended.
+    def __init__(self, path: Path):
+        self.path = path
+        self.created = 0
+        self._index: dict[int, tuple[int, int, int, int]] = {}
+        # End of the last complete record, 0 until the header is written.
+        self._end = 0
+        self._stale = 0
+        # Inode, size and mtime of the file the index was read from.
+        self._stat: Optional[tuple[int, int, int]] = None
+        # Versions of a volume written again after it was cleared start above
+        # the ones it had.
+        self._version_floor = 0
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _path_stat(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _reset(self):
+        self.created = 0
+        self._index = {}
+        self._end = 0
+        self._stale = 0
+        self._stat = None
+
+    def _refresh(self):
+        # Another process may have written to, compacted or cleared the volume.
+        if self._path_stat() == self._stat:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                self._load(f)
+        except FileNotFoundError:
+            self._reset()
+
+    def _load(self, f: BinaryIO):
+        stat = os.fstat(f.fileno())
+        file_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        file_size = stat.st_size
+        f.seek(0)
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            # Created by a writer which has not written the header yet.
+            self._reset()
+            self._stat = file_stat
+            return
+        magic, created = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a mask volume")
+
+        # Records are only appended to a file, so when it is the one already
+        # indexed only the new records are read. The header tells a file
+        # created again with the same inode number apart.
+        if (
+            self._stat is None
+            or self._stat[0] != file_stat[0]
+            or self._end == 0
+            or created != self.created
+            or file_size < self._end
+        ):
+            self._reset()
+            self.created = created
+            self._end = HEADER.size
+
+        offset = self._end
+        while offset + RECORD.size <= file_size:
+            f.seek(offset)
+            frame_number, width, height, length = RECORD.unpack(f.read(RECORD.size))
+            payload_offset = offset + RECORD.size
+            if payload_offset + length > file_size:
+                break
+            if frame_number in self._index:
+                self._stale += 1
+            self._index[frame_number] = (payload_offset, width, height, length)
+            offset = payload_offset + length
+        self._end = offset
+        self._stat = file_stat
+
+    @contextmanager
+    def _locked_file(self) -> Iterator[BinaryIO]:
+        # The volume opened for writing with an exclusive lock, opened again if
+        # it was compacted or removed while waiting for the lock.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            f = open(self.path, "a+b")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            stat = self._path_stat()
+            if stat is not None and stat[0] == os.fstat(f.fileno()).st_ino:
+                break
+            f.close()
+        try:
+            yield f
+        finally:
+            f.close()
+
+    def write(self, frame_number: int, mask: np.ndarray):
+        mask = np.asarray(mask).squeeze()
+        height, width = mask.shape
+        payload = encode_rle(mask).tobytes()
+
+        record = RECORD.pack(frame_number, width, height, len(payload))
+
+        with self._lock, self._locked_file() as f:
+            self._load(f)
+            if self._end == 0:
+                f.truncate(0)
+                self.created = max(time.time_ns(), self._version_floor)
+                f.write(HEADER.pack(MAGIC, self.created))
+                self._end = HEADER.size
+            elif os.fstat(f.fileno()).st_size > self._end:
+                # A record left incomplete by an interrupted write, no other
+                # writer can be appending while the lock is held.
+                f.truncate(self._end)
+
+            offset = self._end
+            f.write(record + payload)
+            f.flush()
+            if frame_number in self._index:
+                self._stale += 1
+            self._index[frame_number] = (
+                offset + RECORD.size,
+                width,
+                height,
+                len(payload),
+            )
+            self._end = offset + len(record) + len(payload)
+
+            if self._stale > max(len(self._index), 64):
+                self._compact(f)
+            self._stat = self._path_stat()
+
+    def read(self, frame_number: int) -> Optional[np.ndarray]:
+        with self._lock:
+            self._refresh()
+            if frame_number not in self._index:
+                return None
+            try:
+                with open(self.path, "rb") as f:
+                    # The file may have been written to or compacted since it
+                    # was indexed, a compacted file can get the inode number
+                    # of an earlier one so the header is checked as well.
+                    stat = os.fstat(f.fileno())
+                    if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != self._stat:
+                        self._load(f)
+                    record = self._index.get(frame_number)
+                    if record is None:
+                        return None
+                    offset, width, height, length = record
+                    f.seek(offset)
+                    payload = f.read(length)
+            except FileNotFoundError:
+                self._reset()
+                return None
+
+        return decode_rle(np.frombuffer(payload, dtype="<u4"), width, height)
+
+    def version(self, frame_number: int) -> Optional[int]:
+        with self._lock:
+            self._refresh()
+            record = self._index.get(frame_number)
+            if record is None:
+                return None
+            return self.created + record[0]
+
+    def frame_numbers(self) -> list[int]:
+        with self._lock:
+            self._refresh()
+            return sorted(self._index)
+
+    def _compact(self, source: BinaryIO):
+        # Called by write with the lock of the file held. Writers waiting for
+        # the lock open the new file once it is released. A version is created
+        # plus the offset of the record, the rewritten file gets a created past
+        # every version of the current one so that a moved record never takes
+        # the version another mask had.
+        self.created = max(time.time_ns(), self.created + self._end)
+        temporary_path = self.path.with_suffix(".tmp")
+        index = {}
+        with open(temporary_path, "wb") as target:
+            target.write(HEADER.pack(MAGIC, self.created))
+            for frame_number in sorted(self._index):
+                offset, width, height, length = self._index[frame_number]
+                source.seek(offset)
+                payload = source.read(length)
+                target.write(RECORD.pack(frame_number, width, height, length))
+                index[frame_number] = (target.tell(), width, height, length)
+                target.write(payload)
+            end = target.tell()
+        os.replace(temporary_path, self.path)
+        self._index = index
+        self._end = end
+        self._stale = 0
+
+    def clear(self):
+        with self._lock:
+            self._refresh()
+            if self._stat is not None:
+                self._version_floor = self.created + self._end
+            self.path.unlink(missing_ok=True)
+            self._reset()
+
+
+class MaskStore:
+    # Each tracked object has its own volume. Object 0 keeps the path used
+    # before objects were introduced, the others live in <video>.objects/.
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._volumes: dict[tuple[str, int], MaskVolume] = {}
+        self._lock = threading.Lock()
+
+    def get_objects_directory(self, video_name: str) -> Path:
+        return self.directory / f"{video_name}.objects"
+
+    def get_volume_path(self, video_name: str, object_id: int) -> Path:
+        if object_id == 0:
+            return self.directory / f"{video_name}.masks"
+        return self.get_objects_directory(video_name) / f"{object_id}.masks"
+
+    def get_result_path(self, video_name: str) -> Path:
+        # Which job the masks of the video come from, see segmentation_results.
+        return self.directory / f"{video_name}.segmentation.json"
+
+    def volume(self, video_name: str, object_id: int = 0) -> MaskVolume:
+        with self._lock:
+            volume = self._volumes.get((video_name, object_id))
+            if volume is None:
+                volume = MaskVolume(self.get_volume_path(video_name, object_id))
+                self._volumes[(video_name, object_id)] = volume
+            return volume
+
+    def object_ids(self, video_name: str) -> list[int]:
+        object_ids = set()
+        if self.get_volume_path(video_name, 0).exists():
+            object_ids.add(0)
+        objects_directory = self.get_objects_directory(video_name)
+        if objects_directory.is_dir():
+            object_ids.update(
+                int(volume.stem)
+                for volume in objects_directory.glob("*.masks")
+                if volume.stem.isdigit()
+            )
+        return sorted(object_ids)
+
+    def volumes(self, video_name: str) -> list[MaskVolume]:
+        return [
+            self.volume(video_name, object_id)
+            for object_id in self.object_ids(video_name)
+        ]
+
+
+mask_store = MaskStore(settings.mask_directory)
+
+
+def get_legacy_mask_path(entry: VideoEntry, frame_number: int) -> Optional[Path]:
+    frame_name = entry.frame_name(frame_number)
+    if frame_name is None:
+        return None
+    return settings.mask_directory / entry.stem / frame_name
+
+
+def read_mask(
+    entry: VideoEntry, frame_number: int, object_id: int = 0
+) -> Optional[np.ndarray]:
+    mask = mask_store.volume(entry.stem, object_id).read(frame_number)
+    if mask is not None or object_id != 0:
+        return mask
+
+    legacy_path = get_legacy_mask_path(entry, frame_number)
+    if legacy_path is None or not legacy_path.exists():
+        return None
+    mask = cv2.imread(str(legacy_path), cv2.IMREAD_GRAYSCALE)
+    # Legacy masks are stored as JPEG, anything above 1 is foreground.
+    return mask > 1 if mask is not None else None
+
+
+def read_masks(entry: VideoEntry, frame_number: int) -> dict[int, np.ndarray]:
+    masks = {}
+    for object_id in get_mask_object_ids(entry):
+        mask = read_mask(entry, frame_number, object_id)
+        if mask is not None:
+            masks[object_id] = mask
+    return masks
+
+
+def get_mask_object_ids(entry: VideoEntry) -> list[int]:
+    object_ids = mask_store.object_ids(entry.stem)
+    if 0 not in object_ids and (settings.mask_directory / entry.stem).is_dir():
+        object_ids.insert(0, 0)
+    return object_ids
+
+
+def get_mask_version(entry: VideoEntry, frame_number: int) -> Optional[int]:
+    # The versions of all the objects of the frame, a volume being rewritten
+    # from scratch always gets a larger version than the one it replaces.
+    versions = [
+        volume.version(frame_number) for volume in mask_store.volumes(entry.stem)
+    ]
+    versions = [version for version in versions if version is not None]
+    if versions:
+        return max(versions)
+
+    legacy_path = get_legacy_mask_path(entry, frame_number)
+    if legacy_path is None:
+        return None
+    try:
+        return legacy_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_mask_frame_numbers(entry: VideoEntry) -> list[int]:
+    frame_numbers = set()
+    for volume in mask_store.volumes(entry.stem):
+        frame_numbers.update(volume.frame_numbers())
+
+    legacy_directory = settings.mask_directory / entry.stem
+    if legacy_directory.is_dir():
+        if entry.is_video:
+            frame_numbers.update(
+                int(mask.stem)
+                for mask in legacy_directory.iterdir()
+                if mask.stem.isdigit()
+            )
+        else:
+            frame_indexes = {name: i for i, name in enumerate(entry.frame_names)}
+            frame_numbers.update(
+                frame_indexes[mask.name]
+                for mask in legacy_directory.iterdir()
+                if mask.name in frame_indexes
+            )
+    return sorted(frame_numbers)
+
+
+def get_mask_paths(entry: VideoEntry) -> list[Path]:
+    return [
+        mask_store.get_volume_path(entry.stem, object_id)
+        for object_id in mask_store.object_ids(entry.stem)
+    ]
+
+
+def write_mask(
+    entry: VideoEntry, frame_number: int, mask: np.ndarray, object_id: int = 0
+):
+    with span("mask_write"):
+        mask_store.volume(entry.stem, object_id).write(frame_number, mask)
+
+
+def clear_masks(entry: VideoEntry):
+    mask_store.get_result_path(entry.stem).unlink(missing_ok=True)
+    for volume in mask_store.volumes(entry.stem):
+        volume.clear()
+    objects_directory = mask_store.get_objects_directory(entry.stem)
+    if objects_directory.is_dir():
+        shutil.rmtree(objects_directory)
+    legacy_directory = settings.mask_directory / entry.stem
+    if legacy_directory.is_dir():
+        shutil.rmtree(legacy_directory)
+
+
+class MaskWriter:
+    # Encodes and writes masks on a small pool of threads while propagation
+    # goes on. submit blocks once max_pending masks are waiting, so a slow disk
+    # slows inference down instead of growing the queue. The first failed
+    # write is raised by the next submit, a job stops instead of propagating
+    # masks it cannot store.
+    def __init__(self, entry: VideoEntry, workers: int, max_pending: int):
+        self.entry = entry
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="mask-writer"
+        )
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def _written(self, future: Future):
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            with self._lock:
+                if self._error is None:
+                    self._error = error
+        self._pending.release()
+
+    def _raise_error(self):
+        with self._lock:
+            error = self._error
+        if error is not None:
+            raise error
+
+    def submit(self, frame_number: int, mask: np.ndarray, object_id: int = 0):
+        self._raise_error()
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(
+                write_mask, self.entry, frame_number, mask, object_id
+            )
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(self._written)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def migrate_masks(entry: VideoEntry) -> int:
+    legacy_directory = settings.mask_directory / entry.stem
+    if not legacy_directory.is_dir():
+        return 0
+
+    volume = mask_store.volume(entry.stem)
+    existing = set(volume.frame_numbers())
+    migrated = 0
+    for frame_number in get_mask_frame_numbers(entry):
+        if frame_number in existing:
+            continue
+        mask = read_mask(entry, frame_number)
+        if mask is not None:
+            volume.write(frame_number, mask)
+            migrated += 1
+
+    shutil.rmtree(legacy_directory)
+    return migrated
+
+
+if __name__ == "__main__":
+    videos, images_videos = video_catalog.entries()
+    for entry in videos + images_videos:
+        migrated = migrate_masks(entry)
+        if migrated > 0:
+            print(f"Migrated {migrated} masks for {entry.name}")
@@ -0,0 +1,183 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    math.inf,
+)
+
+DESCRIPTIONS = {
+    "monet_stage_duration_seconds": (
+        "histogram",
+        "Time spent in each stage of the frame and segmentation paths.",
+    ),
+    "monet_request_duration_seconds": ("histogram", "Time spent handling requests."),
+    "monet_cache_requests_total": ("counter", "Cache lookups by cache and result."),
+    "monet_segmentation_jobs_total": (
+        "counter",
+        "Finished segmentation jobs by status.",
+    ),
+    "monet_segmentation_frames_total": ("counter", "Frames propagated by jobs."),
+    "monet_segmentation_reused_frames_total": (
+        "counter",
+        "Frames of jobs served from the masks of an identical earlier job.",
+    ),
+    "monet_segmentation_jobs": ("gauge", "Segmentation jobs by status."),
+    "monet_frame_cache_bytes": ("gauge", "Size of the decoded frame cache."),
+    "monet_frame_cache_entries": ("gauge", "Frames in the decoded frame cache."),
+    "monet_inference_states": ("gauge", "Inference states in the cache."),
+    "monet_inference_state_bytes": ("gauge", "Size of the cached inference states."),
+    "monet_executor_pending": ("gauge", "Calls queued or running by executor."),
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = [
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    return "+Inf" if value == math.inf else str(value)
+
+
+class Metrics:
+    # Counters, gauges and histograms kept in memory and rendered in the
+    # Prometheus text format. Metrics recorded in segmentation worker
+    # processes stay in those processes.
+    def __init__(self):
+        self._counters: dict[tuple[str, Labels], float] = {}
+        self._gauges: dict[tuple[str, Labels], float] = {}
+        self._histograms: dict[tuple[str, Labels], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float, **labels: str):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(DURATION_BUCKETS)
+            histogram.observe(value)
+
+    def render(self) -> str:
+        samples: dict[str, list[str]] = {}
+        with self._lock:
+            for (name, labels), value in {**self._counters, **self._gauges}.items():
+                samples.setdefault(name, []).append(
+                    f"{name}{format_labels(labels)} {format_value(value)}"
+                )
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    bucket_label = (("le", format_value(bucket)),)
+                    lines.append(
+                        f"{name}_bucket{format_labels(labels, bucket_label)} "
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}"
+                )
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+        output = []
+        for name in sorted(samples):
+            metric_type, description = DESCRIPTIONS.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+
+metrics = Metrics()
+
+# The stages timed while handling a request, for its Server-Timing header.
+# None outside of a request, e.g. in the segmentation workers.
+request_timings: ContextVar[Optional[list[tuple[str, float]]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def record_span(stage: str, seconds: float):
+    metrics.observe("monet_stage_duration_seconds", seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - started)
+
+
+def record_cache_access(cache: str, hit: bool):
+    metrics.inc(
+        "monet_cache_requests_total", cache=cache, result="hit" if hit else "miss"
+    )
+
+
+def server_timing_header(timings: list[tuple[str, float]]) -> str:
+    # Stages run several times in a request, e.g. decode for a frame and its
+    # overlay, are summed.
+    durations: dict[str, float] = {}
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in durations.items()
+    )
@@ -0,0 +1,166 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+import torch
+
+from app.metrics import span
+from app.state_cache import inference_state_cache
+from app.video_processing import warm_up_predictor
+
+
+class LoadedModel:
+    def __init__(self, predictor: Any):
+        self.predictor = predictor
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class ModelManager:
+    # Holds the predictors of one segmentation worker by model name, so that a
+    # predictor is never used by two jobs at once. The default model is loaded
+    # and warmed up in the background when the worker starts, other variants
+    # are loaded by the first job asking for them. Models unused for
+    # idle_seconds are unloaded, and at most max_loaded are kept.
+    def __init__(
+        self,
+        loader: Callable[[str], Any],
+        default_model: str,
+        idle_seconds: float = 0.0,
+        max_loaded: int = 2,
+        warm_up: bool = True,
+        on_status: Optional[Callable[[dict], None]] = None,
+    ):
+        self.loader = loader
+        self.default_model = default_model
+        self.idle_seconds = idle_seconds
+        self.max_loaded = max(max_loaded, 1)
+        self.warm_up = warm_up
+        self.on_status = on_status
+        self._models: OrderedDict[str, LoadedModel] = OrderedDict()
+        self._loading: set[str] = set()
+        self._statuses: dict[str, str] = {default_model: "unloaded"}
+        self._errors: dict[str, str] = {}
+        self._condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(
+            target=self._load_default, name="model-warm-up", daemon=True
+        ).start()
+        if self.idle_seconds > 0:
+            threading.Thread(
+                target=self._unload_idle, name="model-idle-unload", daemon=True
+            ).start()
+
+    def _load_default(self):
+        try:
+            with self.lease(self.default_model, warm_up=self.warm_up):
+                pass
+        except Exception as e:
+            print(f"Error while loading {self.default_model}: {e}")
+
+    def _set_status(self, model_name: str, status: str, error: Optional[str] = None):
+        self._statuses[model_name] = status
+        if error is None:
+            self._errors.pop(model_name, None)
+        else:
+            self._errors[model_name] = error
+
+    def status(self) -> dict:
+        with self._condition:
+            return {
+                "default_model": self.default_model,
+                "ready": self._statuses.get(self.default_model) == "ready",
+                "models": dict(self._statuses),
+                "errors": dict(self._errors),
+            }
+
+    def _notify_status(self):
+        if self.on_status is not None:
+            self.on_status(self.status())
+
+    @contextmanager
+    def lease(
+        self, model_name: Optional[str] = None, warm_up: bool = False
+    ) -> Iterator[Any]:
+        model = self._acquire(model_name or self.default_model, warm_up)
+        try:
+            yield model.predictor
+        finally:
+            with self._condition:
+                model.in_use -= 1
+                model.last_used = time.monotonic()
+
+    def _acquire(self, model_name: str, warm_up: bool) -> LoadedModel:
+        with self._condition:
+            self._condition.wait_for(lambda: model_name not in self._loading)
+            model = self._models.get(model_name)
+            if model is not None:
+                model.in_use += 1
+                self._models.move_to_end(model_name)
+                return model
+            self._loading.add(model_name)
+            self._set_status(model_name, "loading")
+        self._notify_status()
+
+        # Loading takes a while, other models stay usable in the meantime.
+        try:
+            with span("load_model"):
+                predictor = self.loader(model_name)
+                if warm_up:
+                    warm_up_predictor(predictor)
+        except Exception as e:
+            with self._condition:
+                self._loading.discard(model_name)
+                self._set_status(model_name, "failed", str(e))
+                self._condition.notify_all()
+            self._notify_status()
+            raise
+
+        with self._condition:
+            model = LoadedModel(predictor)
+            model.in_use = 1
+            self._models[model_name] = model
+            self._loading.discard(model_name)
+            self._set_status(model_name, "ready")
+            evicted = self._evict(
+                lambda name, loaded: len(self._models) > self.max_loaded
+            )
+            self._condition.notify_all()
+        self._release(evicted)
+        self._notify_status()
+        return model
+
+    def _evict(self, should_evict: Callable[[str, LoadedModel], bool]) -> list[Any]:
+        # Called with the condition held, models in use are never evicted.
+        evicted = []
+        for model_name, model in list(self._models.items()):
+            if model.in_use == 0 and should_evict(model_name, model):
+                del self._models[model_name]
+                self._set_status(model_name, "unloaded")
+                evicted.append(model.predictor)
+        return evicted
+
+    def _release(self, predictors: list[Any]):
+        if not predictors:
+            return
+        for predictor in predictors:
+            inference_state_cache.invalidate_predictor(predictor)
+        predictors.clear()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self._notify_status()
+
+    def _unload_idle(self):
+        while True:
+            time.sleep(min(self.idle_seconds, 10.0))
+            now = time.monotonic()
+            with self._condition:
+                evicted = self._evict(
+                    lambda name, model: now - model.last_used > self.idle_seconds
+                )
+            self._release(evicted)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel
 
@@ -15,14 +15,76 @@ class Point(BaseModel):
     y: float
 
 
+class ObjectAnnotation(BaseModel):
+    objectId: int
+    box: Optional[Box] = None
+    positivePoints: list[Point] = []
+    negativePoints: list[Point] = []
+
+
 class Annotation(BaseModel):
     videoName: str
     frameNumber: int
+    # The points at the top level are the ones of object 0, other objects are
+    # listed in objects.
     box: Optional[Box] = None
     positivePoints: list[Point] = []
     negativePoints: list[Point] = []
+    objects: list[ObjectAnnotation] = []
 
 
 class FrameRange(BaseModel):
     start_frame: int
     end_frame: int
+
+
+class SegmentationRequest(FrameRange):
+    priority: int = 0
+    use_all_annotations: bool = False
+    # One of settings.sam2_model_variants, the default model if None.
+    model_name: Optional[str] = None
+
+
+class SegmentationJobInfo(BaseModel):
+    id: str
+    video_name: str
+    frame_number: int
+    start_frame: int
+    end_frame: int
+    priority: int
+    model_name: Optional[str] = None
+    status: Literal["queued", "running", "completed", "failed", "cancelled"]
+    processed_frames: int
+    total_frames: int
+    progress: float
+    eta_seconds: Optional[float] = None
+    error: Optional[str] = None
+    mask_paths: list[str] = []
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+class UploadSession(BaseModel):
+    id: str
+    video_name: str
+    size: Optional[int] = None
+    offset: int = 0
+
+
+class UploadSessionRequest(BaseModel):
+    videoName: str
+    size: Optional[int] = None
+
+
+class VideoMetadata(BaseModel):
+    name: str
+    is_video: bool
+    mtime_ns: int
+    size: int
+    frame_count: int
+    width: int
+    height: int
+    fps: Optional[float] = None
+    mask_frame_count: int = 0
+    masks_updated_ns: Optional[int] = None
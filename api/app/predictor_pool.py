@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import queue
+from multiprocessing.connection import Connection
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Event
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+
+from app.catalog import video_catalog
+from app.config import settings
+from app.mask_store import get_mask_paths
+from app.model_manager import ModelManager
+from app.scheduler import SegmentationJob, reuse_segmentation
+from app.video_processing import (
+    SegmentationCancelled,
+    coco_rle,
+    process_segmentation,
+)
+
+# Spawned rather than forked, torch does not survive a fork once it has
+# started its thread pools.
+context = multiprocessing.get_context("spawn")
+
+
+def get_torch_threads(workers: int, torch_threads: int) -> int:
+    if torch_threads > 0:
+        return torch_threads
+    return max((os.cpu_count() or 1) // max(workers, 1), 1)
+
+
+def serve_predictor(
+    connection: Connection,
+    cancel_event: Event,
+    statuses: Queue,
+    model_manager_factory: Callable[..., ModelManager],
+    torch_threads: int,
+):
+    # Each worker process gets an equal share of the cores, so that concurrent
+    # jobs do not oversubscribe the CPU.
+    torch.set_num_threads(torch_threads)
+    torch.set_num_interop_threads(1)
+
+    models = model_manager_factory(on_status=statuses.put)
+    models.start()
+
+    def send_mask(frame_number: int, object_id: int, mask: np.ndarray):
+        # Sent run-length encoded, a fraction of the size of the mask.
+        height, width = mask.shape[:2]
+        connection.send(
+            ("mask", frame_number, object_id, coco_rle(mask, width, height))
+        )
+
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        try:
+            with models.lease(job["model_name"]) as predictor:
+                process_segmentation(
+                    job["video_name"],
+                    job["frame_number"],
+                    job["start_frame"],
+                    job["end_frame"],
+                    predictor,
+                    use_all_annotations=job["use_all_annotations"],
+                    on_progress=lambda processed, total, frame_number: connection.send(
+                        ("progress", processed, total, frame_number)
+                    ),
+                    on_mask=send_mask if settings.segmentation_stream_masks else None,
+                    cancel_event=cancel_event,
+                    model_name=job["model_name"],
+                )
+            entry = video_catalog.get(job["video_name"])
+            mask_paths = [str(path) for path in get_mask_paths(entry)] if entry else []
+            connection.send(("completed", mask_paths))
+        except SegmentationCancelled:
+            connection.send(("cancelled",))
+        except Exception as e:
+            connection.send(("failed", str(e)))
+
+
+class PredictorProcess:
+    # Runs jobs in a worker process holding its own models. The process is
+    # started right away so that the default model warms up before the first
+    # job, and restarted if it dies. Progress and the paths of the written
+    # masks are sent back over a pipe, model statuses over a queue.
+    def __init__(
+        self, model_manager_factory: Callable[..., ModelManager], torch_threads: int
+    ):
+        self.model_manager_factory = model_manager_factory
+        self.torch_threads = torch_threads
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.connection: Optional[Connection] = None
+        self.cancel_event = context.Event()
+        self.statuses = context.Queue()
+        self._status: dict = {"ready": False, "models": {}, "errors": {}}
+        self.start()
+
+    def start(self):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=serve_predictor,
+            args=(
+                child_connection,
+                self.cancel_event,
+                self.statuses,
+                self.model_manager_factory,
+                self.torch_threads,
+            ),
+            name="segmentation-worker",
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def model_status(self) -> dict:
+        while True:
+            try:
+                self._status = self.statuses.get_nowait()
+            except queue.Empty:
+                break
+        if self.process is None or not self.process.is_alive():
+            return {**self._status, "ready": False}
+        return self._status
+
+    def run(self, job: SegmentationJob) -> list[str]:
+        # Checked here rather than in the worker process, a job whose masks
+        # are all stored neither waits for the process nor for a model.
+        mask_paths = reuse_segmentation(job)
+        if mask_paths is not None:
+            return mask_paths
+
+        if self.process is None or not self.process.is_alive():
+            self.start()
+
+        self.cancel_event.clear()
+        self.connection.send(
+            {
+                "video_name": job.video_name,
+                "frame_number": job.frame_number,
+                "start_frame": job.start_frame,
+                "end_frame": job.end_frame,
+                "use_all_annotations": job.use_all_annotations,
+                "model_name": job.model_name,
+            }
+        )
+
+        while True:
+            if job.cancel_event.is_set():
+                self.cancel_event.set()
+            try:
+                if not self.connection.poll(0.2):
+                    if not self.process.is_alive():
+                        raise RuntimeError("Segmentation worker process exited")
+                    continue
+                message = self.connection.recv()
+            except EOFError:
+                raise RuntimeError("Segmentation worker process exited")
+
+            if message[0] == "progress":
+                job.update_progress(*message[1:])
+            elif message[0] == "mask":
+                job.publish_mask(*message[1:])
+            elif message[0] == "completed":
+                return message[1]
+            elif message[0] == "cancelled":
+                raise SegmentationCancelled()
+            else:
+                raise RuntimeError(message[1])
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.connection.send(None)
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+        self.process = None
@@ -0,0 +1,141 @@
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+import cv2
+
+from app.catalog import VideoEntry, video_catalog
+from app.config import settings
+
+
+def get_proxy_size(width: int, height: int, proxy_height: int) -> tuple[int, int]:
+    # Video encoders expect even dimensions.
+    proxy_width = int(round(width * proxy_height / height / 2)) * 2
+    return max(proxy_width, 2), proxy_height - proxy_height % 2
+
+
+def get_proxy_path(entry: VideoEntry, proxy_height: int) -> Path:
+    if entry.is_video:
+        return settings.proxy_directory / entry.stem / f"{proxy_height}.mp4"
+    return settings.proxy_directory / entry.stem / str(proxy_height)
+
+
+def get_proxy_marker(entry: VideoEntry, proxy_height: int) -> Path:
+    return settings.proxy_directory / entry.stem / f"{proxy_height}.done"
+
+
+def is_proxy_ready(entry: VideoEntry, proxy_height: int) -> bool:
+    # The marker is written once the rendition is complete, a source modified
+    # after that makes the rendition stale.
+    try:
+        marker_mtime = get_proxy_marker(entry, proxy_height).stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return marker_mtime >= entry.mtime_ns
+
+
+def get_proxy_heights(entry: VideoEntry) -> list[int]:
+    return sorted(
+        proxy_height
+        for proxy_height in settings.proxy_heights
+        if 0 < proxy_height < entry.height
+    )
+
+
+def find_proxy(entry: VideoEntry, width: int, height: int) -> Optional[Path]:
+    for proxy_height in get_proxy_heights(entry):
+        proxy_width, proxy_height_even = get_proxy_size(
+            entry.width, entry.height, proxy_height
+        )
+        if proxy_width < width or proxy_height_even < height:
+            continue
+        if is_proxy_ready(entry, proxy_height):
+            return get_proxy_path(entry, proxy_height)
+    return None
+
+
+def clear_proxies(video_name: str):
+    proxy_directory = settings.proxy_directory / video_name
+    if proxy_directory.exists():
+        shutil.rmtree(proxy_directory)
+
+
+def generate_video_proxies(entry: VideoEntry, proxy_heights: list[int]):
+    capture = cv2.VideoCapture(str(entry.path))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+
+    writers = {}
+    for proxy_height in proxy_heights:
+        size = get_proxy_size(entry.width, entry.height, proxy_height)
+        temporary_path = get_proxy_path(entry, proxy_height).with_suffix(".tmp.mp4")
+        writers[proxy_height] = (
+            cv2.VideoWriter(str(temporary_path), fourcc, fps, size),
+            temporary_path,
+            size,
+        )
+
+    try:
+        while True:
+            success, frame = capture.read()
+            if not success:
+                break
+            for writer, _, size in writers.values():
+                writer.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+    finally:
+        capture.release()
+        for writer, _, _ in writers.values():
+            writer.release()
+
+    for proxy_height, (_, temporary_path, _) in writers.items():
+        os.replace(temporary_path, get_proxy_path(entry, proxy_height))
+        get_proxy_marker(entry, proxy_height).touch()
+
+
+def generate_images_proxies(entry: VideoEntry, proxy_heights: list[int]):
+    sizes = {}
+    for proxy_height in proxy_heights:
+        proxy_path = get_proxy_path(entry, proxy_height)
+        proxy_path.mkdir(parents=True, exist_ok=True)
+        sizes[proxy_height] = get_proxy_size(entry.width, entry.height, proxy_height)
+
+    for frame_name in entry.frame_names:
+        frame = cv2.imread(str(entry.path / frame_name))
+        if frame is None:
+            # A rendition missing frames is never marked as ready, the frames
+            # keep being served from the originals.
+            print(f"Cannot decode {frame_name} of {entry.name}, proxies not kept")
+            clear_proxies(entry.stem)
+            return
+        for proxy_height, size in sizes.items():
+            if not cv2.imwrite(
+                str(get_proxy_path(entry, proxy_height) / frame_name),
+                cv2.resize(frame, size, interpolation=cv2.INTER_AREA),
+            ):
+                raise OSError(f"Cannot write the {proxy_height}p proxy of {frame_name}")
+
+    for proxy_height in proxy_heights:
+        get_proxy_marker(entry, proxy_height).touch()
+
+
+def generate_proxies(video_file: str):
+    entry = video_catalog.get(video_file)
+    if entry is None or entry.width == 0 or entry.height == 0:
+        print(f"Cannot generate proxies for {video_file}")
+        return
+
+    clear_proxies(entry.stem)
+    proxy_heights = get_proxy_heights(entry)
+    if not proxy_heights:
+        return
+    (settings.proxy_directory / entry.stem).mkdir(parents=True, exist_ok=True)
+
+    try:
+        if entry.is_video:
+            generate_video_proxies(entry, proxy_heights)
+        else:
+            generate_images_proxies(entry, proxy_heights)
+    except Exception as e:
+        print(f"Error while generating proxies for {video_file}: {e}")
+        clear_proxies(entry.stem)
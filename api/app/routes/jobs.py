@@ -0,0 +1,71 @@
+import json
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
+
+from app.dependencies import get_scheduler
+from app.models import SegmentationJobInfo
+from app.scheduler import SegmentationScheduler
+
+router = APIRouter(prefix="/jobs")
+
+
+@router.get("", response_model=list[SegmentationJobInfo])
+def get_jobs(
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
+    video_name: Optional[str] = None,
+    status: Optional[str] = None,
+):
+    return [job.info() for job in scheduler.jobs(video_name, status)]
+
+
+@router.get("/{job_id}", response_model=SegmentationJobInfo)
+def get_job(
+    job_id: str,
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
+):
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.info()
+
+
+@router.post("/{job_id}/cancel", response_model=SegmentationJobInfo)
+def cancel_job(
+    job_id: str,
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
+):
+    job = scheduler.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.info()
+
+
+@router.get("/{job_id}/events")
+def follow_job(
+    job_id: str,
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
+    masks: bool = True,
+    last_event_id: Annotated[Optional[int], Header()] = None,
+):
+    # Server-sent events: the status of the job when it changes, its progress
+    # after each propagated frame and, unless masks is false, the mask of each
+    # object as soon as it is computed, in COCO RLE. The stream ends with the
+    # final status. Clients reconnecting with Last-Event-ID get the status and
+    # progress events they missed, masks are only sent while connected.
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        async for event_id, event, data in job.events.follow(
+            -1 if last_event_id is None else last_event_id, live=masks
+        ):
+            yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
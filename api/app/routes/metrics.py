@@ -0,0 +1,41 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from app.dependencies import get_scheduler
+from app.executors import executors
+from app.frame_cache import frame_cache
+from app.metrics import metrics
+from app.scheduler import SegmentationScheduler
+from app.state_cache import inference_state_cache
+
+router = APIRouter()
+
+JOB_STATUSES = ("queued", "running", "completed", "failed", "cancelled")
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics(
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
+):
+    # Gauges are read when scraped, counters and histograms are recorded as
+    # the stages run.
+    jobs = scheduler.jobs()
+    for status in JOB_STATUSES:
+        metrics.set(
+            "monet_segmentation_jobs",
+            sum(1 for job in jobs if job.status == status),
+            status=status,
+        )
+    metrics.set("monet_frame_cache_bytes", frame_cache.size)
+    metrics.set("monet_frame_cache_entries", len(frame_cache))
+    states, states_bytes = inference_state_cache.stats()
+    metrics.set("monet_inference_states", states)
+    metrics.set("monet_inference_state_bytes", states_bytes)
+    for executor in executors:
+        metrics.set("monet_executor_pending", executor.pending, executor=executor.name)
+
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,17 +1,77 @@
+import asyncio
+from pathlib import Path
 from typing import Annotated, Optional
 
-import cv2
-import numpy as np
-from fastapi import APIRouter, Form, HTTPException, UploadFile
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Form,
+    HTTPException,
+    Request,
+    UploadFile,
+)
 
 from app.config import settings
+from app.executors import background_executor, io_executor
+from app.keyframes import keyframe_index
+from app.manifest import video_manifest
+from app.models import UploadSession, UploadSessionRequest
+from app.proxies import generate_proxies
+from app.state_cache import inference_state_cache
+from app.uploads import (
+    commit_uploaded_images,
+    complete_upload_session,
+    convert_to_jpeg,
+    copy_file,
+    create_upload_session,
+    delete_upload_session,
+    expire_upload_sessions,
+    get_session_part_path,
+    get_staged_path,
+    get_upload_session,
+    image_conversion_pool,
+    remove_uploaded_images,
+)
 
 router = APIRouter(prefix="/upload")
 
+# Appends to a session are serialized, the offset check would not hold if two
+# requests wrote to the same part at once. Locks are only created for existing
+# sessions and dropped once a session is completed, aborted or expired.
+session_locks: dict[str, asyncio.Lock] = {}
+
+
+def get_session_lock(session_id: str) -> asyncio.Lock:
+    if get_upload_session(session_id) is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session_locks.setdefault(session_id, asyncio.Lock())
+
+
+def get_locked_session(session_id: str) -> UploadSession:
+    # Read again once the lock is held, the session may have been completed or
+    # aborted by the request holding it before.
+    session = get_upload_session(session_id)
+    if session is None:
+        session_locks.pop(session_id, None)
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+def finish_upload(video_name: str, background_tasks: BackgroundTasks):
+    # Probes the new video for the manifest, called in the io executor.
+    inference_state_cache.invalidate(video_name)
+    video_manifest.update(video_name)
+    if video_name.endswith(".mp4"):
+        background_tasks.add_task(
+            background_executor.run, keyframe_index.get, settings.video_dir / video_name
+        )
+    background_tasks.add_task(background_executor.run, generate_proxies, video_name)
+
 
 @router.post("")
 async def upload_files(
     videoName: Annotated[str | None, Form()],
+    background_tasks: BackgroundTasks,
     images: Optional[list[UploadFile]] = None,
     video: Optional[UploadFile] = None,
 ):
@@ -34,8 +94,11 @@ async def upload_files(
         else:
             raise HTTPException(status_code=400, detail="Video name must be provided")
 
-        with open(video_location, "wb") as f:
-            f.write(await video.read())
+        await io_executor.run(
+            copy_file, video.file, video_location, settings.upload_chunk_size
+        )
+
+        await io_executor.run(finish_upload, video_location.name, background_tasks)
 
     if images:
         if videoName is None:
@@ -43,25 +106,141 @@ async def upload_files(
                 status_code=400, detail="Video name must be provided for images"
             )
 
+        if any(image.filename is None for image in images):
+            raise HTTPException(status_code=400, detail="Image must have a filename")
+
         image_dir = settings.images_dir / videoName
+        created = not image_dir.exists()
         image_dir.mkdir(exist_ok=True, parents=True)
 
-        for image in images:
-            if image.filename is None:
+        # The frames of the batch, written under their staged names, and the
+        # PNGs waiting to be converted.
+        frames: list[Path] = []
+        sources: list[Path] = []
+        loop = asyncio.get_running_loop()
+        conversions = {}
+        try:
+            for image in images:
+                if image.filename.lower().endswith(".png"):
+                    png_location = image_dir / f".{image.filename}"
+                    jpg_location = image_dir / f"{image.filename.rsplit('.', 1)[0]}.jpg"
+                    sources.append(png_location)
+                    frames.append(jpg_location)
+                    await io_executor.run(
+                        copy_file, image.file, png_location, settings.upload_chunk_size
+                    )
+                    conversions[image.filename] = loop.run_in_executor(
+                        image_conversion_pool,
+                        convert_to_jpeg,
+                        str(png_location),
+                        str(get_staged_path(jpg_location)),
+                    )
+                else:
+                    file_location = image_dir / image.filename
+                    frames.append(file_location)
+                    await io_executor.run(
+                        copy_file,
+                        image.file,
+                        get_staged_path(file_location),
+                        settings.upload_chunk_size,
+                    )
+            converted = await asyncio.gather(
+                *conversions.values(), return_exceptions=True
+            )
+            failed = [
+                filename
+                for filename, success in zip(conversions, converted)
+                if success is not True
+            ]
+            if failed:
                 raise HTTPException(
-                    status_code=400, detail="Image must have a filename"
+                    status_code=400, detail=f"Could not convert images: {failed}"
                 )
-            file_location = image_dir / image.filename
-
-            if image.filename.lower().endswith(".png"):
-                image_data = await image.read()
-                image_array = np.frombuffer(image_data, np.uint8)
-                img = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-                jpg_filename = image.filename.rsplit(".", 1)[0] + ".jpg"
-                file_location = image_dir / jpg_filename
-                cv2.imwrite(str(file_location), img)
-            else:
-                with open(file_location, "wb") as f:
-                    f.write(await image.read())
+        except BaseException:
+            await asyncio.gather(*conversions.values(), return_exceptions=True)
+            staged = [get_staged_path(frame) for frame in frames]
+            await io_executor.run(
+                remove_uploaded_images, image_dir, staged + sources, created
+            )
+            raise
+
+        await io_executor.run(commit_uploaded_images, frames)
+
+        await io_executor.run(finish_upload, videoName, background_tasks)
 
     return {"info": "files successfully uploaded"}
+
+
+@router.post("/sessions", response_model=UploadSession)
+def start_upload_session(session_request: UploadSessionRequest):
+    if not session_request.videoName.endswith(".mp4"):
+        raise HTTPException(status_code=400, detail="Only mp4 videos can be uploaded")
+    if Path(session_request.videoName).name != session_request.videoName:
+        raise HTTPException(status_code=400, detail="Invalid video name")
+    for session_id in expire_upload_sessions(settings.upload_session_max_age):
+        session_locks.pop(session_id, None)
+    return create_upload_session(session_request.videoName, session_request.size)
+
+
+@router.get("/sessions/{session_id}", response_model=UploadSession)
+def get_session(session_id: str):
+    session = get_upload_session(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+@router.put("/sessions/{session_id}", response_model=UploadSession)
+async def append_to_session(session_id: str, offset: int, request: Request):
+    async with get_session_lock(session_id):
+        session = get_locked_session(session_id)
+        # A client resuming an interrupted upload starts again from the offset
+        # of the session.
+        if offset != session.offset:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload session is at offset {session.offset}",
+            )
+
+        f = await io_executor.run(open, get_session_part_path(session_id), "ab")
+        try:
+            async for chunk in request.stream():
+                if session.size is not None and session.offset + len(chunk) > (
+                    session.size
+                ):
+                    raise HTTPException(
+                        status_code=400, detail="Upload is larger than announced"
+                    )
+                await io_executor.run(f.write, chunk)
+                session.offset += len(chunk)
+        finally:
+            await io_executor.run(f.close)
+
+    return session
+
+
+@router.post("/sessions/{session_id}/complete")
+async def complete_session(session_id: str, background_tasks: BackgroundTasks):
+    async with get_session_lock(session_id):
+        session = get_locked_session(session_id)
+        if session.size is not None and session.offset != session.size:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload session is at offset {session.offset} of "
+                f"{session.size}",
+            )
+        video_location = await io_executor.run(complete_upload_session, session)
+    session_locks.pop(session_id, None)
+
+    await io_executor.run(finish_upload, video_location.name, background_tasks)
+    return {"info": "files successfully uploaded"}
+
+
+@router.delete("/sessions/{session_id}")
+def abort_session(session_id: str):
+    session = get_upload_session(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    delete_upload_session(session)
+    session_locks.pop(session_id, None)
+    return {"info": "Upload session deleted"}
@@ -1,22 +1,54 @@
 import json
-from typing import Annotated, Any, DefaultDict, Optional
+import shutil
+from typing import Annotated, Literal, Optional
 
-import cv2
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
-from sam2.sam2_video_predictor import SAM2VideoPredictor
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    HTTPException,
+    Request,
+    Response,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
 
+from app.annotation_store import annotation_store
+from app.catalog import video_catalog
 from app.config import settings
-from app.dependencies import get_sam2_predictor, get_task_queue
-from app.models import Annotation, Box, FrameRange, Point
+from app.dependencies import get_scheduler
+from app.executors import background_executor, frame_executor, io_executor
+from app.manifest import video_manifest
+from app.mask_store import clear_masks, get_mask_version
+from app.models import (
+    Annotation,
+    Box,
+    ObjectAnnotation,
+    Point,
+    SegmentationRequest,
+)
+from app.proxies import clear_proxies
+from app.scheduler import (
+    ACTIVE_STATUSES,
+    JobConflictError,
+    QueueFullError,
+    SegmentationJob,
+    SegmentationScheduler,
+)
+from app.state_cache import inference_state_cache
 from app.video_processing import (
-    apply_image_mask,
     calculate_resized_size,
     encode_image,
+    encode_image_bytes,
+    export_segmented_images,
+    frame_etag,
     get_annotation,
-    get_videos_sizes,
-    process_segmentation,
+    get_frame_size,
+    get_frame_source,
+    get_mtime,
     read_frame,
-    retrieve_video_files,
+    read_frames,
+    render_mask_payload,
+    render_overlay,
 )
 
 router = APIRouter(prefix="/videos")
@@ -24,54 +56,101 @@ router = APIRouter(prefix="/videos")
 
 @router.get("")
 def get_videos():
-    videos, images_videos = retrieve_video_files()
-    videos_sizes, invalid_images_videos = get_videos_sizes(videos, images_videos)
+    videos, images_videos = video_manifest.entries()
 
+    invalid_images_videos = [
+        metadata.name for metadata in images_videos if metadata.frame_count == 0
+    ]
     if len(invalid_images_videos) > 0:
         print(f"Invalid images videos: {invalid_images_videos}")
-        for invalid_image_video in invalid_images_videos:
-            images_videos.remove(invalid_image_video)
 
-    videos.extend(images_videos)
-    return {"videos": videos, "count": len(videos), "videos_sizes": videos_sizes}
+    metadata = videos + [
+        metadata for metadata in images_videos if metadata.frame_count > 0
+    ]
+    return {
+        "videos": [video.name for video in metadata],
+        "count": len(metadata),
+        "videos_sizes": [video.size for video in metadata],
+        "metadata": metadata,
+    }
+
+
+@router.delete("/{video_file}")
+def delete_video(
+    video_file: str,
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
+):
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    for status in ACTIVE_STATUSES:
+        if scheduler.jobs(video_file, status):
+            raise HTTPException(
+                status_code=409, detail="Video has a segmentation job in progress"
+            )
+
+    # Annotations are kept, they apply again if the video is uploaded again.
+    if entry.is_video:
+        entry.path.unlink(missing_ok=True)
+    else:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    clear_masks(entry)
+    clear_proxies(entry.stem)
+    inference_state_cache.invalidate(video_file)
+    video_catalog.invalidate(video_file)
+    video_manifest.remove(video_file)
+
+    return {"info": f"Video {video_file} deleted."}
 
 
 @router.get("/{video_file}/frame/{frame_number}")
-def get_frame(
+async def get_frame(
     video_file: str,
     frame_number: int,
     max_height: int = 480,
     max_width: int = 640,
+    mask_format: Literal["image", "polygons", "rle"] = "image",
+):
+    return await frame_executor.run(
+        frame_payload, video_file, frame_number, max_height, max_width, mask_format
+    )
+
+
+def frame_payload(
+    video_file: str,
+    frame_number: int,
+    max_height: int,
+    max_width: int,
+    mask_format: str,
 ):
-    frame, video_name, frame_name = read_frame(video_file, frame_number)
+    frame, video_name, frame_name = read_frame(
+        video_file, frame_number, max_height, max_width
+    )
     if video_name is None:
-        return HTTPException(status_code=404, detail="Video not found")
+        raise HTTPException(status_code=404, detail="Video not found")
     if frame is None or frame_name is None:
-        return HTTPException(status_code=404, detail="Frame not found")
+        raise HTTPException(status_code=404, detail="Frame not found")
 
     annotation = get_annotation(video_name, frame_number)
 
-    current_height, current_width = frame.shape[:2]
-    width, height = calculate_resized_size(
-        current_height, current_width, max_height, max_width
-    )
-
-    frame = cv2.resize(frame, (width, height))
+    height, width = frame.shape[:2]
     try:
         image_base64 = encode_image(frame)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error encoding image: {e}") from e
 
-    mask_file = settings.mask_directory / video_name / frame_name
+    # With mask_format polygons or rle the overlay is drawn by the client from
+    # mask instead of being sent as a second image.
+    entry = video_catalog.get(video_file)
+    mask = None
     try:
-        segmented_img = apply_image_mask(
-            mask_file,
-            frame,
-            width,
-            height,
-            save_name=video_name / frame_name,
-            save=True,
-        )
+        if entry is None:
+            segmented_img = None
+        elif mask_format == "image":
+            segmented_img = render_overlay(entry, frame_number, frame)
+        else:
+            segmented_img = None
+            mask = render_mask_payload(entry, frame_number, width, height, mask_format)
         if segmented_img is not None:
             segmented_image_base64 = encode_image(segmented_img)
         else:
@@ -82,6 +161,7 @@ def get_frame(
     return {
         "image": image_base64,
         "segmented_image": segmented_image_base64,
+        "mask": mask,
         "frame_number": frame_number,
         "annotation": annotation,
         "width": width,
@@ -89,9 +169,350 @@ def get_frame(
     }
 
 
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+
+def image_response(content: bytes, etag: str, cache_control: str) -> Response:
+    return Response(
+        content=content,
+        media_type="image/webp",
+        headers={"ETag": etag, "Cache-Control": cache_control},
+    )
+
+
+def not_modified_response(etag: str, cache_control: str) -> Response:
+    return Response(
+        status_code=304, headers={"ETag": etag, "Cache-Control": cache_control}
+    )
+
+
+@router.get("/{video_file}/frame/{frame_number}/meta")
+def get_frame_meta(
+    video_file: str,
+    frame_number: int,
+    max_height: int = 480,
+    max_width: int = 640,
+):
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    frame_name = entry.frame_name(frame_number)
+    frame_path = entry.frame_path(frame_number)
+    if frame_name is None or frame_path is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+
+    width, height = calculate_resized_size(
+        entry.height, entry.width, max_height, max_width
+    )
+    return {
+        "frame_number": frame_number,
+        "annotation": get_annotation(entry.stem, frame_number),
+        "width": width,
+        "height": height,
+        "version": get_mtime(frame_path),
+        "mask_version": get_mask_version(entry, frame_number),
+    }
+
+
+@router.get("/{video_file}/frame/{frame_number}/image")
+async def get_frame_image(
+    request: Request,
+    video_file: str,
+    frame_number: int,
+    max_height: int = 480,
+    max_width: int = 640,
+):
+    return await frame_executor.run(
+        frame_image_response, request, video_file, frame_number, max_height, max_width
+    )
+
+
+def frame_image_response(
+    request: Request,
+    video_file: str,
+    frame_number: int,
+    max_height: int,
+    max_width: int,
+) -> Response:
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    frame_path = entry.frame_path(frame_number)
+    source_mtime = get_mtime(frame_path) if frame_path is not None else None
+    if source_mtime is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+
+    cache_control = settings.frame_cache_control
+    size = get_frame_size(entry, max_height, max_width)
+    etag = frame_etag(
+        video_file,
+        frame_number,
+        source_mtime,
+        max_height,
+        max_width,
+        get_frame_source(entry, size),
+    )
+    if etag_matches(request, etag):
+        return not_modified_response(etag, cache_control)
+
+    frame, _, _ = read_frame(video_file, frame_number, max_height, max_width)
+    if frame is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+
+    try:
+        content = encode_image_bytes(frame)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error encoding image: {e}") from e
+
+    return image_response(content, etag, cache_control)
+
+
+@router.get("/{video_file}/frame/{frame_number}/overlay")
+async def get_frame_overlay(
+    request: Request,
+    video_file: str,
+    frame_number: int,
+    max_height: int = 480,
+    max_width: int = 640,
+):
+    return await frame_executor.run(
+        frame_overlay_response,
+        request,
+        video_file,
+        frame_number,
+        max_height,
+        max_width,
+    )
+
+
+def frame_overlay_response(
+    request: Request,
+    video_file: str,
+    frame_number: int,
+    max_height: int,
+    max_width: int,
+) -> Response:
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    frame_name = entry.frame_name(frame_number)
+    frame_path = entry.frame_path(frame_number)
+    source_mtime = get_mtime(frame_path) if frame_path is not None else None
+    if frame_name is None or source_mtime is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+
+    mask_version = get_mask_version(entry, frame_number)
+    if mask_version is None:
+        raise HTTPException(status_code=404, detail="Mask not found")
+
+    cache_control = settings.overlay_cache_control
+    etag = frame_etag(
+        video_file, frame_number, source_mtime, mask_version, max_height, max_width
+    )
+    if etag_matches(request, etag):
+        return not_modified_response(etag, cache_control)
+
+    frame, _, _ = read_frame(video_file, frame_number, max_height, max_width)
+    if frame is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+
+    try:
+        segmented_img = render_overlay(entry, frame_number, frame)
+        if segmented_img is None:
+            raise HTTPException(status_code=404, detail="Mask not found")
+        content = encode_image_bytes(segmented_img)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error encoding image: {e}") from e
+
+    return image_response(content, etag, cache_control)
+
+
+@router.get("/{video_file}/frame/{frame_number}/mask")
+async def get_frame_mask(
+    request: Request,
+    video_file: str,
+    frame_number: int,
+    max_height: int = 480,
+    max_width: int = 640,
+    format: Literal["polygons", "rle"] = "polygons",
+):
+    return await frame_executor.run(
+        frame_mask_response,
+        request,
+        video_file,
+        frame_number,
+        max_height,
+        max_width,
+        format,
+    )
+
+
+def frame_mask_response(
+    request: Request,
+    video_file: str,
+    frame_number: int,
+    max_height: int,
+    max_width: int,
+    mask_format: str,
+) -> Response:
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    mask_version = get_mask_version(entry, frame_number)
+    if mask_version is None:
+        raise HTTPException(status_code=404, detail="Mask not found")
+
+    cache_control = settings.overlay_cache_control
+    etag = frame_etag(
+        video_file, frame_number, mask_version, max_height, max_width, mask_format
+    )
+    if etag_matches(request, etag):
+        return not_modified_response(etag, cache_control)
+
+    width, height = calculate_resized_size(
+        entry.height, entry.width, max_height, max_width
+    )
+    mask = render_mask_payload(entry, frame_number, width, height, mask_format)
+    if mask is None:
+        raise HTTPException(status_code=404, detail="Mask not found")
+    return JSONResponse(
+        {"frame_number": frame_number, "mask_version": mask_version, **mask},
+        headers={"ETag": etag, "Cache-Control": cache_control},
+    )
+
+
+@router.get("/{video_file}/frames")
+async def get_frames(
+    video_file: str,
+    start: int = 0,
+    count: int = 16,
+    max_height: int = 480,
+    max_width: int = 640,
+    output: Literal["ndjson", "multipart"] = "ndjson",
+    mask_format: Optional[Literal["polygons", "rle"]] = None,
+):
+    if start < 0:
+        raise HTTPException(status_code=400, detail="start should be positive")
+    if count < 1 or count > settings.max_batch_frames:
+        raise HTTPException(
+            status_code=400,
+            detail=f"count should be between 1 and {settings.max_batch_frames}",
+        )
+
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    # Frames are decoded and encoded in the frame executor one at a time as
+    # the response is streamed.
+    frames = read_frames(entry, start, count, max_height, max_width)
+
+    def ndjson_stream():
+        annotations = annotation_store.get_range(entry.stem, start, start + count)
+        for frame_number, frame_name, frame in frames:
+            height, width = frame.shape[:2]
+            annotation = annotations.get(frame_number)
+            line = {
+                "frame_number": frame_number,
+                "image": encode_image(frame),
+                "width": width,
+                "height": height,
+                "annotation": annotation.model_dump() if annotation else None,
+                "version": get_mtime(entry.frame_path(frame_number)),
+                "mask_version": get_mask_version(entry, frame_number),
+            }
+            if mask_format is not None:
+                line["mask"] = render_mask_payload(
+                    entry, frame_number, width, height, mask_format
+                )
+            yield json.dumps(line) + "\n"
+
+    def multipart_stream():
+        for frame_number, _, frame in frames:
+            height, width = frame.shape[:2]
+            headers = (
+                f"--frame\r\n"
+                f"Content-Type: image/webp\r\n"
+                f"X-Frame-Number: {frame_number}\r\n"
+                f"X-Frame-Width: {width}\r\n"
+                f"X-Frame-Height: {height}\r\n\r\n"
+            )
+            yield headers.encode() + encode_image_bytes(frame) + b"\r\n"
+        yield b"--frame--\r\n"
+
+    if output == "multipart":
+        return StreamingResponse(
+            frame_executor.iterate(multipart_stream()),
+            media_type="multipart/mixed; boundary=frame",
+        )
+    return StreamingResponse(
+        frame_executor.iterate(ndjson_stream()), media_type="application/x-ndjson"
+    )
+
+
+@router.post("/{video_file}/segmented_images")
+def export_segmented(
+    video_file: str,
+    background_tasks: BackgroundTasks,
+    start_frame: int = 0,
+    end_frame: int = -1,
+):
+    if video_catalog.get(video_file) is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    background_tasks.add_task(
+        background_executor.run,
+        export_segmented_images,
+        video_file,
+        start_frame,
+        end_frame,
+    )
+
+    return {"info": f"Segmented images for {video_file} are being exported."}
+
+
+@router.get("/{video_name}/annotations", response_model=list[Annotation])
+async def get_annotations_range(
+    video_name: str, start_frame: int = 0, end_frame: int = -1
+):
+    # Annotated frames in [start_frame, end_frame], up to the last frame if
+    # end_frame is -1.
+    annotations = await io_executor.run(
+        annotation_store.get_range,
+        video_name.replace(".mp4", ""),
+        start_frame,
+        end_frame + 1 if end_frame >= 0 else None,
+    )
+    return list(annotations.values())
+
+
+@router.put("/{video_name}/annotations")
+async def annotate_frames(video_name: str, annotations: list[Annotation]):
+    if video_catalog.get(video_name) is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    # Saved in one transaction, none is saved if one of them is rejected.
+    await io_executor.run(
+        annotation_store.put_many,
+        video_name.replace(".mp4", ""),
+        {annotation.frameNumber: annotation for annotation in annotations},
+    )
+    return {"info": f"Annotations for {len(annotations)} frames saved."}
+
+
 @router.get("/{video_name}/annotations/{frame_number}", response_model=Annotation)
 async def get_annotations(video_name: str, frame_number: int):
-    annotation = get_annotation(video_name.replace(".mp4", ""), frame_number)
+    annotation = await io_executor.run(
+        get_annotation, video_name.replace(".mp4", ""), frame_number
+    )
     if annotation is None:
         raise HTTPException(status_code=404, detail="Annotation not found")
     return annotation
@@ -104,30 +525,63 @@ async def annotate_frame(
     box: Optional[Box] = None,
     positivePoints: list[Point] | None = None,
     negativePoints: list[Point] | None = None,
+    objects: list[ObjectAnnotation] | None = None,
+    object_id: int = 0,
 ):
     if positivePoints is None:
         positivePoints = []
     if negativePoints is None:
         negativePoints = []
 
-    output_dir = settings.annotation_directory / video_name.replace(".mp4", "")
-    output_dir.mkdir(exist_ok=True, parents=True)
-
-    videos, images_videos = retrieve_video_files()
-    if video_name not in images_videos and video_name not in videos:
+    if video_catalog.get(video_name) is None:
         raise HTTPException(status_code=404, detail="Video not found")
 
-    annotation = Annotation(
-        videoName=video_name,
-        frameNumber=frame_number,
-        box=box if box else None,
-        positivePoints=positivePoints,
-        negativePoints=negativePoints,
-    )
+    # When objects is sent the request holds the whole annotation of the frame.
+    # Otherwise the points sent replace the ones of object_id and the other
+    # objects of the frame are kept, the annotation is read and written in one
+    # transaction.
+    def update_annotation(annotation: Optional[Annotation]) -> Annotation:
+        if objects is not None:
+            annotation = Annotation(
+                videoName=video_name,
+                frameNumber=frame_number,
+                box=box if box else None,
+                positivePoints=positivePoints,
+                negativePoints=negativePoints,
+                objects=objects,
+            )
+        else:
+            if annotation is None:
+                annotation = Annotation(videoName=video_name, frameNumber=frame_number)
+            if object_id == 0:
+                annotation.box = box if box else None
+                annotation.positivePoints = positivePoints
+                annotation.negativePoints = negativePoints
+            else:
+                annotation.objects = [
+                    annotation_object
+                    for annotation_object in annotation.objects
+                    if annotation_object.objectId != object_id
+                ]
+                annotation.objects.append(
+                    ObjectAnnotation(
+                        objectId=object_id,
+                        box=box if box else None,
+                        positivePoints=positivePoints,
+                        negativePoints=negativePoints,
+                    )
+                )
+        annotation.objects.sort(
+            key=lambda annotation_object: annotation_object.objectId
+        )
+        return annotation
 
-    annotation_file = output_dir / f"{frame_number}.json"
-    with open(annotation_file, "w") as f:
-        json.dump(annotation.model_dump(), f, indent=4)
+    await io_executor.run(
+        annotation_store.update,
+        video_name.replace(".mp4", ""),
+        frame_number,
+        update_annotation,
+    )
 
     return {"info": f"Annotations for frame {frame_number} saved."}
 
@@ -136,13 +590,11 @@ async def annotate_frame(
 async def segment_and_mask(
     video_name: str,
     frame_number: int,
-    frame_range: FrameRange,
-    background_tasks: BackgroundTasks,
-    sam2_predictor: Annotated[SAM2VideoPredictor, Depends(get_sam2_predictor)],
-    task_queue: Annotated[DefaultDict[Any, list], Depends(get_task_queue)],
+    segmentation_request: SegmentationRequest,
+    scheduler: Annotated[SegmentationScheduler, Depends(get_scheduler)],
 ):
-    start_frame = frame_range.start_frame
-    end_frame = frame_range.end_frame
+    start_frame = segmentation_request.start_frame
+    end_frame = segmentation_request.end_frame
 
     if start_frame > frame_number:
         raise HTTPException(
@@ -162,24 +614,32 @@ async def segment_and_mask(
             status_code=400, detail="end_frame should be greater than 0 or equal to -1"
         )
 
-    videos, images_videos = retrieve_video_files()
-    if video_name not in images_videos and video_name not in videos:
+    if video_catalog.get(video_name) is None:
         raise HTTPException(status_code=400, detail="Video not found")
+    model_name = segmentation_request.model_name
+    if model_name is not None and model_name not in settings.sam2_model_variants:
+        raise HTTPException(
+            status_code=400,
+            detail=f"model_name should be one of {settings.sam2_model_variants}",
+        )
 
-    if (video_name, frame_number) in task_queue:
-        raise HTTPException(status_code=400, detail="Task already in queue")
-
-    task_queue[(video_name, frame_number)].append((start_frame, end_frame))
-    background_tasks.add_task(
-        process_segmentation,
+    job = SegmentationJob(
         video_name,
         frame_number,
         start_frame,
         end_frame,
-        sam2_predictor,
-        task_queue,
+        priority=segmentation_request.priority,
+        use_all_annotations=segmentation_request.use_all_annotations,
+        model_name=model_name,
     )
+    try:
+        scheduler.submit(job)
+    except JobConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e)) from e
 
     return {
-        "info": f"Segmentation and mask for frame {frame_number} is being processed."
+        "info": f"Segmentation and mask for frame {frame_number} is being processed.",
+        "job": job.info(),
     }
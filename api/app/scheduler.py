@@ -0,0 +1,422 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Callable, Optional, Protocol
+
+import numpy as np
+
+from app.config import settings
+from app.catalog import video_catalog
+from app.manifest import video_manifest
+from app.mask_store import get_mask_paths
+from app.metrics import metrics
+from app.model_manager import ModelManager
+from app.models import SegmentationJobInfo
+from app.video_processing import (
+    SegmentationCancelled,
+    coco_rle,
+    get_reusable_frames,
+    process_segmentation,
+)
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobConflictError(Exception):
+    def __init__(self, job: "SegmentationJob"):
+        super().__init__(f"Job {job.id} is already {job.status} for {job.video_name}")
+        self.job = job
+
+
+class JobEvents:
+    # Events of a job for the clients following it, numbered in order. Only
+    # the last max_events are kept, a client falling behind skips the events
+    # dropped in the meantime. Events are published from the worker threads
+    # and followed from the event loop.
+    #
+    # Live events, the masks, are only queued for the clients following the
+    # job when they are published and are never replayed, so that a finished
+    # job kept in the history does not hold on to its masks.
+    def __init__(self, max_events: int):
+        self._max_events = max(max_events, 1)
+        self._events: deque[tuple[int, str, dict]] = deque(maxlen=self._max_events)
+        self._next_id = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._followers: dict[
+            asyncio.Event,
+            tuple[asyncio.AbstractEventLoop, Optional[deque[tuple[int, str, dict]]]],
+        ] = {}
+
+    def publish(self, event: str, data: dict, close: bool = False, live: bool = False):
+        with self._lock:
+            if self._closed:
+                return
+            item = (self._next_id, event, data)
+            self._next_id += 1
+            if not live:
+                self._events.append(item)
+            followers = []
+            for waiter, (loop, live_events) in self._followers.items():
+                if live:
+                    if live_events is None:
+                        continue
+                    live_events.append(item)
+                followers.append((waiter, loop))
+            self._closed = close
+        for waiter, loop in followers:
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:
+                # The loop of the client is closed.
+                pass
+
+    def since(
+        self,
+        last_id: int,
+        live_events: Optional[deque[tuple[int, str, dict]]] = None,
+    ) -> tuple[list[tuple[int, str, dict]], bool]:
+        with self._lock:
+            events = [item for item in self._events if item[0] > last_id]
+            if live_events:
+                events = sorted(
+                    events + [item for item in live_events if item[0] > last_id],
+                    key=lambda item: item[0],
+                )
+                live_events.clear()
+            return events, self._closed
+
+    async def follow(
+        self, last_id: int = -1, live: bool = True
+    ) -> AsyncIterator[tuple[int, str, dict]]:
+        waiter = asyncio.Event()
+        live_events = deque(maxlen=self._max_events) if live else None
+        with self._lock:
+            self._followers[waiter] = (asyncio.get_running_loop(), live_events)
+        try:
+            while True:
+                waiter.clear()
+                events, closed = self.since(last_id, live_events)
+                for item in events:
+                    last_id = item[0]
+                    yield item
+                if closed:
+                    return
+                await waiter.wait()
+        finally:
+            with self._lock:
+                del self._followers[waiter]
+
+
+class SegmentationJob:
+    def __init__(
+        self,
+        video_name: str,
+        frame_number: int,
+        start_frame: int,
+        end_frame: int,
+        priority: int = 0,
+        use_all_annotations: bool = False,
+        model_name: Optional[str] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.video_name = video_name
+        self.frame_number = frame_number
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.priority = priority
+        self.use_all_annotations = use_all_annotations
+        self.model_name = model_name
+
+        self.status = "queued"
+        self.processed_frames = 0
+        self.total_frames = 0
+        self.error: Optional[str] = None
+        self.mask_paths: list[str] = []
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.events = JobEvents(settings.segmentation_job_events)
+        self._propagation_started_at: Optional[float] = None
+
+    def update_progress(
+        self,
+        processed_frames: int,
+        total_frames: int,
+        frame_number: Optional[int] = None,
+    ):
+        if self._propagation_started_at is None:
+            self._propagation_started_at = time.time()
+        self.processed_frames = processed_frames
+        self.total_frames = total_frames
+        self.events.publish(
+            "progress",
+            {
+                "processed_frames": processed_frames,
+                "total_frames": total_frames,
+                "frame_number": frame_number,
+                "eta_seconds": self.eta(),
+            },
+        )
+
+    def publish_mask(self, frame_number: int, object_id: int, rle: dict):
+        # COCO RLE, as served by the mask endpoint with format=rle. Clients
+        # joining later get the frames from the progress events instead.
+        self.events.publish(
+            "mask",
+            {"frame_number": frame_number, "object_id": object_id, "rle": rle},
+            live=True,
+        )
+
+    def add_mask(self, frame_number: int, object_id: int, mask: np.ndarray):
+        height, width = mask.shape[:2]
+        self.publish_mask(frame_number, object_id, coco_rle(mask, width, height))
+
+    def publish_status(self):
+        # The last event of a job is its final status.
+        self.events.publish(
+            "status",
+            self.info().model_dump(),
+            close=self.status not in ACTIVE_STATUSES,
+        )
+
+    def eta(self) -> Optional[float]:
+        # Loading the frames is not counted, the rate is measured from the
+        # first propagated frame.
+        if (
+            self.status != "running"
+            or self._propagation_started_at is None
+            or self.processed_frames == 0
+        ):
+            return None
+        elapsed = time.time() - self._propagation_started_at
+        remaining = max(self.total_frames - self.processed_frames, 0)
+        return elapsed / self.processed_frames * remaining
+
+    def info(self) -> SegmentationJobInfo:
+        if self.status == "completed":
+            progress = 1.0
+        elif self.total_frames > 0:
+            progress = self.processed_frames / self.total_frames
+        else:
+            progress = 0.0
+        return SegmentationJobInfo(
+            id=self.id,
+            video_name=self.video_name,
+            frame_number=self.frame_number,
+            start_frame=self.start_frame,
+            end_frame=self.end_frame,
+            priority=self.priority,
+            model_name=self.model_name,
+            status=self.status,
+            processed_frames=self.processed_frames,
+            total_frames=self.total_frames,
+            progress=progress,
+            eta_seconds=self.eta(),
+            error=self.error,
+            mask_paths=self.mask_paths,
+            created_at=self.created_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+        )
+
+
+def get_mask_path_names(video_name: str) -> list[str]:
+    entry = video_catalog.get(video_name)
+    return [str(path) for path in get_mask_paths(entry)] if entry else []
+
+
+def reuse_segmentation(job: SegmentationJob) -> Optional[list[str]]:
+    # The mask paths of a job whose masks are all stored already, it completes
+    # right away without leasing a predictor. None if it has to be run.
+    reused_frames = get_reusable_frames(
+        job.video_name,
+        job.frame_number,
+        job.start_frame,
+        job.end_frame,
+        use_all_annotations=job.use_all_annotations,
+        model_name=job.model_name,
+    )
+    if reused_frames is None:
+        return None
+    return get_mask_path_names(job.video_name)
+
+
+class SegmentationRunner(Protocol):
+    def run(self, job: SegmentationJob) -> list[str]: ...
+
+    def model_status(self) -> dict: ...
+
+
+class PredictorRunner:
+    # Runs jobs in the scheduler's worker thread with predictors of its own.
+    def __init__(self, models: ModelManager):
+        self.models = models
+        self.models.start()
+
+    def run(self, job: SegmentationJob) -> list[str]:
+        mask_paths = reuse_segmentation(job)
+        if mask_paths is not None:
+            return mask_paths
+
+        with self.models.lease(job.model_name) as predictor:
+            process_segmentation(
+                job.video_name,
+                job.frame_number,
+                job.start_frame,
+                job.end_frame,
+                predictor,
+                use_all_annotations=job.use_all_annotations,
+                on_progress=job.update_progress,
+                on_mask=job.add_mask if settings.segmentation_stream_masks else None,
+                cancel_event=job.cancel_event,
+                model_name=job.model_name,
+            )
+        return get_mask_path_names(job.video_name)
+
+    def model_status(self) -> dict:
+        return self.models.status()
+
+
+class SegmentationScheduler:
+    # Jobs wait in a bounded priority queue and are run by a fixed number of
+    # workers, each with a runner of its own so that a predictor is never used
+    # by two jobs at once. Only one job per video can be queued or running,
+    # since a job starts by clearing the masks of the video.
+    def __init__(
+        self,
+        runner_factory: Callable[[], SegmentationRunner],
+        workers: int,
+        max_queued: int,
+        max_history: int,
+    ):
+        self.runner_factory = runner_factory
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_history = max_history
+        self._queue: list[tuple[int, int, SegmentationJob]] = []
+        self._counter = itertools.count()
+        self._jobs: OrderedDict[str, SegmentationJob] = OrderedDict()
+        self._condition = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._runners: list[SegmentationRunner] = []
+
+    def start(self):
+        for worker in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"segmentation-{worker}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job: SegmentationJob) -> SegmentationJob:
+        with self._condition:
+            for other in self._jobs.values():
+                if other.video_name == job.video_name and other.status in (
+                    ACTIVE_STATUSES
+                ):
+                    raise JobConflictError(other)
+            if len(self._queue) >= self.max_queued:
+                raise QueueFullError("Segmentation queue is full")
+
+            heapq.heappush(self._queue, (-job.priority, next(self._counter), job))
+            self._jobs[job.id] = job
+            self._prune()
+            self._condition.notify()
+        job.publish_status()
+        return job
+
+    def get(self, job_id: str) -> Optional[SegmentationJob]:
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def jobs(
+        self, video_name: Optional[str] = None, status: Optional[str] = None
+    ) -> list[SegmentationJob]:
+        with self._condition:
+            return [
+                job
+                for job in self._jobs.values()
+                if (video_name is None or job.video_name == video_name)
+                and (status is None or job.status == status)
+            ]
+
+    def cancel(self, job_id: str) -> Optional[SegmentationJob]:
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status == "queued":
+                self._queue = [item for item in self._queue if item[2] is not job]
+                heapq.heapify(self._queue)
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                job.publish_status()
+            elif job.status == "running":
+                # The worker stops at the next propagated frame.
+                job.cancel_event.set()
+            return job
+
+    def _prune(self):
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.status not in ACTIVE_STATUSES
+        ]
+        for job_id in finished[: max(len(finished) - self.max_history, 0)]:
+            del self._jobs[job_id]
+
+    def _next_job(self) -> SegmentationJob:
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._queue) > 0)
+            _, _, job = heapq.heappop(self._queue)
+            job.status = "running"
+            job.started_at = time.time()
+        job.publish_status()
+        return job
+
+    def model_status(self) -> list[dict]:
+        # Runners are created by the workers as they start, a worker not
+        # started yet is not listed.
+        with self._condition:
+            return [runner.model_status() for runner in self._runners]
+
+    def _run(self):
+        runner = self.runner_factory()
+        with self._condition:
+            self._runners.append(runner)
+        while True:
+            job = self._next_job()
+            try:
+                job.mask_paths = runner.run(job)
+                status = "completed"
+            except SegmentationCancelled:
+                status = "cancelled"
+            except Exception as e:
+                print(f"Error while processing segmentation job {job.id}: {e}")
+                job.error = str(e)
+                status = "failed"
+
+            # A failed or cancelled job may have written some masks as well.
+            try:
+                video_manifest.update_masks(job.video_name)
+            except Exception as e:
+                print(f"Error while updating the manifest of {job.video_name}: {e}")
+
+            metrics.inc("monet_segmentation_jobs_total", status=status)
+            metrics.inc("monet_segmentation_frames_total", job.processed_frames)
+
+            with self._condition:
+                job.status = status
+                job.finished_at = time.time()
+                self._prune()
+            job.publish_status()
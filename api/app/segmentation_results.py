@@ -0,0 +1,82 @@
+import hashlib
+import os
+from typing import Optional
+
+from pydantic import BaseModel
+
+from app.catalog import VideoEntry
+from app.config import settings
+from app.mask_store import mask_store
+from app.models import Annotation
+
+
+class SegmentationResult(BaseModel):
+    # The job the stored masks of a video come from, they cover the frames
+    # [start_frame, end_frame).
+    fingerprint: str
+    start_frame: int
+    end_frame: int
+    # Size and mtime of each mask volume once the job was done, masks written
+    # since by another job make the result unusable.
+    volumes: dict[int, tuple[int, int]]
+
+
+def segmentation_fingerprint(
+    entry: VideoEntry, annotations: dict[int, Annotation], model_name: Optional[str]
+) -> str:
+    # What the masks depend on besides the range: the source file, the prompt
+    # annotations, the model and how the propagation is chunked.
+    parts = [
+        entry.name,
+        entry.mtime_ns,
+        entry.size,
+        entry.frame_count,
+        model_name or settings.sam2_model_name,
+        settings.segmentation_chunk_size,
+        settings.segmentation_chunk_overlap,
+    ]
+    parts += [
+        annotations[annotated_frame].model_dump_json(exclude={"videoName"})
+        for annotated_frame in sorted(annotations)
+    ]
+    return hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def get_volume_stats(entry: VideoEntry) -> dict[int, tuple[int, int]]:
+    stats = {}
+    for object_id in mask_store.object_ids(entry.stem):
+        try:
+            stat = mask_store.get_volume_path(entry.stem, object_id).stat()
+        except FileNotFoundError:
+            continue
+        stats[object_id] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+def read_segmentation_result(entry: VideoEntry) -> Optional[SegmentationResult]:
+    path = mask_store.get_result_path(entry.stem)
+    try:
+        with open(path, "r") as f:
+            result = SegmentationResult.model_validate_json(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"Ignoring invalid segmentation result {path}: {e}")
+        return None
+    if result.volumes != get_volume_stats(entry):
+        return None
+    return result
+
+
+def write_segmentation_result(entry: VideoEntry, fingerprint: str, frames: range):
+    result = SegmentationResult(
+        fingerprint=fingerprint,
+        start_frame=frames.start,
+        end_frame=frames.stop,
+        volumes=get_volume_stats(entry),
+    )
+    path = mask_store.get_result_path(entry.stem)
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "w") as f:
+        f.write(result.model_dump_json())
+    os.replace(temporary_path, path)
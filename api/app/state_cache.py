@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import torch
+
+from app.config import settings
+from app.metrics import record_cache_access
+
+
+def tensor_bytes(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(tensor_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(item) for item in value)
+    return 0
+
+
+def move_to(value: Any, device: torch.device) -> Any:
+    if isinstance(value, torch.Tensor):
+        return value.to(device, non_blocking=True)
+    if isinstance(value, dict):
+        return {key: move_to(item, device) for key, item in value.items()}
+    if isinstance(value, list):
+        return [move_to(item, device) for item in value]
+    if isinstance(value, tuple):
+        return tuple(move_to(item, device) for item in value)
+    return value
+
+
+class EmbeddingCache:
+    # SAM2 keeps the image features of the last frame only, under
+    # inference_state["cached_features"]. This keeps the features of every
+    # frame seen so far, up to max_bytes, optionally in CPU memory.
+    def __init__(self, max_bytes: int, device: torch.device, offload: bool):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.offload = offload
+        self._features: OrderedDict[int, tuple[Any, int]] = OrderedDict()
+        self.size = 0
+
+    def get(self, frame_idx: int, default: Any = None) -> Any:
+        cached = self._features.get(frame_idx)
+        record_cache_access("embedding", cached is not None)
+        if cached is None:
+            return default
+        self._features.move_to_end(frame_idx)
+        features = cached[0]
+        return move_to(features, self.device) if self.offload else features
+
+    def update(self, features: dict):
+        for frame_idx, value in features.items():
+            if self.offload:
+                value = move_to(value, torch.device("cpu"))
+            value_bytes = tensor_bytes(value)
+            if value_bytes > self.max_bytes:
+                continue
+            previous = self._features.pop(frame_idx, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._features[frame_idx] = (value, value_bytes)
+            self.size += value_bytes
+
+        while self.size > self.max_bytes:
+            _, (_, evicted_bytes) = self._features.popitem(last=False)
+            self.size -= evicted_bytes
+
+    def __contains__(self, frame_idx: int) -> bool:
+        return frame_idx in self._features
+
+    def __len__(self) -> int:
+        return len(self._features)
+
+
+class EmbeddingCachingState(dict):
+    def __init__(self, state: dict, max_bytes: int, offload: bool = False):
+        super().__init__(state)
+        self.embeddings = EmbeddingCache(max_bytes, state["device"], offload)
+        self.embeddings.update(state.get("cached_features", {}))
+        super().__setitem__("cached_features", self.embeddings)
+
+    def __setitem__(self, key: Any, value: Any):
+        if key == "cached_features" and value is not self.embeddings:
+            self.embeddings.update(value)
+            return
+        super().__setitem__(key, value)
+
+    def nbytes(self) -> int:
+        images = self.get("images")
+        images_bytes = getattr(images, "nbytes", None)
+        if images_bytes is None:
+            images_bytes = tensor_bytes(images)
+        return images_bytes + self.embeddings.size
+
+
+class InferenceStateCache:
+    # States are handed out exclusively, a state being used by a job is not in
+    # the cache until the job releases it.
+    def __init__(self, max_states: int, max_bytes: int):
+        self.max_states = max_states
+        self.max_bytes = max_bytes
+        self._states: OrderedDict[Hashable, tuple[Any, EmbeddingCachingState]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def acquire(
+        self, key: Hashable, sam2_predictor: Any
+    ) -> Optional[EmbeddingCachingState]:
+        with self._lock:
+            cached = self._states.pop(key, None)
+        if cached is None or cached[0] is not sam2_predictor:
+            return None
+        return cached[1]
+
+    def release(self, key: Hashable, sam2_predictor: Any, state: EmbeddingCachingState):
+        if self.max_states <= 0:
+            return
+        with self._lock:
+            self._states[key] = (sam2_predictor, state)
+            while len(self._states) > self.max_states or (
+                len(self._states) > 1 and self.size() > self.max_bytes
+            ):
+                self._states.popitem(last=False)
+
+    def size(self) -> int:
+        return sum(state.nbytes() for _, state in self._states.values())
+
+    def stats(self) -> tuple[int, int]:
+        # The number of cached states and their size.
+        with self._lock:
+            return len(self._states), self.size()
+
+    def invalidate_predictor(self, sam2_predictor: Any):
+        # States hold on to the predictor and its tensors, they go when the
+        # predictor is unloaded.
+        with self._lock:
+            for key in list(self._states):
+                if self._states[key][0] is sam2_predictor:
+                    del self._states[key]
+
+    def invalidate(self, video_file: Optional[str] = None):
+        with self._lock:
+            if video_file is None:
+                self._states.clear()
+                return
+            for key in list(self._states):
+                if key[0] == video_file:
+                    del self._states[key]
+
+
+inference_state_cache = InferenceStateCache(
+    settings.inference_state_cache_size, settings.inference_state_cache_max_bytes
+)
@@ -0,0 +1,144 @@
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+import cv2
+from app.config import settings
+from app.models import UploadSession
+
+
+def copy_file(source: BinaryIO, target_path: Path, chunk_size: int):
+    # Written next to the target and renamed once complete, so that a partial
+    # file is never picked up as a video or a frame.
+    temporary_path = target_path.with_name(f".{target_path.name}.part")
+    with open(temporary_path, "wb") as f:
+        shutil.copyfileobj(source, f, chunk_size)
+    os.replace(temporary_path, target_path)
+
+
+def convert_to_jpeg(source_path: str, target_path: str) -> bool:
+    # The source is removed only once the JPEG is in place, on failure it is
+    # left for the caller to clean up with the rest of the batch.
+    image = cv2.imread(source_path, cv2.IMREAD_COLOR)
+    if image is None:
+        return False
+
+    # Encoded explicitly, the target may be a staged name without an extension.
+    success, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not success:
+        return False
+
+    temporary_path = Path(target_path).with_name(f".{Path(target_path).name}")
+    try:
+        with open(temporary_path, "wb") as f:
+            f.write(data.tobytes())
+        os.replace(temporary_path, target_path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+    os.remove(source_path)
+    return True
+
+
+def get_staged_path(path: Path) -> Path:
+    # The images of an upload are written under hidden names and renamed once
+    # the whole batch is stored, so that a failed batch leaves the frames of
+    # the sequence as they were.
+    return path.with_name(f".{path.name}.upload")
+
+
+def commit_uploaded_images(paths: list[Path]):
+    for path in paths:
+        os.replace(get_staged_path(path), path)
+
+
+def remove_uploaded_images(image_dir: Path, paths: list[Path], created: bool):
+    # Undoes a failed image upload, the directory is removed as well when the
+    # upload created it.
+    for path in paths:
+        path.unlink(missing_ok=True)
+    if created:
+        try:
+            image_dir.rmdir()
+        except OSError:
+            pass
+
+
+# Image conversion is CPU bound, it runs in worker processes so that large
+# batches convert in parallel without holding the event loop.
+image_conversion_pool = ProcessPoolExecutor(
+    max_workers=settings.image_conversion_workers or None,
+    mp_context=multiprocessing.get_context("spawn"),
+)
+
+
+def get_session_path(session_id: str) -> Path:
+    return settings.upload_directory / f"{session_id}.json"
+
+
+def get_session_part_path(session_id: str) -> Path:
+    return settings.upload_directory / f"{session_id}.part"
+
+
+def create_upload_session(video_name: str, size: Optional[int]) -> UploadSession:
+    session = UploadSession(id=uuid.uuid4().hex, video_name=video_name, size=size)
+    get_session_part_path(session.id).touch()
+    with open(get_session_path(session.id), "w") as f:
+        f.write(session.model_dump_json(exclude={"offset"}))
+    return session
+
+
+def get_upload_session(session_id: str) -> Optional[UploadSession]:
+    # Sessions are stored on disk, an upload can resume after a restart from
+    # the size of the part already received.
+    if not session_id.isalnum():
+        return None
+    session_path = get_session_path(session_id)
+    part_path = get_session_part_path(session_id)
+    if not session_path.exists() or not part_path.exists():
+        return None
+
+    with open(session_path, "r") as f:
+        session = UploadSession.model_validate_json(f.read())
+    session.offset = part_path.stat().st_size
+    return session
+
+
+def complete_upload_session(session: UploadSession) -> Path:
+    video_location = settings.video_dir / session.video_name
+    temporary_path = video_location.with_name(f".{video_location.name}.part")
+    shutil.move(get_session_part_path(session.id), temporary_path)
+    os.replace(temporary_path, video_location)
+    get_session_path(session.id).unlink(missing_ok=True)
+    return video_location
+
+
+def delete_upload_session(session: UploadSession):
+    get_session_part_path(session.id).unlink(missing_ok=True)
+    get_session_path(session.id).unlink(missing_ok=True)
+
+
+def expire_upload_sessions(max_age: float) -> list[str]:
+    # Sessions nothing was appended to for max_age seconds are abandoned, their
+    # files are removed. Returns the ids of the expired sessions.
+    expired = []
+    oldest = time.time() - max_age
+    for session_path in settings.upload_directory.glob("*.json"):
+        session_id = session_path.stem
+        part_path = get_session_part_path(session_id)
+        try:
+            last_write = max(
+                session_path.stat().st_mtime,
+                part_path.stat().st_mtime if part_path.exists() else 0,
+            )
+        except FileNotFoundError:
+            continue
+        if last_write < oldest:
+            part_path.unlink(missing_ok=True)
+            session_path.unlink(missing_ok=True)
+            expired.append(session_id)
+    return expired
@@ -1,22 +1,52 @@
 import base64
-import json
-import shutil
+import hashlib
+import threading
+import time
+from contextlib import ExitStack, closing
 from pathlib import Path
-from typing import Any, DefaultDict
+from typing import Any, Callable, Optional
 
 import cv2
 import numpy as np
+from app.annotation_store import annotation_store
+from app.catalog import VideoEntry, video_catalog
 from app.config import settings
-from app.models import Annotation, Point
+from app.frame_cache import (
+    PooledVideoReader,
+    frame_cache,
+    frame_key,
+    video_reader_pool,
+)
+from app.frame_sources import (
+    ArrayFrameSource,
+    get_frame_range,
+    init_state,
+    open_frame_range,
+)
+from app.mask_store import (
+    MaskWriter,
+    clear_masks,
+    encode_rle,
+    get_mask_frame_numbers,
+    get_mask_version,
+    read_masks,
+)
+from app.metrics import metrics, record_cache_access, record_span, span
+from app.models import Annotation, ObjectAnnotation, Point
+from app.proxies import find_proxy
+from app.segmentation_results import (
+    read_segmentation_result,
+    segmentation_fingerprint,
+    write_segmentation_result,
+)
+from app.state_cache import EmbeddingCachingState, inference_state_cache
 from sam2.sam2_video_predictor import SAM2VideoPredictor
-from video_utils.image import ImageFromVideo
 
 
 def get_size_video(path) -> tuple:
-    if path.is_dir():
-        images = list(path.glob("*.jpg"))
-        height, width = cv2.imread(str(images[0])).shape[:2]
-        return width, height
+    entry = video_catalog.get(path.name)
+    if entry is not None:
+        return entry.width, entry.height
 
     cap = cv2.VideoCapture(str(path))
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -25,71 +55,6 @@ def get_size_video(path) -> tuple:
     return width, height
 
 
-def extract_frames(
-    video_path: Path, output_dir: Path, start_frame: int, end_frame: int
-):
-    video_capture = cv2.VideoCapture(str(video_path))
-    video_capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-    width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    frame_number = start_frame
-    while True:
-        success, frame = video_capture.read()
-        if not success:
-            raise ValueError("Failed to read frame")
-        if end_frame > 0 and frame_number > end_frame:
-            break
-        cv2.imwrite(str(output_dir / f"{frame_number}.jpg"), frame)
-        frame_number += 1
-    video_capture.release()
-
-    return frame_number - start_frame, width, height
-
-
-def clear_directory(directory: Path):
-    if directory.exists() and directory.is_dir():
-        for file in directory.iterdir():
-            file.unlink()
-        directory.rmdir()
-
-    directory.mkdir(parents=True, exist_ok=True)
-
-
-def retrieve_video_files():
-    videos = settings.video_dir.glob("*.mp4")
-    videos = [video.name for video in videos]
-
-    images_videos = settings.images_dir.glob("*")
-    images_videos = [image.name for image in images_videos]
-    return videos, images_videos
-
-
-def get_videos_sizes(videos: list[str], images_videos: list[str]):
-    videos_sizes = []
-    for video in videos:
-        video_path = settings.video_dir / video
-        video_size = video_path.stat().st_size
-        videos_sizes.append(video_size)
-
-    invalid_images_videos = []
-    for image_video in images_videos:
-        if image_video not in videos:
-            images = list(settings.images_dir.glob(f"{image_video}/*.jpg"))
-            images = [image.name for image in images]
-            if len(images) > 0:
-                video_size = sum(
-                    [
-                        (settings.images_dir / image_video / image).stat().st_size
-                        for image in images
-                    ]
-                )
-                videos_sizes.append(video_size)
-            else:
-                invalid_images_videos.append(image_video)
-                videos_sizes.append(0)
-    return videos_sizes, invalid_images_videos
-
-
 def calculate_resized_size(current_height, current_width, max_height, max_width):
     if current_height > max_height or current_width > max_width:
         if current_height > current_width:
@@ -113,70 +78,226 @@ def read_frame_from_image(image_path: Path):
 
 
 def read_frame_from_video(video_path: Path, frame_number: int):
-    imageFromVideo = ImageFromVideo(path=video_path, image_index=frame_number)
-    frame = imageFromVideo.read_image()
+    frame = video_reader_pool.read(
+        video_path, frame_number, settings.video_reader_backfill_frames
+    )
+
+    return frame
+
+
+def load_frame(
+    source_path: Path,
+    frame_number: int,
+    is_video: bool,
+    size: Optional[tuple[int, int]] = None,
+    reader: Optional[PooledVideoReader] = None,
+):
+    key = frame_key(source_path, source_path.stat().st_mtime_ns, frame_number, size)
+    frame = frame_cache.get(key)
+    record_cache_access("frame", frame is not None)
+    if frame is not None:
+        return frame
+
+    if size is not None:
+        frame = load_frame(source_path, frame_number, is_video, reader=reader)
+        if frame is None:
+            return None
+        with span("resize"):
+            frame = cv2.resize(frame, size)
+    else:
+        with span("decode"):
+            if is_video and reader is not None:
+                frame = reader.read(frame_number)
+            elif is_video:
+                frame = read_frame_from_video(source_path, frame_number)
+            else:
+                frame = read_frame_from_image(source_path)
 
+    if frame is not None:
+        frame_cache.put(key, frame)
     return frame
 
 
-def get_frame_name(images_dir: Path, frame_number: int):
-    frames = list(images_dir.glob("*.jpg"))
-    frames = sorted([frame.name for frame in frames])
-    frame_name = frames[frame_number]
+def get_frame_name(entry: VideoEntry, frame_number: int):
+    return entry.frame_name(frame_number)
 
-    return frame_name
 
+def get_frame_size(
+    entry: VideoEntry, max_height: Optional[int], max_width: Optional[int]
+) -> Optional[tuple[int, int]]:
+    if max_height is None or max_width is None:
+        return None
+    return calculate_resized_size(entry.height, entry.width, max_height, max_width)
 
-def read_frame(video_file: str, frame_number: int):
-    videos, images_videos = retrieve_video_files()
-    if video_file in images_videos:
-        video_name = Path(video_file)
-        video_path = settings.images_dir / video_file
-        frame_name = get_frame_name(video_path, frame_number)
-        frame = read_frame_from_image(video_path / frame_name)
-    elif video_file in videos:
-        video_name = Path(video_file.replace(".mp4", ""))
-        video_path = settings.video_dir / video_file
-        frame_name = f"{frame_number}.jpg"
-        frame = read_frame_from_video(video_path, frame_number)
-    else:
+
+def get_frame_source(entry: VideoEntry, size: Optional[tuple[int, int]]) -> Path:
+    # Serve from the smallest proxy rendition that is at least as large as the
+    # requested size, the original is only decoded when none is.
+    if size is not None:
+        proxy_path = find_proxy(entry, *size)
+        if proxy_path is not None:
+            return proxy_path
+    return entry.path
+
+
+def load_entry_frame(
+    entry: VideoEntry,
+    frame_number: int,
+    max_height: Optional[int] = None,
+    max_width: Optional[int] = None,
+):
+    frame_name = get_frame_name(entry, frame_number)
+    if frame_name is None:
+        return None
+
+    if entry.width == 0 or entry.height == 0:
+        frame_path = entry.frame_path(frame_number)
+        frame = load_frame(frame_path, frame_number, entry.is_video)
+        if frame is None or max_height is None or max_width is None:
+            return frame
+        current_height, current_width = frame.shape[:2]
+        size = calculate_resized_size(
+            current_height, current_width, max_height, max_width
+        )
+        return load_frame(frame_path, frame_number, entry.is_video, size)
+
+    size = get_frame_size(entry, max_height, max_width)
+    source_path = get_frame_source(entry, size)
+    if not entry.is_video:
+        source_path = source_path / frame_name
+    return load_frame(source_path, frame_number, entry.is_video, size)
+
+
+def read_frame(
+    video_file: str,
+    frame_number: int,
+    max_height: Optional[int] = None,
+    max_width: Optional[int] = None,
+):
+    entry = video_catalog.get(video_file)
+    if entry is None:
         return None, None, None
 
+    video_name = Path(entry.stem)
+    frame_name = get_frame_name(entry, frame_number)
+    if frame_name is None:
+        return None, video_name, None
+
+    frame = load_entry_frame(entry, frame_number, max_height, max_width)
+
     return frame, video_name, frame_name
 
 
+def read_frames(
+    entry: VideoEntry,
+    start_frame: int,
+    count: int,
+    max_height: Optional[int] = None,
+    max_width: Optional[int] = None,
+):
+    end_frame = start_frame + count
+    if not entry.is_video or entry.width == 0 or entry.height == 0:
+        for frame_number in range(start_frame, end_frame):
+            frame = load_entry_frame(entry, frame_number, max_height, max_width)
+            if frame is None:
+                return
+            yield frame_number, entry.frame_name(frame_number), frame
+        return
+
+    size = get_frame_size(entry, max_height, max_width)
+    source_path = get_frame_source(entry, size)
+    # A single reader is held for the whole range so uncached frames are
+    # decoded in one sequential pass.
+    with video_reader_pool.lease(source_path, start_frame) as reader:
+        for frame_number in range(start_frame, end_frame):
+            frame = load_frame(source_path, frame_number, True, size, reader)
+            if frame is None:
+                return
+            yield frame_number, entry.frame_name(frame_number), frame
+
+
 def get_annotation(video_name: Path | str, frame_number: int):
-    annotation_file = (
-        settings.annotation_directory / video_name / f"{frame_number}.json"
+    return annotation_store.get(str(video_name), frame_number)
+
+
+def get_annotation_objects(annotation: Annotation) -> dict[int, ObjectAnnotation]:
+    objects = {}
+    if annotation.positivePoints or annotation.negativePoints:
+        objects[0] = ObjectAnnotation(
+            objectId=0,
+            box=annotation.box,
+            positivePoints=annotation.positivePoints,
+            negativePoints=annotation.negativePoints,
+        )
+    for annotation_object in annotation.objects:
+        if annotation_object.positivePoints or annotation_object.negativePoints:
+            objects[annotation_object.objectId] = annotation_object
+    return objects
+
+
+def resize_mask(mask: np.ndarray, width: int, height: int) -> np.ndarray:
+    if mask.shape[:2] == (height, width):
+        return mask
+    mask = cv2.resize(
+        mask.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST
     )
-    if not annotation_file.exists():
-        return None
+    return mask > 0
 
-    with open(annotation_file, "r") as f:
-        annotation = json.load(f)
-        annotation = Annotation.model_validate(annotation)
 
-    return annotation
+OBJECT_COLORS = [
+    (255, 0, 0),
+    (0, 255, 0),
+    (0, 0, 255),
+    (255, 255, 0),
+    (255, 0, 255),
+    (0, 255, 255),
+    (255, 128, 0),
+    (128, 0, 255),
+]
+
+
+def get_object_color(object_id: int) -> tuple[int, int, int]:
+    return OBJECT_COLORS[object_id % len(OBJECT_COLORS)]
+
+
+def blend_mask(
+    frame: np.ndarray,
+    mask: np.ndarray,
+    weight: float = 0.3,
+    color: tuple[int, int, int] = (255, 0, 0),
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    # Only the masked pixels are blended, the rest of the frame is copied as is.
+    # Given out, a copy of the frame, the mask is blended into it in place, so
+    # that the objects of a frame share one buffer.
+    if out is None:
+        out = frame.copy()
+    offset = np.array(color, dtype=np.float32) * (1 - weight) + 0.5
+    out[mask] = (out[mask] * weight + offset).astype(np.uint8)
+    return out
 
 
 def apply_image_mask(
-    mask_path: Path,
+    masks: dict[int, np.ndarray],
     frame: np.ndarray,
     width: int,
     height: int,
-    save_name: Path,
+    save_name: Optional[Path] = None,
     weight: float = 0.3,
     save: bool = False,
 ):
-    if mask_path.exists():
-        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
-        _, mask = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
-        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
-        overlay = frame.copy()
-        overlay[mask > 0] = (255, 0, 0)
-        segmented_image = cv2.addWeighted(overlay, 1 - weight, frame, weight, 0)
-
-        if save:
+    if masks:
+        segmented_image = frame.copy()
+        for object_id, mask in sorted(masks.items()):
+            blend_mask(
+                frame,
+                resize_mask(mask, width, height),
+                weight,
+                get_object_color(object_id),
+                out=segmented_image,
+            )
+
+        if save and save_name is not None:
             (settings.segmented_images_directory / save_name.parent).mkdir(
                 exist_ok=True, parents=True
             )
@@ -190,31 +311,193 @@ def apply_image_mask(
     return segmented_image
 
 
-def encode_image(image: np.ndarray):
-    success, encoded_image = cv2.imencode(".webp", image)
+def render_overlay(
+    entry: VideoEntry,
+    frame_number: int,
+    frame: np.ndarray,
+    weight: float = 0.3,
+) -> Optional[np.ndarray]:
+    mask_version = get_mask_version(entry, frame_number)
+    if mask_version is None:
+        return None
+
+    height, width = frame.shape[:2]
+    key = (
+        "overlay",
+        entry.stem,
+        mask_version,
+        entry.path,
+        entry.mtime_ns,
+        frame_number,
+        (width, height),
+        weight,
+    )
+    segmented_image = frame_cache.get(key)
+    record_cache_access("overlay", segmented_image is not None)
+    if segmented_image is not None:
+        return segmented_image
+
+    with span("overlay"):
+        segmented_image = apply_image_mask(
+            read_masks(entry, frame_number), frame, width, height, weight=weight
+        )
+    if segmented_image is not None:
+        frame_cache.put(key, segmented_image)
+    return segmented_image
+
+
+def mask_polygons(
+    mask: np.ndarray, width: int, height: int, tolerance: float
+) -> list[list[float]]:
+    # Outlines and holes of the mask as flat [x0, y0, x1, y1, ...] lists in
+    # the coordinates of a width x height frame, to be filled with the evenodd
+    # rule. Contours are found at the mask resolution and simplified by up to
+    # tolerance pixels of the requested size.
+    mask_height, mask_width = mask.shape[:2]
+    scale = np.array([width / mask_width, height / mask_height], dtype=np.float32)
+    contours, _ = cv2.findContours(
+        mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+    )
+    polygons = []
+    for contour in contours:
+        if tolerance > 0:
+            contour = cv2.approxPolyDP(
+                contour, tolerance / float(scale.min()), closed=True
+            )
+        if len(contour) < 3:
+            continue
+        points = np.round(contour.reshape(-1, 2) * scale, 1)
+        polygons.append(points.ravel().tolist())
+    return polygons
+
+
+def coco_counts(runs: np.ndarray) -> str:
+    # The compressed counts string of pycocotools: each run, minus the run
+    # two before it from the fourth on, in 5 bit groups with a continuation
+    # bit, offset into printable characters.
+    characters = []
+    runs = runs.astype(np.int64)
+    for i, value in enumerate(runs.tolist()):
+        if i > 2:
+            value -= int(runs[i - 2])
+        more = True
+        while more:
+            group = value & 0x1F
+            value >>= 5
+            more = value != -1 if group & 0x10 else value != 0
+            if more:
+                group |= 0x20
+            characters.append(chr(group + 48))
+    return "".join(characters)
+
+
+def coco_rle(mask: np.ndarray, width: int, height: int) -> dict:
+    # COCO run-length encoding of the mask resized to width x height, as
+    # returned by pycocotools.mask.encode: column-major runs starting with a
+    # background run.
+    mask = resize_mask(mask, width, height)
+    return {"size": [height, width], "counts": coco_counts(encode_rle(mask.T))}
+
+
+def render_mask_payload(
+    entry: VideoEntry,
+    frame_number: int,
+    width: int,
+    height: int,
+    mask_format: str,
+    weight: float = 0.3,
+) -> Optional[dict]:
+    # The masks of a frame for the client to draw its own overlay, in the
+    # colors and opacity of render_overlay.
+    masks = read_masks(entry, frame_number)
+    if not masks:
+        return None
+
+    objects = []
+    with span("mask_encode"):
+        for object_id, mask in sorted(masks.items()):
+            blue, green, red = get_object_color(object_id)
+            payload = {"object_id": object_id, "color": [red, green, blue]}
+            if mask_format == "polygons":
+                payload["polygons"] = mask_polygons(
+                    mask, width, height, settings.mask_polygon_tolerance
+                )
+            else:
+                payload["rle"] = coco_rle(mask, width, height)
+            objects.append(payload)
+    return {
+        "format": mask_format,
+        "width": width,
+        "height": height,
+        "opacity": 1 - weight,
+        "objects": objects,
+    }
+
+
+def export_segmented_images(video_file: str, start_frame: int = 0, end_frame: int = -1):
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        print(f"Video {video_file} not found")
+        return
+
+    output_directory = settings.segmented_images_directory / entry.stem
+    output_directory.mkdir(exist_ok=True, parents=True)
+
+    frame_numbers = [
+        frame_number
+        for frame_number in get_mask_frame_numbers(entry)
+        if frame_number >= start_frame and (end_frame < 0 or frame_number <= end_frame)
+    ]
+
+    # Frames are read directly rather than through the frame cache, exporting
+    # full resolution frames would otherwise evict the frames being viewed.
+    with ExitStack() as stack:
+        reader = None
+        if entry.is_video:
+            reader = stack.enter_context(video_reader_pool.lease(entry.path))
+        for frame_number in frame_numbers:
+            frame_name = entry.frame_name(frame_number)
+            if reader is not None:
+                frame = reader.read(frame_number)
+            else:
+                frame = read_frame_from_image(entry.path / frame_name)
+            if frame is None:
+                continue
+
+            height, width = frame.shape[:2]
+            apply_image_mask(
+                read_masks(entry, frame_number),
+                frame,
+                width,
+                height,
+                save_name=Path(entry.stem) / frame_name,
+                save=True,
+            )
+
+
+def encode_image_bytes(image: np.ndarray, extension: str = ".webp") -> bytes:
+    with span("encode"):
+        success, encoded_image = cv2.imencode(extension, image)
     if not success:
         raise Exception("Error encoding image")
 
-    return base64.b64encode(encoded_image).decode("utf-8")
+    return encoded_image.tobytes()
 
 
-def copy_images_to_input(video_name: str, start_frame: int = 0, end_frame: int = 0):
-    images_dir = settings.images_dir / video_name
-    input_dir = settings.input_dir / video_name
-    clear_directory(input_dir)
+def encode_image(image: np.ndarray):
+    return base64.b64encode(encode_image_bytes(image)).decode("utf-8")
 
-    images = sorted(list(images_dir.glob("*.jpg")))
-    names = [image.name for image in images]
 
-    if end_frame == -1:
-        end_frame = len(images)
-    for image in images[start_frame:end_frame]:
-        image_name = image.name
-        image_path = input_dir / image_name
+def frame_etag(*parts) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
 
-        shutil.copyfile(image, image_path)
 
-    return names
+def get_mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
 
 
 def add_points_to_state(
@@ -225,6 +508,7 @@ def add_points_to_state(
     width: int,
     height: int,
     frame_idx: int,
+    obj_id: int = 0,
 ):
     points = np.array(
         [
@@ -240,7 +524,7 @@ def add_points_to_state(
     frame_idx, object_ids, masks = sam2_predictor.add_new_points_or_box(
         inference_state=state,
         frame_idx=frame_idx,
-        obj_id=0,
+        obj_id=obj_id,
         points=points,
         labels=labels,
     )
@@ -248,106 +532,459 @@ def add_points_to_state(
     return frame_idx, object_ids, masks
 
 
-def process_segmentation(
-    video_file: str,
-    frame_number: int,
-    start_frame: int,
-    end_frame: int,
+def propagate_direction(
     sam2_predictor: SAM2VideoPredictor,
-    task_queue: DefaultDict[Any, list],
-    use_all_annotations: bool = False,
+    state: Any,
+    reverse: bool,
+    start_frame_idx: Optional[int] = None,
 ):
-    videos, images_videos = retrieve_video_files()
-    is_video = False
-    if video_file in videos:
-        video_path = settings.video_dir / video_file
-        video_name = video_file.replace(".mp4", "")
-        is_video = True
-    elif video_file in images_videos:
-        video_name = video_file
-        video_path = settings.images_dir / video_name
-    else:
-        print(f"Video {video_file} not found")
-        task_queue.pop((video_file, frame_number))
-        return
+    # The time of a step is the time the predictor takes to produce the masks
+    # of the next frame, not the time spent by the caller between steps.
+    propagation = sam2_predictor.propagate_in_video(
+        state, start_frame_idx=start_frame_idx, reverse=reverse
+    )
+    while True:
+        started = time.perf_counter()
+        step = next(propagation, None)
+        if step is None:
+            return
+        frame_idx, object_ids, masks = step
+        masks = [(masks[i] > 0.0).cpu().numpy()[0] for i in range(len(object_ids))]
+        record_span("propagate", time.perf_counter() - started)
+        for out_obj_id, mask in zip(object_ids, masks):
+            yield frame_idx, out_obj_id, mask
+
 
-    mask_output_directory = settings.mask_directory / video_name
-    clear_directory(mask_output_directory)
+def propagate_masks(sam2_predictor: SAM2VideoPredictor, state: Any, reverse: bool):
+    passes = [False, True] if reverse else [False]
+    for reverse_pass in passes:
+        yield from propagate_direction(sam2_predictor, state, reverse_pass)
 
-    image_output_dir = settings.input_dir / video_name
-    clear_directory(image_output_dir)
 
-    if is_video:
-        n_frames, width, height = extract_frames(
-            video_path, image_output_dir, start_frame, end_frame
+def get_inference_state(
+    sam2_predictor: SAM2VideoPredictor,
+    entry: VideoEntry,
+    key: tuple,
+    frames: range,
+) -> EmbeddingCachingState:
+    # A cached state already holds the decoded frames and image features of the
+    # range, only the prompts and tracking results need to be reset.
+    state = inference_state_cache.acquire(key, sam2_predictor)
+    record_cache_access("inference_state", state is not None)
+    if state is not None:
+        sam2_predictor.reset_state(state)
+        return state
+
+    frame_source = open_frame_range(entry, frames)
+    with span("init_state"):
+        state = init_state(
+            sam2_predictor,
+            frame_source,
+            offload_video_to_cpu=settings.sam2_offload_video_to_cpu,
+            offload_state_to_cpu=settings.sam2_offload_state_to_cpu,
         )
-        images_names = [f"{i}.jpg" for i in range(n_frames)]
-    else:
-        width, height = get_size_video(video_path)
-        images_names = copy_images_to_input(video_name, start_frame, end_frame)
+    return EmbeddingCachingState(
+        state, settings.embedding_cache_max_bytes, settings.embedding_cache_offload
+    )
+
+
+def add_annotations_to_state(
+    sam2_predictor: SAM2VideoPredictor,
+    state: Any,
+    annotations: dict[int, Annotation],
+    first_frame: int,
+):
+    width, height = state["video_width"], state["video_height"]
+    for annotated_frame, annotation in annotations.items():
+        for object_id, annotation_object in get_annotation_objects(annotation).items():
+            add_points_to_state(
+                sam2_predictor=sam2_predictor,
+                state=state,
+                positive_points=annotation_object.positivePoints,
+                negative_points=annotation_object.negativePoints,
+                width=width,
+                height=height,
+                frame_idx=annotated_frame - first_frame,
+                obj_id=object_id,
+            )
 
+
+def propagate_in_state(
+    sam2_predictor: SAM2VideoPredictor,
+    entry: VideoEntry,
+    annotations: dict[int, Annotation],
+    frames: range,
+    reverse: bool,
+):
+    # Every object is prompted into the same state, so the features of each
+    # frame are computed once however many objects are tracked.
+    key = (entry.name, entry.mtime_ns, frames.start, frames.stop)
+    state = get_inference_state(sam2_predictor, entry, key, frames)
     try:
-        state = sam2_predictor.init_state(str(image_output_dir))
-    except Exception as e:
-        print(f"Error while initializing state: {e}")
-        task_queue.pop((video_file, frame_number))
-        return
+        add_annotations_to_state(sam2_predictor, state, annotations, frames.start)
+        for frame_idx, object_id, mask in propagate_masks(
+            sam2_predictor, state, reverse=reverse
+        ):
+            yield frames.start + frame_idx, object_id, mask
+    finally:
+        inference_state_cache.release(key, sam2_predictor, state)
 
-    if not use_all_annotations:
-        annotation = get_annotation(video_name, frame_number)
-        if annotation is None:
-            task_queue.pop((video_file, frame_number))
-            return
-        add_points_to_state(
-            sam2_predictor=sam2_predictor,
-            state=state,
-            positive_points=annotation.positivePoints,
-            negative_points=annotation.negativePoints,
-            width=width,
-            height=height,
-            frame_idx=frame_number - start_frame,
+
+def propagate_in_chunks(
+    sam2_predictor: SAM2VideoPredictor,
+    entry: VideoEntry,
+    annotations: dict[int, Annotation],
+    frames: range,
+    reverse: bool,
+    chunk_size: int,
+    overlap: int,
+):
+    # Each chunk gets its own inference state, offloaded to the CPU, so memory
+    # is bounded by the chunk size rather than the length of the range. The
+    # masks of the last overlap frames of a chunk are given as mask prompts to
+    # the next one, which carries the objects across the boundary.
+    first_prompt = min(annotations)
+    # An object prompted after the first chunk only joins the forward pass at
+    # the chunk of its prompt. Like in a single state it is tracked back from
+    # there, each object by a reverse pass seeded with the masks of the first
+    # overlap frames it got.
+    appeared: dict[int, int] = {}
+    seeds: dict[int, dict[int, dict[int, np.ndarray]]] = {}
+    for frame_number, object_id, mask in propagate_pass(
+        sam2_predictor,
+        entry,
+        annotations,
+        frames,
+        False,
+        first_prompt,
+        {},
+        chunk_size,
+        overlap,
+    ):
+        start = appeared.setdefault(object_id, frame_number)
+        if frame_number < start + overlap:
+            seeds.setdefault(start, {}).setdefault(frame_number, {})[object_id] = mask
+        yield frame_number, object_id, mask
+
+    reverse_frames = range(frames.start if reverse else first_prompt, frames.stop)
+    for start in sorted(seeds):
+        yield from propagate_pass(
+            sam2_predictor,
+            entry,
+            {},
+            reverse_frames,
+            True,
+            start - 1,
+            seeds[start],
+            chunk_size,
+            overlap,
         )
-    else:
-        one_annotation = False
-        for frame_idx in range(start_frame, end_frame):
-            annotation = get_annotation(video_name, frame_idx)
-            if annotation is not None:
-                one_annotation = True
-                add_points_to_state(
-                    sam2_predictor=sam2_predictor,
-                    state=state,
-                    positive_points=annotation.positivePoints,
-                    negative_points=annotation.negativePoints,
-                    width=width,
-                    height=height,
-                    frame_idx=frame_idx - start_frame,
+
+
+def propagate_pass(
+    sam2_predictor: SAM2VideoPredictor,
+    entry: VideoEntry,
+    annotations: dict[int, Annotation],
+    frames: range,
+    reverse_pass: bool,
+    boundary: int,
+    seeds: dict[int, dict[int, np.ndarray]],
+    chunk_size: int,
+    overlap: int,
+):
+    # boundary is the next frame without a mask in the direction of the pass,
+    # seeds the masks of the frames just before it.
+    while frames.start <= boundary < frames.stop:
+        if reverse_pass:
+            chunk_stop = boundary + len(seeds) + 1
+            chunk = range(max(chunk_stop - chunk_size, frames.start), chunk_stop)
+            new_frames = range(chunk.start, boundary + 1)
+            tail = range(chunk.start, chunk.start + overlap)
+            start_frame_idx = len(chunk) - 1
+        else:
+            chunk_start = boundary - len(seeds)
+            chunk = range(chunk_start, min(chunk_start + chunk_size, frames.stop))
+            new_frames = range(boundary, chunk.stop)
+            tail = range(chunk.stop - overlap, chunk.stop)
+            start_frame_idx = 0
+
+        state = init_state(
+            sam2_predictor,
+            open_frame_range(entry, chunk),
+            offload_video_to_cpu=True,
+            offload_state_to_cpu=True,
+        )
+        for seed_frame, seed_masks in seeds.items():
+            for object_id, mask in seed_masks.items():
+                sam2_predictor.add_new_mask(
+                    inference_state=state,
+                    frame_idx=seed_frame - chunk.start,
+                    obj_id=object_id,
+                    mask=mask,
                 )
-        if not one_annotation:
-            task_queue.pop((video_file, frame_number))
-            return
+        add_annotations_to_state(
+            sam2_predictor,
+            state,
+            {
+                annotated_frame: annotation
+                for annotated_frame, annotation in annotations.items()
+                if annotated_frame in new_frames
+            },
+            chunk.start,
+        )
+
+        seeds = {}
+        for frame_idx, object_id, mask in propagate_direction(
+            sam2_predictor, state, reverse_pass, start_frame_idx
+        ):
+            frame_number = chunk.start + frame_idx
+            if frame_number in tail:
+                seeds.setdefault(frame_number, {})[object_id] = mask
+            if frame_number in new_frames:
+                yield frame_number, object_id, mask
 
-    video_segments = {}
-    for frame_idx, object_ids, masks in sam2_predictor.propagate_in_video(state):
-        video_segments[frame_idx] = {
-            out_obj_id: (masks[i] > 0.0).cpu().permute(1, 2, 0).numpy()
-            for i, out_obj_id in enumerate(object_ids)
+        sam2_predictor.reset_state(state)
+        del state
+        boundary = chunk.start - 1 if reverse_pass else chunk.stop
+
+
+def propagate_missing(
+    sam2_predictor: SAM2VideoPredictor,
+    entry: VideoEntry,
+    covered: range,
+    target: range,
+    chunk_size: int,
+    overlap: int,
+):
+    # The frames of target on either side of covered, whose masks are stored.
+    # Each side is propagated like the next chunk of propagate_in_chunks, from
+    # the stored masks of the overlap frames at the edge of covered.
+    frames = range(min(covered.start, target.start), max(covered.stop, target.stop))
+    if target.stop > covered.stop:
+        seeds = {
+            frame_number: read_masks(entry, frame_number)
+            for frame_number in range(
+                max(covered.stop - overlap, covered.start), covered.stop
+            )
+        }
+        yield from propagate_pass(
+            sam2_predictor,
+            entry,
+            {},
+            frames,
+            False,
+            covered.stop,
+            seeds,
+            chunk_size,
+            overlap,
+        )
+    if target.start < covered.start:
+        seeds = {
+            frame_number: read_masks(entry, frame_number)
+            for frame_number in range(
+                covered.start, min(covered.start + overlap, covered.stop)
+            )
         }
+        yield from propagate_pass(
+            sam2_predictor,
+            entry,
+            {},
+            frames,
+            True,
+            covered.start - 1,
+            seeds,
+            chunk_size,
+            overlap,
+        )
+
+
+def warm_up_predictor(sam2_predictor: SAM2VideoPredictor, frame_count: int = 2):
+    # Runs a prompt and a short propagation on synthetic frames, so that the
+    # first job does not pay for the lazy initialization of the model.
+    frames = [
+        np.full((256, 256, 3), 32 * frame_number, dtype=np.uint8)
+        for frame_number in range(frame_count)
+    ]
+    for frame in frames:
+        cv2.circle(frame, (128, 128), 48, (255, 255, 255), -1)
+
+    state = init_state(sam2_predictor, ArrayFrameSource(frames))
+    add_points_to_state(
+        sam2_predictor, state, [Point(x=0.5, y=0.5)], [], 256, 256, frame_idx=0
+    )
+    for _ in propagate_direction(sam2_predictor, state, reverse=False):
+        pass
+    sam2_predictor.reset_state(state)
+
+
+class SegmentationCancelled(Exception):
+    pass
 
+
+def get_prompt_annotations(
+    entry: VideoEntry,
+    frame_number: int,
+    start_frame: int,
+    end_frame: int,
+    use_all_annotations: bool,
+) -> dict[int, Annotation]:
+    if not use_all_annotations:
+        frame_numbers = range(frame_number, frame_number + 1)
+    else:
+        frame_numbers = get_frame_range(entry, start_frame, end_frame)
+
+    # Only the annotated frames of the range are read from the store.
+    return {
+        annotated_frame: annotation
+        for annotated_frame, annotation in annotation_store.get_range(
+            entry.stem, frame_numbers.start, frame_numbers.stop
+        ).items()
+        if get_annotation_objects(annotation)
+    }
+
+
+def get_segmentation_target(
+    entry: VideoEntry,
+    annotations: dict[int, Annotation],
+    frame_number: int,
+    start_frame: int,
+    end_frame: int,
+) -> range:
+    # SAM2 propagates forward from the first prompted frame to the end of the
+    # range, then backward from that frame to the start of the range.
+    frames = get_frame_range(entry, start_frame, end_frame)
     if start_frame < frame_number:
-        for frame_idx, object_ids, masks in sam2_predictor.propagate_in_video(
-            state, reverse=True
-        ):
-            video_segments[frame_idx] = {
-                out_obj_id: (masks[i] > 0.0).cpu().permute(1, 2, 0).numpy()
-                for i, out_obj_id in enumerate(object_ids)
-            }
-
-    for frame_idx, masks in video_segments.items():
-        for obj_id, mask in masks.items():
-            frame_n = start_frame + frame_idx
-            mask_path = mask_output_directory / images_names[frame_n]
-            mask = mask.astype(np.uint8) * 255
-            mask_path.parent.mkdir(parents=True, exist_ok=True)
-            cv2.imwrite(str(mask_path), mask)
-
-    task_queue.pop((video_file, frame_number))
+        return range(frames.start, frames.stop)
+    return range(min(annotations), frames.stop)
+
+
+def get_reusable_frames(
+    video_file: str,
+    frame_number: int,
+    start_frame: int,
+    end_frame: int,
+    use_all_annotations: bool = False,
+    model_name: Optional[str] = None,
+) -> Optional[int]:
+    # The number of frames of a job whose masks are all stored by a job with
+    # the same fingerprint, None if it has frames to compute. Checked before a
+    # predictor is leased, such a job does not wait for a model to load.
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        return None
+    previous = read_segmentation_result(entry)
+    if previous is None:
+        return None
+    annotations = get_prompt_annotations(
+        entry, frame_number, start_frame, end_frame, use_all_annotations
+    )
+    if not annotations:
+        return None
+    if previous.fingerprint != segmentation_fingerprint(entry, annotations, model_name):
+        return None
+    target = get_segmentation_target(
+        entry, annotations, frame_number, start_frame, end_frame
+    )
+    if target.start < previous.start_frame or target.stop > previous.end_frame:
+        return None
+    metrics.inc("monet_segmentation_reused_frames_total", len(target))
+    return len(target)
+
+
+def process_segmentation(
+    video_file: str,
+    frame_number: int,
+    start_frame: int,
+    end_frame: int,
+    sam2_predictor: SAM2VideoPredictor,
+    use_all_annotations: bool = False,
+    on_progress: Optional[Callable[[int, int, Optional[int]], None]] = None,
+    on_mask: Optional[Callable[[int, int, np.ndarray], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    model_name: Optional[str] = None,
+) -> int:
+    entry = video_catalog.get(video_file)
+    if entry is None:
+        raise ValueError(f"Video {video_file} not found")
+
+    with span("annotations"):
+        annotations = get_prompt_annotations(
+            entry, frame_number, start_frame, end_frame, use_all_annotations
+        )
+    if not annotations:
+        raise ValueError(f"No annotation found for {video_file}")
+
+    frames = get_frame_range(entry, start_frame, end_frame)
+    reverse = start_frame < frame_number
+    target = get_segmentation_target(
+        entry, annotations, frame_number, start_frame, end_frame
+    )
+
+    # When the stored masks come from a job with the same fingerprint only the
+    # frames of the range they do not cover are computed, both ranges hold the
+    # first prompted frame so they are contiguous.
+    fingerprint = segmentation_fingerprint(entry, annotations, model_name)
+    previous = read_segmentation_result(entry)
+    chunk_size = settings.segmentation_chunk_size
+    if previous is not None and previous.fingerprint == fingerprint:
+        covered = range(previous.start_frame, previous.end_frame)
+        result = range(min(covered.start, target.start), max(covered.stop, target.stop))
+        total_frames = len(result) - len(covered)
+        metrics.inc(
+            "monet_segmentation_reused_frames_total",
+            len(
+                range(max(covered.start, target.start), min(covered.stop, target.stop))
+            ),
+        )
+        chunk_size = chunk_size if chunk_size > 0 else len(result)
+        overlap = min(max(settings.segmentation_chunk_overlap, 1), chunk_size - 1)
+        masks = propagate_missing(
+            sam2_predictor, entry, covered, target, chunk_size, overlap
+        )
+    else:
+        with span("clear_masks"):
+            clear_masks(entry)
+        result = target
+        total_frames = len(target)
+        if 0 < chunk_size < len(frames):
+            overlap = min(max(settings.segmentation_chunk_overlap, 1), chunk_size - 1)
+            masks = propagate_in_chunks(
+                sam2_predictor, entry, annotations, frames, reverse, chunk_size, overlap
+            )
+        else:
+            masks = propagate_in_state(
+                sam2_predictor, entry, annotations, frames, reverse
+            )
+
+    # Frames are counted once, the reverse passes revisit the frames where
+    # the objects were first seen.
+    processed_frames: set[int] = set()
+    last_frame_number = None
+    if on_progress is not None:
+        on_progress(0, total_frames, None)
+    with (
+        closing(masks),
+        MaskWriter(
+            entry, settings.mask_writer_workers, settings.mask_writer_max_pending
+        ) as mask_writer,
+    ):
+        for mask_frame_number, object_id, mask in masks:
+            if cancel_event is not None and cancel_event.is_set():
+                raise SegmentationCancelled()
+            with span("mask_submit"):
+                mask_writer.submit(mask_frame_number, mask, object_id)
+            # Masks are pushed to the clients following the job as soon as
+            # they are computed, before they are written.
+            if on_mask is not None:
+                on_mask(mask_frame_number, object_id, mask)
+            if mask_frame_number != last_frame_number:
+                if last_frame_number is not None and on_progress is not None:
+                    on_progress(len(processed_frames), total_frames, last_frame_number)
+                last_frame_number = mask_frame_number
+                processed_frames.add(mask_frame_number)
+        # The masks of the last frame are all computed once propagation ends.
+        if last_frame_number is not None and on_progress is not None:
+            on_progress(len(processed_frames), total_frames, last_frame_number)
+
+    write_segmentation_result(entry, fingerprint, result)
+    return len(processed_frames)
@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+from benchmarks.synthetic import write_image_sequence, write_video
+
+# Run from the api directory:
+#   python -m benchmarks.bench --output bench.json
+#   python -m benchmarks.bench --output new.json --compare bench.json
+
+VIDEO_NAME = "synthetic.mp4"
+IMAGES_NAME = "synthetic_images"
+
+
+def configure_environment(workdir: Path):
+    # The settings are read when app.config is imported, the app modules are
+    # only imported once the data directories point to the work directory.
+    directories = {
+        "IMAGE_DIRECTORY": "images",
+        "IMAGES_DIR": "images",
+        "MASK_DIRECTORY": "masks",
+        "SEGMENTED_IMAGES_DIRECTORY": "segmented_images",
+        "ANNOTATION_DIRECTORY": "annotations",
+        "VIDEO_DIR": "videos",
+        "PROXY_DIRECTORY": "proxies",
+        "UPLOAD_DIRECTORY": "uploads",
+    }
+    for variable, directory in directories.items():
+        os.environ[variable] = str(workdir / directory)
+    os.environ["MANIFEST_PATH"] = str(workdir / "manifest.json")
+
+
+def latency_stats(durations: list[float]) -> dict:
+    milliseconds = np.array(durations) * 1000
+    return {
+        "count": len(durations),
+        "cold_ms": float(milliseconds[0]),
+        "mean_ms": float(milliseconds.mean()),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "max_ms": float(milliseconds.max()),
+    }
+
+
+def measure(requests: int, request: Callable[[int], None]) -> dict:
+    durations = []
+    for i in range(requests):
+        started = time.perf_counter()
+        request(i)
+        durations.append(time.perf_counter() - started)
+    return latency_stats(durations)
+
+
+def check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.url}: {response.status_code}")
+
+
+def bench_latencies(args: argparse.Namespace) -> dict:
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    client = TestClient(app)
+    rng = np.random.default_rng(0)
+    results = {}
+
+    results["get_videos"] = measure(
+        args.requests, lambda _: check(client.get("/videos"))
+    )
+
+    for name, frame_count in ((VIDEO_NAME, args.frames), (IMAGES_NAME, args.frames)):
+        frame_numbers = rng.integers(0, frame_count, args.requests)
+        results[f"get_frame[{name}]"] = measure(
+            args.requests,
+            lambda i: check(client.get(f"/videos/{name}/frame/{frame_numbers[i]}")),
+        )
+        results[f"get_frame_sequential[{name}]"] = measure(
+            min(args.requests, frame_count),
+            lambda i: check(client.get(f"/videos/{name}/frame/{i}")),
+        )
+
+    frame_numbers = rng.integers(0, args.frames, args.requests)
+    results["save_annotation"] = measure(
+        args.requests,
+        lambda i: check(
+            client.post(
+                f"/videos/{VIDEO_NAME}/annotations/{frame_numbers[i]}",
+                params={"object_id": i % 3},
+                json={"positivePoints": [{"x": 0.5, "y": 0.5}]},
+            )
+        ),
+    )
+    return results
+
+
+class StageTimer:
+    # Wraps the functions process_segmentation calls, so that a run can be
+    # broken down into stages without changing the code being measured.
+    def __init__(self):
+        self.timings: dict[str, float] = defaultdict(float)
+
+    def wrap(self, stage: str, function: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.timings[stage] += time.perf_counter() - started
+
+        return timed
+
+
+def bench_segmentation(args: argparse.Namespace) -> dict:
+    import app.video_processing as video_processing
+    from app.annotation_store import annotation_store
+    from app.catalog import video_catalog
+    from app.mask_store import clear_masks
+    from app.models import Annotation, Point
+    from benchmarks.stub_predictor import StubPredictor
+
+    predictor = StubPredictor(args.stub_image_size, args.stub_work)
+    timer = StageTimer()
+    for stage, name in (
+        ("annotations", "get_prompt_annotations"),
+        ("clear_masks", "clear_masks"),
+        ("init_state", "init_state"),
+    ):
+        setattr(
+            video_processing, name, timer.wrap(stage, getattr(video_processing, name))
+        )
+
+    class TimedMaskWriter(video_processing.MaskWriter):
+        def submit(self, *args, **kwargs):
+            return timer.wrap("mask_submit", super().submit)(*args, **kwargs)
+
+        def __exit__(self, *exc_info):
+            return timer.wrap("mask_flush", super().__exit__)(*exc_info)
+
+    video_processing.MaskWriter = TimedMaskWriter
+
+    results = {}
+    for name in (VIDEO_NAME, IMAGES_NAME):
+        frame_number = args.frames // 2
+        annotation_store.put(
+            Path(name).stem,
+            frame_number,
+            Annotation(
+                videoName=name,
+                frameNumber=frame_number,
+                positivePoints=[Point(x=0.5, y=0.5)],
+            ),
+        )
+
+        runs = []
+        for _ in range(args.segmentation_runs):
+            timer.timings.clear()
+            predictor.timings.clear()
+            # Otherwise the masks of the previous run would be reused instead
+            # of propagating the range again.
+            clear_masks(video_catalog.get(name))
+            started = time.perf_counter()
+            processed_frames = video_processing.process_segmentation(
+                name, frame_number, 0, -1, predictor
+            )
+            elapsed = time.perf_counter() - started
+
+            stages = {**timer.timings, **predictor.timings}
+            # Whatever is not in a stage: the propagation loop, mask
+            # thresholding and progress reporting.
+            stages["other"] = elapsed - sum(stages.values())
+            runs.append(
+                {
+                    "seconds": elapsed,
+                    "frames": processed_frames,
+                    "frames_per_second": processed_frames / elapsed,
+                    "stages_seconds": stages,
+                }
+            )
+        results[name] = {
+            # The first run loads the frames and computes the features, the
+            # next ones reuse the cached inference state.
+            "cold": runs[0],
+            "warm": runs[1:],
+        }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict):
+    def change(new: float, old: float) -> str:
+        if old == 0:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"Compared with {baseline.get('git_commit')}")
+    for name, stats in results["latency"].items():
+        old = baseline.get("latency", {}).get(name)
+        if old is None:
+            continue
+        print(
+            f"  {name}: p50 {stats['p50_ms']:.2f} ms "
+            f"({change(stats['p50_ms'], old['p50_ms'])}), "
+            f"p99 {stats['p99_ms']:.2f} ms ({change(stats['p99_ms'], old['p99_ms'])})"
+        )
+    for name, runs in results["segmentation"].items():
+        old = baseline.get("segmentation", {}).get(name)
+        if old is None:
+            continue
+        for run in ("cold", "warm"):
+            new_runs = runs[run] if run == "warm" else [runs[run]]
+            old_runs = old[run] if run == "warm" else [old[run]]
+            if not new_runs or not old_runs:
+                continue
+            new_fps = np.mean([r["frames_per_second"] for r in new_runs])
+            old_fps = np.mean([r["frames_per_second"] for r in old_runs])
+            print(
+                f"  segmentation {run} [{name}]: {new_fps:.1f} frames/s "
+                f"({change(new_fps, old_fps)})"
+            )
+
+
+def print_results(results: dict):
+    for name, stats in results["latency"].items():
+        print(
+            f"{name}: p50 {stats['p50_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms, "
+            f"cold {stats['cold_ms']:.2f} ms"
+        )
+    for name, runs in results["segmentation"].items():
+        for run in [runs["cold"], *runs["warm"]]:
+            stages = ", ".join(
+                f"{stage} {seconds:.2f}s"
+                for stage, seconds in sorted(
+                    run["stages_seconds"].items(), key=lambda item: -item[1]
+                )
+            )
+            print(
+                f"segmentation [{name}]: {run['frames']} frames in "
+                f"{run['seconds']:.2f}s ({run['frames_per_second']:.1f} frames/s): "
+                f"{stages}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Monet backend")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--segmentation-runs", type=int, default=3)
+    parser.add_argument("--stub-image-size", type=int, default=256)
+    parser.add_argument("--stub-work", type=int, default=4)
+    parser.add_argument("--workdir", type=Path, default=None)
+    parser.add_argument("--output", type=Path, default=Path("bench.json"))
+    parser.add_argument("--compare", type=Path, default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="monet-bench-"))
+    configure_environment(workdir)
+    print(f"Writing synthetic data to {workdir}")
+    write_video(workdir / "videos" / VIDEO_NAME, args.frames, args.width, args.height)
+    write_image_sequence(
+        workdir / "images" / IMAGES_NAME, args.frames, args.width, args.height
+    )
+
+    results = {
+        "git_commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+        },
+        "latency": bench_latencies(args),
+        "segmentation": bench_segmentation(args),
+    }
+
+    print_results(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
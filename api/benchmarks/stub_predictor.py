@@ -0,0 +1,176 @@
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+import cv2
+import numpy as np
+import sam2.sam2_video_predictor as sam2_video_predictor
+import torch
+
+
+class StubPredictor:
+    # Deterministic CPU stand-in for SAM2VideoPredictor. It loads frames the
+    # same way, caches one feature map per frame under "cached_features" like
+    # SAM2 does, and returns logits at the video resolution, but the masks are
+    # discs following the prompts and the model cost is a fixed amount of
+    # matrix products per frame.
+    def __init__(self, image_size: int = 256, work: int = 4):
+        self.image_size = image_size
+        self.work = work
+        self.device = torch.device("cpu")
+        self.timings: dict[str, float] = defaultdict(float)
+        self._weights = np.random.default_rng(0).standard_normal(
+            (256, 256), dtype=np.float32
+        )
+
+    def init_state(
+        self,
+        video_path: str,
+        offload_video_to_cpu: bool = False,
+        offload_state_to_cpu: bool = False,
+        async_loading_frames: bool = False,
+    ) -> dict:
+        images, video_height, video_width = sam2_video_predictor.load_video_frames(
+            video_path=video_path,
+            image_size=self.image_size,
+            offload_video_to_cpu=offload_video_to_cpu,
+            async_loading_frames=async_loading_frames,
+            compute_device=self.device,
+        )
+        return {
+            "images": images,
+            "num_frames": len(images),
+            "video_height": video_height,
+            "video_width": video_width,
+            "device": self.device,
+            "cached_features": {},
+            "prompts": {},
+        }
+
+    def reset_state(self, inference_state: dict):
+        inference_state["prompts"].clear()
+
+    def _add_prompt(
+        self, inference_state: dict, frame_idx: int, obj_id: int, center: np.ndarray
+    ) -> tuple[int, list[int], Any]:
+        inference_state["prompts"].setdefault(obj_id, {})[frame_idx] = center
+        obj_ids = sorted(inference_state["prompts"])
+        return frame_idx, obj_ids, self._logits(inference_state, frame_idx, obj_ids)
+
+    def add_new_points_or_box(
+        self,
+        inference_state: dict,
+        frame_idx: int,
+        obj_id: int,
+        points: Optional[np.ndarray] = None,
+        labels: Optional[np.ndarray] = None,
+        **kwargs,
+    ) -> tuple[int, list[int], Any]:
+        positive = points[labels == 1] if points is not None else np.zeros((0, 2))
+        if len(positive) == 0:
+            center = np.array(
+                [
+                    inference_state["video_width"] / 2,
+                    inference_state["video_height"] / 2,
+                ]
+            )
+        else:
+            center = positive.mean(axis=0)
+        return self._add_prompt(inference_state, frame_idx, obj_id, center)
+
+    def add_new_mask(
+        self, inference_state: dict, frame_idx: int, obj_id: int, mask: np.ndarray
+    ) -> tuple[int, list[int], Any]:
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            center = np.array([mask.shape[1] / 2, mask.shape[0] / 2])
+        else:
+            center = np.array([xs.mean(), ys.mean()])
+        return self._add_prompt(inference_state, frame_idx, obj_id, center)
+
+    def _features(self, inference_state: dict, frame_idx: int) -> np.ndarray:
+        cached = inference_state["cached_features"].get(frame_idx)
+        if cached is not None:
+            return cached[1].cpu().numpy()
+
+        started = time.perf_counter()
+        image = inference_state["images"][frame_idx]
+        loaded = time.perf_counter()
+        self.timings["frame_loading"] += loaded - started
+
+        pixels = image.cpu().numpy()
+        stride = max(self.image_size // 16, 1)
+        size = self.image_size // stride * stride
+        features = (
+            pixels[:, :size, :size]
+            .reshape(3, size // stride, stride, size // stride, stride)
+            .mean(axis=(2, 4))
+        )
+        activations = self._weights
+        for _ in range(self.work):
+            activations = np.tanh(activations @ self._weights)
+        features = features + activations[: features.shape[1], : features.shape[2]]
+        self.timings["model"] += time.perf_counter() - loaded
+
+        inference_state["cached_features"] = {
+            frame_idx: (image, torch.from_numpy(features.astype(np.float32)))
+        }
+        return features
+
+    def _logits(
+        self, inference_state: dict, frame_idx: int, obj_ids: list[int]
+    ) -> torch.Tensor:
+        features = self._features(inference_state, frame_idx)
+
+        started = time.perf_counter()
+        width = inference_state["video_width"]
+        height = inference_state["video_height"]
+        # Low resolution logits upsampled to the video resolution, as SAM2
+        # does with its 256x256 mask decoder output.
+        low_resolution = self.image_size // 4
+        ys, xs = np.mgrid[0:low_resolution, 0:low_resolution].astype(np.float32)
+        radius = low_resolution / 8
+        logits = []
+        for obj_id in obj_ids:
+            prompts = inference_state["prompts"][obj_id]
+            prompt_frame = min(prompts, key=lambda frame: abs(frame - frame_idx))
+            center = prompts[prompt_frame] / [width, height] * low_resolution
+            drift = (frame_idx - prompt_frame) * 0.1 + float(features.mean()) * 0.01
+            distance = np.hypot(xs - center[0] - drift, ys - center[1])
+            object_logits = cv2.resize(
+                (radius - distance).astype(np.float32),
+                (width, height),
+                interpolation=cv2.INTER_LINEAR,
+            )
+            logits.append(object_logits[None])
+        self.timings["mask_decoding"] += time.perf_counter() - started
+        return torch.from_numpy(np.stack(logits))
+
+    def propagate_in_video(
+        self,
+        inference_state: dict,
+        start_frame_idx: Optional[int] = None,
+        max_frame_num_to_track: Optional[int] = None,
+        reverse: bool = False,
+    ):
+        prompts = inference_state["prompts"]
+        if not prompts:
+            raise RuntimeError("No prompts provided")
+        if start_frame_idx is None:
+            start_frame_idx = min(min(frames) for frames in prompts.values())
+        num_frames = inference_state["num_frames"]
+        if max_frame_num_to_track is None:
+            max_frame_num_to_track = num_frames
+
+        if reverse:
+            end_frame_idx = max(start_frame_idx - max_frame_num_to_track, 0)
+            frames = range(start_frame_idx, end_frame_idx - 1, -1)
+        else:
+            end_frame_idx = min(
+                start_frame_idx + max_frame_num_to_track, num_frames - 1
+            )
+            frames = range(start_frame_idx, end_frame_idx + 1)
+
+        obj_ids = sorted(prompts)
+        for frame_idx in frames:
+            yield frame_idx, obj_ids, self._logits(inference_state, frame_idx, obj_ids)
@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def synthetic_frame(
+    frame_number: int, width: int, height: int, rng: np.random.Generator
+) -> np.ndarray:
+    # A gradient background with a moving disc and some noise, so that frames
+    # differ from each other and compress like real footage rather than a
+    # solid color.
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    frame = np.empty((height, width, 3), dtype=np.float32)
+    frame[:, :, 0] = x[None, :]
+    frame[:, :, 1] = y[:, None]
+    frame[:, :, 2] = (frame_number * 3) % 256
+    frame += rng.normal(0, 8, size=(height, width, 1))
+
+    radius = max(min(width, height) // 8, 1)
+    center = (
+        int(width / 2 + width / 3 * np.sin(frame_number / 20)),
+        int(height / 2 + height / 3 * np.cos(frame_number / 25)),
+    )
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    cv2.circle(frame, center, radius, (40, 200, 80), -1)
+    return frame
+
+
+def write_video(
+    path: Path, frame_count: int, width: int, height: int, fps: float = 25.0
+):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height)
+    )
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not open a video writer for {path}")
+    rng = np.random.default_rng(0)
+    try:
+        for frame_number in range(frame_count):
+            writer.write(synthetic_frame(frame_number, width, height, rng))
+    finally:
+        writer.release()
+
+
+def write_image_sequence(directory: Path, frame_count: int, width: int, height: int):
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for frame_number in range(frame_count):
+        cv2.imwrite(
+            str(directory / f"{frame_number:05d}.jpg"),
+            synthetic_frame(frame_number, width, height, rng),
+            [cv2.IMWRITE_JPEG_QUALITY, 90],
+        )
@@ -0,0 +1,19 @@
+import os
+import tempfile
+from pathlib import Path
+
+# The settings create their directories when app.config is imported, the tests
+# get them in a temporary directory instead of ./data.
+data_directory = Path(tempfile.mkdtemp(prefix="monet-tests-"))
+for name in [
+    "IMAGE_DIRECTORY",
+    "MASK_DIRECTORY",
+    "SEGMENTED_IMAGES_DIRECTORY",
+    "ANNOTATION_DIRECTORY",
+    "VIDEO_DIR",
+    "IMAGES_DIR",
+    "PROXY_DIRECTORY",
+    "UPLOAD_DIRECTORY",
+]:
+    os.environ.setdefault(name, str(data_directory / name.lower()))
+os.environ.setdefault("MANIFEST_PATH", str(data_directory / "manifest.json"))
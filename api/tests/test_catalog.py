@@ -0,0 +1,22 @@
+from pathlib import Path
+
+from app.catalog import VideoEntry
+
+
+def test_video_frames_outside_the_video_are_not_found():
+    entry = VideoEntry(
+        name="clip.mp4",
+        stem="clip",
+        path=Path("clip.mp4"),
+        is_video=True,
+        mtime_ns=0,
+        frame_count=3,
+        width=40,
+        height=30,
+        size=0,
+    )
+    assert entry.frame_name(2) == "2.jpg"
+    assert entry.frame_path(2) == Path("clip.mp4")
+    for frame_number in [-1, 3]:
+        assert entry.frame_name(frame_number) is None
+        assert entry.frame_path(frame_number) is None
@@ -0,0 +1,94 @@
+import struct
+
+import pytest
+
+from app.keyframes import KeyframeIndex, read_keyframes
+
+# A GOP of ten frames with B-frames, in presentation order I B B P B B I B B P.
+# The samples are stored in decoding order, each reference frame before the
+# B-frames shown ahead of it.
+PRESENTATION_ORDER = [0, 3, 1, 2, 6, 4, 5, 9, 7, 8]
+SYNC_SAMPLES = [1, 5]
+DELTA = 512
+
+
+def box(box_type: bytes, *children: bytes) -> bytes:
+    payload = b"".join(children)
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, payload: bytes) -> bytes:
+    return box(box_type, struct.pack(">B3x", version), payload)
+
+
+def entries(fields: str, rows: list[tuple]) -> bytes:
+    return struct.pack(">I", len(rows)) + b"".join(
+        struct.pack(">" + fields, *row) for row in rows
+    )
+
+
+def track(handler: bytes, sample_count: int, *tables: bytes) -> bytes:
+    hdlr = full_box(b"hdlr", 0, b"\0" * 4 + handler + b"\0" * 12 + b"\0")
+    stsz = full_box(b"stsz", 0, struct.pack(">II", 0, sample_count))
+    stbl = box(b"stbl", stsz, *tables)
+    return box(b"trak", box(b"mdia", hdlr, box(b"minf", stbl)))
+
+
+def write_mp4(path, ctts_version: int = 0, moov_last: bool = False, stss=True):
+    stts = full_box(b"stts", 0, entries("II", [(len(PRESENTATION_ORDER), DELTA)]))
+    # Composition offsets shift each sample from its decoding time to its
+    # presentation time, version 1 allows negative offsets.
+    shift = 0 if ctts_version == 1 else 1
+    ctts = full_box(
+        b"ctts",
+        ctts_version,
+        entries(
+            "Ii" if ctts_version == 1 else "II",
+            [
+                (1, (frame - sample + shift) * DELTA)
+                for sample, frame in enumerate(PRESENTATION_ORDER)
+            ],
+        ),
+    )
+    tables = [stts, ctts]
+    if stss:
+        tables.append(full_box(b"stss", 0, entries("I", [(s,) for s in SYNC_SAMPLES])))
+    moov = box(
+        b"moov",
+        track(b"soun", 40),
+        track(b"vide", len(PRESENTATION_ORDER), *tables),
+    )
+    ftyp = box(b"ftyp", b"isom", struct.pack(">I", 512), b"isomiso2mp41")
+    mdat = box(b"mdat", b"\0" * 64)
+    with open(path, "wb") as f:
+        f.write(ftyp + (mdat + moov if moov_last else moov + mdat))
+
+
+@pytest.mark.parametrize("ctts_version", [0, 1])
+@pytest.mark.parametrize("moov_last", [False, True])
+def test_keyframes_in_presentation_order(tmp_path, ctts_version, moov_last):
+    path = tmp_path / "bframes.mp4"
+    write_mp4(path, ctts_version, moov_last)
+    # The second sync sample is decoded fifth but shown seventh.
+    assert read_keyframes(path) == [0, 6]
+
+
+def test_every_frame_is_a_keyframe_without_sync_sample_table(tmp_path):
+    path = tmp_path / "intra.mp4"
+    write_mp4(path, stss=False)
+    assert read_keyframes(path) == list(range(len(PRESENTATION_ORDER)))
+
+
+def test_file_without_moov_has_no_keyframes(tmp_path):
+    path = tmp_path / "fragment.mp4"
+    path.write_bytes(box(b"ftyp", b"isom") + box(b"mdat", b"\0" * 16))
+    assert read_keyframes(path) is None
+
+
+def test_keyframe_before(tmp_path):
+    path = tmp_path / "bframes.mp4"
+    write_mp4(path)
+    index = KeyframeIndex()
+    for frame_number, keyframe in [(0, 0), (5, 0), (6, 6), (9, 6)]:
+        assert index.keyframe_before(path, frame_number) == keyframe
+    assert index.keyframe_before(tmp_path / "missing.mp4", 3) is None
@@ -0,0 +1,31 @@
+import os
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.manifest import video_manifest
+from app.mask_store import mask_store
+
+
+def test_modified_sequence_counts_its_masks_again():
+    directory = settings.images_dir / "counted"
+    directory.mkdir(parents=True)
+    for frame_number in range(3):
+        cv2.imwrite(str(directory / f"{frame_number}.jpg"), np.zeros((30, 40, 3)))
+    os.utime(directory, ns=(1, 1_000_000_000))
+
+    _, images = video_manifest.entries()
+    assert [(m.name, m.mask_frame_count) for m in images] == [("counted", 0)]
+
+    mask_store.volume("counted").write(1, np.ones((30, 40), dtype=bool))
+    # Listed again without changes: the stored count is kept.
+    _, images = video_manifest.entries()
+    assert images[0].mask_frame_count == 0
+
+    cv2.imwrite(str(directory / "3.jpg"), np.zeros((30, 40, 3)))
+    os.utime(directory, ns=(2, 2_000_000_000))
+    _, images = video_manifest.entries()
+    assert images[0].frame_count == 4
+    assert images[0].mask_frame_count == 1
+    assert images[0].masks_updated_ns is not None
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from app.mask_store import encode_rle
+from app.video_processing import coco_counts, coco_rle, resize_mask
+
+
+def decode_counts(counts: str) -> list[int]:
+    # rleFrString of pycocotools.
+    runs = []
+    position = 0
+    while position < len(counts):
+        value = 0
+        shift = 0
+        more = True
+        while more:
+            group = ord(counts[position]) - 48
+            value |= (group & 0x1F) << shift
+            more = bool(group & 0x20)
+            position += 1
+            shift += 5
+            if not more and group & 0x10:
+                value |= -1 << shift
+        if len(runs) > 2:
+            value += runs[-2]
+        runs.append(value)
+    return runs
+
+
+def decode_coco_rle(rle: dict) -> np.ndarray:
+    height, width = rle["size"]
+    runs = decode_counts(rle["counts"])
+    values = np.arange(len(runs)) % 2 == 1
+    # Column-major, as the masks of pycocotools.
+    return np.repeat(values, runs).reshape(width, height).T
+
+
+def test_coco_counts_known_value():
+    # pycocotools.mask.encode of [[0, 1], [1, 1]] gives the runs 1, 3.
+    mask = np.array([[False, True], [True, True]])
+    assert coco_rle(mask, 2, 2) == {"size": [2, 2], "counts": "13"}
+
+
+@pytest.mark.parametrize(
+    "runs",
+    [
+        [0, 5, 3],
+        [7, 1, 1, 1, 100, 2, 2000, 1, 50],
+        [3000, 1, 5, 40000, 1],
+    ],
+)
+def test_coco_counts_round_trip(runs):
+    # Long runs and runs shorter than the one two before them take several
+    # groups and negative differences.
+    assert decode_counts(coco_counts(np.array(runs, dtype="<u4"))) == runs
+
+
+@pytest.mark.parametrize(
+    "mask",
+    [
+        np.random.default_rng(0).random((30, 40)) > 0.6,
+        np.zeros((30, 40), dtype=bool),
+        np.ones((30, 40), dtype=bool),
+        np.pad(np.ones((10, 12), dtype=bool), ((5, 15), (20, 8))),
+    ],
+)
+def test_coco_rle_decodes_to_the_mask(mask):
+    rle = coco_rle(mask, 40, 30)
+    assert rle["size"] == [30, 40]
+    assert np.array_equal(decode_coco_rle(rle), mask)
+    assert sum(decode_counts(rle["counts"])) == mask.size
+    assert len(decode_counts(rle["counts"])) == len(encode_rle(mask.T))
+
+
+def test_coco_rle_of_resized_mask():
+    mask = np.zeros((30, 40), dtype=bool)
+    mask[3:17, 10:31] = True
+    rle = coco_rle(mask, 80, 60)
+    assert rle["size"] == [60, 80]
+    assert np.array_equal(decode_coco_rle(rle), resize_mask(mask, 80, 60))
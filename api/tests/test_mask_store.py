@@ -0,0 +1,162 @@
+import cv2
+import numpy as np
+import pytest
+
+from app.catalog import VideoEntry
+from app.config import settings
+from app.mask_store import (
+    HEADER,
+    RECORD,
+    MaskVolume,
+    MaskWriter,
+    decode_rle,
+    encode_rle,
+    mask_store,
+    migrate_masks,
+    read_mask,
+)
+
+
+def make_mask(seed: int, width: int = 40, height: int = 30) -> np.ndarray:
+    return np.random.default_rng(seed).random((height, width)) > 0.7
+
+
+def test_rle_round_trip():
+    for mask in [
+        make_mask(0),
+        np.zeros((30, 40), dtype=bool),
+        np.ones((30, 40), dtype=bool),
+    ]:
+        runs = encode_rle(mask)
+        assert runs.sum() == mask.size
+        assert np.array_equal(decode_rle(runs, 40, 30), mask)
+
+
+def test_rle_starts_with_background_run():
+    mask = np.array([[True, True, False, True]])
+    assert encode_rle(mask).tolist() == [0, 2, 1, 1]
+
+
+def test_volume_write_and_reload(tmp_path):
+    path = tmp_path / "video.masks"
+    volume = MaskVolume(path)
+    for frame_number in range(5):
+        volume.write(frame_number, make_mask(frame_number))
+    volume.write(2, make_mask(10))
+
+    reloaded = MaskVolume(path)
+    assert reloaded.frame_numbers() == [0, 1, 2, 3, 4]
+    assert np.array_equal(reloaded.read(2), make_mask(10))
+    assert np.array_equal(reloaded.read(4), make_mask(4))
+    assert reloaded.read(5) is None
+    assert reloaded.version(2) == volume.version(2)
+
+
+def test_volume_compaction_keeps_masks_and_new_versions(tmp_path):
+    path = tmp_path / "video.masks"
+    volume = MaskVolume(path)
+    versions = set()
+    for step in range(200):
+        frame_number = step % 3
+        volume.write(frame_number, make_mask(step))
+        version = volume.version(frame_number)
+        # Every write gives a version never seen before, compactions included.
+        assert version not in versions
+        versions.add(version)
+
+    # Compacted: far smaller than 200 records.
+    record_size = 16 + encode_rle(make_mask(0)).nbytes
+    assert path.stat().st_size < HEADER.size + 100 * record_size
+
+    reloaded = MaskVolume(path)
+    for frame_number, step in [(0, 198), (1, 199), (2, 197)]:
+        assert np.array_equal(reloaded.read(frame_number), make_mask(step))
+
+
+def test_incomplete_record_is_ignored_by_readers_and_replaced_by_writer(tmp_path):
+    path = tmp_path / "video.masks"
+    MaskVolume(path).write(0, make_mask(0))
+    # A writer interrupted in the middle of a record.
+    with open(path, "ab") as f:
+        f.write(RECORD.pack(1, 40, 30, 1000) + b"partial")
+    size = path.stat().st_size
+
+    reader = MaskVolume(path)
+    assert reader.frame_numbers() == [0]
+    assert reader.read(1) is None
+    assert path.stat().st_size == size
+
+    MaskVolume(path).write(1, make_mask(1))
+    assert path.stat().st_size < size + RECORD.size + encode_rle(make_mask(1)).nbytes
+    assert reader.frame_numbers() == [0, 1]
+    assert np.array_equal(reader.read(1), make_mask(1))
+    assert np.array_equal(reader.read(0), make_mask(0))
+
+
+def test_volume_cleared_and_written_again_gets_larger_versions(tmp_path):
+    volume = MaskVolume(tmp_path / "video.masks")
+    volume.write(0, make_mask(0))
+    version = volume.version(0)
+    volume.clear()
+    assert volume.frame_numbers() == []
+    volume.write(0, make_mask(1))
+    assert volume.version(0) > version
+
+
+def test_migrate_legacy_masks():
+    entry = VideoEntry(
+        name="legacy.mp4",
+        stem="legacy",
+        path=settings.video_dir / "legacy.mp4",
+        is_video=True,
+        mtime_ns=0,
+        frame_count=10,
+        width=40,
+        height=30,
+        size=0,
+    )
+    legacy_directory = settings.mask_directory / "legacy"
+    legacy_directory.mkdir(parents=True)
+    masks = {}
+    for frame_number in [1, 4]:
+        mask = np.zeros((30, 40), dtype=bool)
+        mask[5:20, frame_number : frame_number + 15] = True
+        masks[frame_number] = mask
+        cv2.imwrite(
+            str(legacy_directory / f"{frame_number}.jpg"), mask.astype(np.uint8) * 255
+        )
+
+    # The volume holds exactly what was served from the JPEG masks, which
+    # are lossy, so those are only close to the masks written.
+    served = {frame_number: read_mask(entry, frame_number) for frame_number in masks}
+    for frame_number, mask in masks.items():
+        overlap = (served[frame_number] & mask).sum() / (
+            served[frame_number] | mask
+        ).sum()
+        assert overlap > 0.8
+
+    assert migrate_masks(entry) == 2
+    assert not legacy_directory.exists()
+    volume = mask_store.volume("legacy")
+    assert volume.frame_numbers() == [1, 4]
+    for frame_number, mask in served.items():
+        assert np.array_equal(volume.read(frame_number), mask)
+
+
+def test_mask_writer_fails_fast_once_a_write_fails(monkeypatch):
+    def write_mask(entry, frame_number, mask, object_id):
+        if frame_number == 1:
+            raise OSError("No space left on device")
+
+    monkeypatch.setattr("app.mask_store.write_mask", write_mask)
+    writer = MaskWriter(None, workers=1, max_pending=1)
+    writer.submit(0, make_mask(0))
+    writer.submit(1, make_mask(1))
+    # With one pending write, the failure is known by the time the write after
+    # the next one is submitted.
+    with pytest.raises(OSError, match="No space left"):
+        for frame_number in range(2, 100):
+            writer.submit(frame_number, make_mask(frame_number))
+    assert frame_number <= 3
+    with pytest.raises(OSError):
+        writer.close()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from app.catalog import video_catalog
+from app.config import settings
+from app.models import Annotation, ObjectAnnotation, Point
+from app.video_processing import propagate_in_chunks, propagate_in_state
+from benchmarks.stub_predictor import StubPredictor
+from benchmarks.synthetic import write_image_sequence
+
+FRAME_COUNT = 24
+
+
+@pytest.fixture(scope="module")
+def entry():
+    write_image_sequence(settings.images_dir / "tracked", FRAME_COUNT, 64, 48)
+    return video_catalog.get("tracked")
+
+
+def annotation(frame_number: int, object_id: int, x: float) -> Annotation:
+    return Annotation(
+        videoName="tracked",
+        frameNumber=frame_number,
+        objects=[
+            ObjectAnnotation(objectId=object_id, positivePoints=[Point(x=x, y=0.5)])
+        ],
+    )
+
+
+def collect(masks) -> dict[tuple[int, int], np.ndarray]:
+    # The last mask of a frame and object wins, as in the mask store.
+    return {(frame, object_id): mask for frame, object_id, mask in masks}
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_chunked_propagation_tracks_every_object_like_a_single_state(entry, reverse):
+    # Object 1 is prompted two chunks after object 0.
+    annotations = {6: annotation(6, 0, 0.3), 15: annotation(15, 1, 0.7)}
+    frames = range(0, FRAME_COUNT)
+
+    single = collect(
+        propagate_in_state(StubPredictor(work=0), entry, annotations, frames, reverse)
+    )
+    chunked = collect(
+        propagate_in_chunks(
+            StubPredictor(work=0), entry, annotations, frames, reverse, 4, 2
+        )
+    )
+
+    first_frame = 0 if reverse else 6
+    assert set(single) == {
+        (frame, object_id)
+        for frame in range(first_frame, FRAME_COUNT)
+        for object_id in (0, 1)
+    }
+    assert set(chunked) == set(single)
+    for key, mask in single.items():
+        overlap = (mask & chunked[key]).sum() / (mask | chunked[key]).sum()
+        assert overlap > 0.8, key
@@ -0,0 +1,218 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app.annotation_store import annotation_store
+from app.config import settings
+from app.models import Annotation, ObjectAnnotation, Point
+from app.scheduler import (
+    JobConflictError,
+    JobEvents,
+    QueueFullError,
+    SegmentationJob,
+    SegmentationScheduler,
+    get_mask_path_names,
+)
+from app.video_processing import SegmentationCancelled, coco_rle, process_segmentation
+from benchmarks.stub_predictor import StubPredictor
+from benchmarks.synthetic import write_image_sequence
+
+
+async def follow_job(job: SegmentationJob, mask: np.ndarray, live: bool = True):
+    # Follows the job from its queued status, the mask and the final status are
+    # published while it is followed.
+    follower = job.events.follow(live=live)
+    events = [await anext(follower)]
+    job.add_mask(3, 1, mask)
+    job.status = "completed"
+    job.publish_status()
+    events += [item async for item in follower]
+    return events
+
+
+def test_masks_are_sent_to_followers_in_coco_rle_and_not_replayed():
+    job = SegmentationJob("clip.mp4", 0, 0, -1)
+    job.publish_status()
+    mask = np.zeros((30, 40), dtype=bool)
+    mask[5:10, 20:30] = True
+
+    events = asyncio.run(follow_job(job, mask))
+    assert [(event_id, event) for event_id, event, _ in events] == [
+        (0, "status"),
+        (1, "mask"),
+        (2, "status"),
+    ]
+    assert events[1][2] == {
+        "frame_number": 3,
+        "object_id": 1,
+        "rle": coco_rle(mask, 40, 30),
+    }
+
+    async def replay():
+        return [event async for _, event, _ in job.events.follow()]
+
+    assert asyncio.run(replay()) == ["status", "status"]
+
+
+def test_followers_without_masks_get_no_mask_events():
+    job = SegmentationJob("clip.mp4", 0, 0, -1)
+    job.publish_status()
+    events = asyncio.run(follow_job(job, np.ones((4, 4), dtype=bool), live=False))
+    assert [event for _, event, _ in events] == ["status", "status"]
+
+
+def test_reconnecting_follower_gets_the_events_it_missed():
+    events = JobEvents(max_events=3)
+    for processed_frames in range(5):
+        events.publish("progress", {"processed_frames": processed_frames})
+    events.publish("status", {}, close=True)
+
+    async def follow(last_id):
+        return [event_id async for event_id, _, _ in events.follow(last_id)]
+
+    # Only the last max_events are kept.
+    assert asyncio.run(follow(-1)) == [3, 4, 5]
+    assert asyncio.run(follow(4)) == [5]
+
+
+class RecordingRunner:
+    # Records the jobs it runs, each one waits for the gate to open. A job of
+    # video "cancelled" runs until it is cancelled.
+    def __init__(self):
+        self.gate = threading.Event()
+        self.ran: list[str] = []
+
+    def run(self, job: SegmentationJob) -> list[str]:
+        self.ran.append(job.video_name)
+        if job.video_name == "cancelled":
+            job.cancel_event.wait(5)
+            raise SegmentationCancelled()
+        self.gate.wait(5)
+        return []
+
+    def model_status(self) -> dict:
+        return {}
+
+
+class StubRunner:
+    # Runs the segmentation like PredictorRunner, with the stub predictor.
+    def __init__(self):
+        self.predictor = StubPredictor(work=0)
+
+    def run(self, job: SegmentationJob) -> list[str]:
+        process_segmentation(
+            job.video_name,
+            job.frame_number,
+            job.start_frame,
+            job.end_frame,
+            self.predictor,
+            on_progress=job.update_progress,
+            on_mask=job.add_mask,
+            cancel_event=job.cancel_event,
+        )
+        return get_mask_path_names(job.video_name)
+
+    def model_status(self) -> dict:
+        return {"model": "stub"}
+
+
+def create_scheduler(runner, max_queued: int = 8, max_history: int = 8):
+    return SegmentationScheduler(lambda: runner, 1, max_queued, max_history)
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_jobs_run_by_priority_then_in_submission_order():
+    runner = RecordingRunner()
+    runner.gate.set()
+    scheduler = create_scheduler(runner)
+    jobs = [
+        SegmentationJob(name, 0, 0, -1, priority=priority)
+        for name, priority in [("low", 0), ("first", 5), ("second", 5), ("high", 9)]
+    ]
+    for job in jobs:
+        scheduler.submit(job)
+    scheduler.start()
+
+    wait_until(lambda: all(job.status == "completed" for job in jobs))
+    assert runner.ran == ["high", "first", "second", "low"]
+
+
+def test_one_job_per_video_and_a_bounded_queue():
+    scheduler = create_scheduler(RecordingRunner(), max_queued=2)
+    queued = scheduler.submit(SegmentationJob("clip.mp4", 0, 0, -1))
+
+    with pytest.raises(JobConflictError) as conflict:
+        scheduler.submit(SegmentationJob("clip.mp4", 4, 0, -1))
+    assert conflict.value.job is queued
+
+    scheduler.submit(SegmentationJob("other.mp4", 0, 0, -1))
+    with pytest.raises(QueueFullError):
+        scheduler.submit(SegmentationJob("third.mp4", 0, 0, -1))
+
+
+def test_cancel_queued_and_running_jobs():
+    runner = RecordingRunner()
+    scheduler = create_scheduler(runner)
+    running = scheduler.submit(SegmentationJob("cancelled", 0, 0, -1, priority=1))
+    queued = scheduler.submit(SegmentationJob("clip.mp4", 0, 0, -1))
+    scheduler.start()
+    wait_until(lambda: running.status == "running")
+
+    # A queued job is dropped from the queue, the video is free again.
+    assert scheduler.cancel(queued.id).status == "cancelled"
+    scheduler.submit(SegmentationJob("clip.mp4", 0, 0, -1))
+
+    scheduler.cancel(running.id)
+    wait_until(lambda: running.status == "cancelled")
+    assert scheduler.cancel("unknown") is None
+    runner.gate.set()
+    wait_until(lambda: runner.ran == ["cancelled", "clip.mp4"])
+    assert queued.started_at is None
+
+
+def test_only_the_last_finished_jobs_are_kept():
+    runner = RecordingRunner()
+    runner.gate.set()
+    scheduler = create_scheduler(runner, max_history=2)
+    scheduler.start()
+    jobs = []
+    for name in ["a", "b", "c"]:
+        jobs.append(scheduler.submit(SegmentationJob(name, 0, 0, -1)))
+        wait_until(lambda: jobs[-1].status == "completed")
+
+    assert [job.video_name for job in scheduler.jobs()] == ["b", "c"]
+    assert scheduler.get(jobs[0].id) is None
+
+
+def test_scheduled_segmentation_with_the_stub_predictor():
+    write_image_sequence(settings.images_dir / "scheduled", 12, 64, 48)
+    annotation_store.put(
+        "scheduled",
+        4,
+        Annotation(
+            videoName="scheduled",
+            frameNumber=4,
+            objects=[
+                ObjectAnnotation(objectId=0, positivePoints=[Point(x=0.5, y=0.5)])
+            ],
+        ),
+    )
+    scheduler = SegmentationScheduler(StubRunner, 1, 8, 8)
+    scheduler.start()
+    job = scheduler.submit(SegmentationJob("scheduled", 4, 0, -1))
+
+    wait_until(lambda: job.status not in ("queued", "running"))
+    assert job.status == "completed", job.error
+    # The range starts before the prompt, it is propagated both ways.
+    assert job.processed_frames == job.total_frames == 12
+    assert len(job.mask_paths) > 0
+    assert scheduler.model_status() == [{"model": "stub"}]
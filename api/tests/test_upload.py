@@ -0,0 +1,80 @@
+import os
+import time
+
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from app.config import settings
+from app.main import app
+from app.routes.upload import session_locks
+from app.uploads import get_session_part_path, get_session_path
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(app)
+
+
+def encode(extension: str) -> bytes:
+    return cv2.imencode(extension, np.zeros((20, 30, 3), dtype=np.uint8))[1].tobytes()
+
+
+def test_failed_image_batch_keeps_existing_frames(client):
+    image_dir = settings.images_dir / "kept"
+    image_dir.mkdir(parents=True)
+    original = encode(".jpg")
+    (image_dir / "0.jpg").write_bytes(original)
+
+    response = client.post(
+        "/upload",
+        data={"videoName": "kept"},
+        files=[
+            ("images", ("0.jpg", encode(".jpg") + b"new")),
+            ("images", ("1.png", encode(".png"))),
+            ("images", ("2.png", b"not an image")),
+        ],
+    )
+    assert response.status_code == 400
+    assert "2.png" in response.json()["detail"]
+    assert sorted(os.listdir(image_dir)) == ["0.jpg"]
+    assert (image_dir / "0.jpg").read_bytes() == original
+
+
+def test_image_batch_is_stored_once_complete(client):
+    response = client.post(
+        "/upload",
+        data={"videoName": "stored"},
+        files=[
+            ("images", ("0.jpg", encode(".jpg"))),
+            ("images", ("1.png", encode(".png"))),
+        ],
+    )
+    assert response.status_code == 200, response.text
+    assert sorted(os.listdir(settings.images_dir / "stored")) == ["0.jpg", "1.jpg"]
+
+
+def test_unknown_sessions_get_no_lock(client):
+    response = client.put("/upload/sessions/0123abcd?offset=0", content=b"data")
+    assert response.status_code == 404
+    assert "0123abcd" not in session_locks
+
+
+def test_abandoned_sessions_expire(client):
+    session_id = client.post("/upload/sessions", json={"videoName": "old.mp4"}).json()[
+        "id"
+    ]
+    response = client.put(f"/upload/sessions/{session_id}?offset=0", content=b"data")
+    assert response.status_code == 200
+    assert session_id in session_locks
+
+    old = time.time() - settings.upload_session_max_age - 60
+    for path in [get_session_path(session_id), get_session_part_path(session_id)]:
+        os.utime(path, (old, old))
+    client.post("/upload/sessions", json={"videoName": "new.mp4"})
+
+    assert not get_session_path(session_id).exists()
+    assert session_id not in session_locks
+    response = client.put(f"/upload/sessions/{session_id}?offset=4", content=b"data")
+    assert response.status_code == 404
@@ -0,0 +1,32 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.config import settings
+from app.main import app
+from benchmarks.synthetic import write_image_sequence
+
+
+@pytest.fixture(scope="module")
+def client():
+    write_image_sequence(settings.images_dir / "frames", 4, 64, 48)
+    return TestClient(app)
+
+
+def test_frame_is_returned_with_its_size(client):
+    response = client.get("/videos/frames/frame/2")
+    assert response.status_code == 200
+    payload = response.json()
+    assert (payload["frame_number"], payload["width"], payload["height"]) == (2, 64, 48)
+
+
+@pytest.mark.parametrize(
+    "path, detail",
+    [
+        ("/videos/frames/frame/4", "Frame not found"),
+        ("/videos/v.mp4/frame/0", "Video not found"),
+    ],
+)
+def test_missing_frames_are_not_found(client, path, detail):
+    response = client.get(path)
+    assert response.status_code == 404
+    assert response.json() == {"detail": detail}
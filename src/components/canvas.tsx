@@ -1,12 +1,44 @@
 import { useEffect, useRef, useState } from "react";
 import { TogglableButtonGroup } from "./buttons";
-import { fetchVideoFrame, useVideoFrames } from "../hooks/useVideoFrames";
+import {
+  FrameMask,
+  prefetchVideoFrames,
+  useVideoFrames,
+} from "../hooks/useVideoFrames";
 import { useQueryClient, useMutation } from "@tanstack/react-query";
 import axios from "axios";
 import { Annotation } from "../types/canvas";
 import SegModal from "./segModal";
 import ChangeFrameModal from "./frameModal";
 
+const PREFETCH_FRAME_COUNT = 10;
+
+function drawMask(
+  context: CanvasRenderingContext2D,
+  mask: FrameMask,
+  width: number,
+  height: number
+) {
+  // Polygons are in the coordinates of the frame size the mask was requested
+  // for, holes are cut out by the evenodd rule.
+  context.save();
+  context.scale(width / mask.width, height / mask.height);
+  context.globalAlpha = mask.opacity;
+  mask.objects.forEach((object) => {
+    const path = new Path2D();
+    object.polygons.forEach((polygon) => {
+      path.moveTo(polygon[0], polygon[1]);
+      for (let i = 2; i < polygon.length; i += 2) {
+        path.lineTo(polygon[i], polygon[i + 1]);
+      }
+      path.closePath();
+    });
+    context.fillStyle = `rgb(${object.color.join(",")})`;
+    context.fill(path, "evenodd");
+  });
+  context.restore();
+}
+
 interface CanvasProps {
   selectedVideo: string;
 }
@@ -42,9 +74,7 @@ export function Canvas({ selectedVideo }: CanvasProps) {
   );
 
   const [backgroundImage, setBackgroundImage] = useState<string | null>(null);
-  const [backgroundSegmentedImage, setBackgroundSegmentedImage] = useState<
-    string | null
-  >(null);
+  const [mask, setMask] = useState<FrameMask | null>(null);
   const [useSegmentedImage, setUseSegmentedImage] = useState(false);
 
   const queryClient = useQueryClient();
@@ -61,7 +91,7 @@ export function Canvas({ selectedVideo }: CanvasProps) {
       height: 0,
     });
     setBackgroundImage(null);
-    setBackgroundSegmentedImage(null);
+    setMask(null);
     setUseSegmentedImage(false);
     setFrame(0);
   }, [selectedVideo]);
@@ -69,7 +99,7 @@ export function Canvas({ selectedVideo }: CanvasProps) {
   useEffect(() => {
     if (query.data) {
       setBackgroundImage(query.data.image);
-      setBackgroundSegmentedImage(query.data.segmented_image);
+      setMask(query.data.mask);
       setFrameData((prevFrameData) => ({
         ...prevFrameData,
         [query.data.frame_number]: query.data.annotation,
@@ -93,15 +123,14 @@ export function Canvas({ selectedVideo }: CanvasProps) {
 
     if (!backgroundImage || !query.data) return;
 
-    if (useSegmentedImage && backgroundSegmentedImage) {
-      image.src = "data:image/jpeg;base64," + backgroundSegmentedImage;
-    } else {
-      image.src = "data:image/jpeg;base64," + backgroundImage;
-    }
+    image.src = backgroundImage;
 
     image.onload = () => {
       context.clearRect(0, 0, canvas.width, canvas.height);
       context.drawImage(image, 0, 0, canvas.width, canvas.height);
+      if (useSegmentedImage && mask) {
+        drawMask(context, mask, canvas.width, canvas.height);
+      }
 
       context.strokeStyle = "red";
       context.lineWidth = 2;
@@ -150,6 +179,7 @@ export function Canvas({ selectedVideo }: CanvasProps) {
     };
   }, [
     backgroundImage,
+    mask,
     frameData,
     query.data?.frame_number,
     useSegmentedImage,
@@ -242,17 +272,18 @@ export function Canvas({ selectedVideo }: CanvasProps) {
   const prefetchNextFrame = (frameNumber?: number) => {
     if (!query.data) return;
     const nextFrameNumber = frameNumber ?? query.data.frame_number + 1;
-    queryClient.prefetchQuery({
-      queryKey: ["video_frames", selectedVideo, nextFrameNumber],
-      queryFn: () =>
-        fetchVideoFrame(
-          selectedVideo,
-          nextFrameNumber,
-          maxCanvasSize.height,
-          maxCanvasSize.width
-        ),
-      staleTime: 1000 * 60 * 60,
-    });
+    if (
+      queryClient.getQueryData(["video_frames", selectedVideo, nextFrameNumber])
+    )
+      return;
+    prefetchVideoFrames(
+      queryClient,
+      selectedVideo,
+      nextFrameNumber,
+      PREFETCH_FRAME_COUNT,
+      maxCanvasSize.height,
+      maxCanvasSize.width
+    );
   };
 
   const handlePrevFrame = () => {
@@ -280,12 +311,8 @@ export function Canvas({ selectedVideo }: CanvasProps) {
   };
 
   const handleUseSegmentedImage = () => {
+    // The mask is already loaded with the frame, toggling only redraws.
     setUseSegmentedImage((prev) => !prev);
-    if (query.data) {
-      queryClient.invalidateQueries({
-        queryKey: ["video_frames", selectedVideo, query.data.frame_number],
-      });
-    }
   };
 
   if (query.isError) {
@@ -329,7 +356,7 @@ export function Canvas({ selectedVideo }: CanvasProps) {
         >
           {useSegmentedImage ? "Use Original Image" : "Use Segmented Image"}
         </button>
-        {useSegmentedImage && !backgroundSegmentedImage ? (
+        {useSegmentedImage && !mask ? (
           <div className="m-1 font-bold border-2 border-solid p-1 shadow-md rounded-md">
             No Segmented Image
           </div>
@@ -2,7 +2,14 @@ import { useState } from "react";
 import Modal from "./Modal"; // Assuming you have a Modal component
 import React from "react";
 import axios from "axios";
-import { useQueryClient } from "@tanstack/react-query";
+import {
+  cancelSegmentationJob,
+  isJobActive,
+  useSegmentationJob,
+} from "../hooks/useSegmentationJob";
+
+// A smaller model for quick previews, the server's default model otherwise.
+const FAST_MODEL_NAME = "facebook/sam2-hiera-tiny";
 
 interface SegModalProps {
   selectedVideo: string;
@@ -13,19 +20,24 @@ const SegModal: React.FC<SegModalProps> = ({ selectedVideo, frame_number }) => {
   const [isModalOpen, setIsModalOpen] = useState(false);
   const [startFrame, setStartFrame] = useState<number | null>(null);
   const [endFrame, setEndFrame] = useState<number | null>(null);
+  const [fastMode, setFastMode] = useState(false);
+
+  const [jobId, setJobId] = useState<string | null>(null);
 
-  const queryClient = useQueryClient();
+  const { data: job } = useSegmentationJob(jobId);
 
   const handleSegmentation = async () => {
     if (startFrame !== null && endFrame !== null) {
-      await axios.post(`/api/videos/${selectedVideo}/sam/${frame_number}`, {
-        start_frame: startFrame,
-        end_frame: endFrame,
-      });
+      const res = await axios.post(
+        `/api/videos/${selectedVideo}/sam/${frame_number}`,
+        {
+          start_frame: startFrame,
+          end_frame: endFrame,
+          model_name: fastMode ? FAST_MODEL_NAME : null,
+        }
+      );
+      setJobId(res.data.job.id);
       setIsModalOpen(false);
-      queryClient.invalidateQueries({
-        queryKey: ["video_frames", selectedVideo, frame_number],
-      });
     }
   };
 
@@ -38,6 +50,27 @@ const SegModal: React.FC<SegModalProps> = ({ selectedVideo, frame_number }) => {
         Segment Frames
       </button>
 
+      {job && isJobActive(job) ? (
+        <div className="m-1 py-1 px-3 flex items-center">
+          {job.status === "queued"
+            ? "Queued"
+            : `Segmenting ${Math.round(job.progress * 100)}%` +
+              (job.eta_seconds !== null
+                ? ` (${Math.ceil(job.eta_seconds)}s left)`
+                : "")}
+          <button
+            className="ml-2 py-1 px-2 bg-gray-500 rounded-md text-white"
+            onClick={() => cancelSegmentationJob(job.id)}
+          >
+            Cancel
+          </button>
+        </div>
+      ) : job?.status === "failed" ? (
+        <div className="m-1 py-1 px-3 text-red-700">{job.error}</div>
+      ) : (
+        ""
+      )}
+
       {isModalOpen && (
         <Modal
           isOpen={isModalOpen}
@@ -64,6 +97,16 @@ const SegModal: React.FC<SegModalProps> = ({ selectedVideo, frame_number }) => {
                 className="border rounded p-2 w-full"
               />
             </div>
+            <div className="mb-4">
+              <label className="flex items-center gap-2">
+                <input
+                  type="checkbox"
+                  checked={fastMode}
+                  onChange={(e) => setFastMode(e.target.checked)}
+                />
+                Fast mode (smaller model, lower quality)
+              </label>
+            </div>
           </div>
         </Modal>
       )}
@@ -7,6 +7,57 @@ interface UploadProps {
   onUpload: () => void;
 }
 
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 5;
+
+interface UploadSession {
+  id: string;
+  video_name: string;
+  size: number | null;
+  offset: number;
+}
+
+// Videos are sent in chunks through an upload session. A failed chunk is
+// retried from the offset the server has, so a dropped connection does not
+// restart the whole upload.
+async function uploadVideoInChunks(
+  file: File,
+  videoName: string,
+  onProgress: (progress: number) => void
+) {
+  const { data: session } = await axios.post<UploadSession>(
+    "/api/upload/sessions",
+    { videoName: videoName, size: file.size }
+  );
+
+  let offset = 0;
+  let retries = 0;
+  while (offset < file.size) {
+    const chunk = file.slice(offset, offset + UPLOAD_CHUNK_SIZE);
+    try {
+      const res = await axios.put<UploadSession>(
+        `/api/upload/sessions/${session.id}`,
+        chunk,
+        {
+          params: { offset: offset },
+          headers: { "Content-Type": "application/octet-stream" },
+        }
+      );
+      offset = res.data.offset;
+      retries = 0;
+    } catch (error) {
+      if (++retries > UPLOAD_MAX_RETRIES) throw error;
+      const res = await axios.get<UploadSession>(
+        `/api/upload/sessions/${session.id}`
+      );
+      offset = res.data.offset;
+    }
+    onProgress(offset / file.size);
+  }
+
+  await axios.post(`/api/upload/sessions/${session.id}/complete`);
+}
+
 export function Upload({ onUpload }: UploadProps) {
   const [videoFile, setVideoFile] = useState<File | null>(null);
   const [imageFiles, setImageFiles] = useState<File[]>([]);
@@ -46,10 +97,27 @@ export function Upload({ onUpload }: UploadProps) {
       return;
     }
 
-    const formData = new FormData();
     if (videoFile) {
-      formData.append("video", videoFile);
+      setIsUploading(true);
+      try {
+        const name = videoName || videoFile.name;
+        await uploadVideoInChunks(
+          videoFile,
+          name.endsWith(".mp4") ? name : `${name}.mp4`,
+          (progress) =>
+            setUploadStatus(`Uploading ${Math.round(progress * 100)}%`)
+        );
+        setUploadStatus("Upload successful!");
+        onUpload();
+      } catch (error: any) {
+        setUploadStatus(`Upload error: ${error.message}`);
+      } finally {
+        setIsUploading(false);
+      }
+      return;
     }
+
+    const formData = new FormData();
     for (var x = 0; x < imageFiles.length; x++) {
       formData.append("images", imageFiles[x]);
     }
@@ -0,0 +1,110 @@
+import { useQuery, useQueryClient } from "@tanstack/react-query";
+import { useEffect } from "react";
+import axios from "axios";
+
+export interface SegmentationJob {
+  id: string;
+  video_name: string;
+  frame_number: number;
+  start_frame: number;
+  end_frame: number;
+  priority: number;
+  model_name: string | null;
+  status: "queued" | "running" | "completed" | "failed" | "cancelled";
+  processed_frames: number;
+  total_frames: number;
+  progress: number;
+  eta_seconds: number | null;
+  error: string | null;
+  created_at: number;
+  started_at: number | null;
+  finished_at: number | null;
+}
+
+interface JobProgress {
+  processed_frames: number;
+  total_frames: number;
+  frame_number: number | null;
+  eta_seconds: number | null;
+}
+
+async function fetchSegmentationJob(job_id: string): Promise<SegmentationJob> {
+  const res = await axios.get<SegmentationJob>(`/api/jobs/${job_id}`);
+  return res.data;
+}
+
+export function isJobActive(job: SegmentationJob | undefined) {
+  return job?.status === "queued" || job?.status === "running";
+}
+
+export function useSegmentationJob(job_id: string | null) {
+  const queryClient = useQueryClient();
+
+  const query = useQuery({
+    queryKey: ["segmentation_job", job_id],
+    queryFn: () => fetchSegmentationJob(job_id as string),
+    enabled: job_id !== null,
+  });
+
+  useEffect(() => {
+    if (job_id === null) {
+      return;
+    }
+    // The job is followed over server-sent events instead of being polled.
+    // Masks are not needed here, the overlay of each frame is refreshed as
+    // soon as its progress event says it has been propagated.
+    const events = new EventSource(`/api/jobs/${job_id}/events?masks=false`);
+    events.addEventListener("status", (event) => {
+      const job: SegmentationJob = JSON.parse(event.data);
+      queryClient.setQueryData(["segmentation_job", job_id], job);
+      if (!isJobActive(job)) {
+        events.close();
+      }
+    });
+    events.addEventListener("progress", (event) => {
+      const progress: JobProgress = JSON.parse(event.data);
+      queryClient.setQueryData<SegmentationJob>(
+        ["segmentation_job", job_id],
+        (job) =>
+          job && {
+            ...job,
+            processed_frames: progress.processed_frames,
+            total_frames: progress.total_frames,
+            progress:
+              progress.total_frames > 0
+                ? progress.processed_frames / progress.total_frames
+                : 0,
+            eta_seconds: progress.eta_seconds,
+          },
+      );
+      const job = queryClient.getQueryData<SegmentationJob>([
+        "segmentation_job",
+        job_id,
+      ]);
+      if (job && progress.frame_number !== null) {
+        queryClient.invalidateQueries({
+          queryKey: ["video_frames", job.video_name, progress.frame_number],
+        });
+      }
+    });
+    return () => events.close();
+  }, [job_id]);
+
+  const job = query.data;
+  useEffect(() => {
+    // Masks are written while the job runs, frames are refreshed once it is
+    // done so that the overlays pick up the new mask versions.
+    if (job && !isJobActive(job)) {
+      queryClient.invalidateQueries({
+        queryKey: ["video_frames", job.video_name],
+      });
+    }
+  }, [job?.id, job?.status]);
+
+  return query;
+}
+
+export async function cancelSegmentationJob(job_id: string) {
+  const res = await axios.post<SegmentationJob>(`/api/jobs/${job_id}/cancel`);
+  return res.data;
+}
@@ -1,33 +1,168 @@
-import { useQuery } from "@tanstack/react-query";
+import { QueryClient, useQuery } from "@tanstack/react-query";
 import { useState } from "react";
 import { Annotation } from "../types/canvas";
 import axios from "axios";
 
+export interface MaskObject {
+  object_id: number;
+  color: [number, number, number];
+  polygons: number[][];
+}
+
+export interface FrameMask {
+  width: number;
+  height: number;
+  opacity: number;
+  objects: MaskObject[];
+}
+
 interface VideoFrame {
   frame_number: number;
   image: string;
-  segmented_image: string | null;
+  mask: FrameMask | null;
   annotation: Annotation;
   width: number;
   height: number;
 }
 
-export async function fetchVideoFrame(
+interface VideoFrameMeta {
+  frame_number: number;
+  annotation: Annotation;
+  width: number;
+  height: number;
+  version: number | null;
+  mask_version: number | null;
+}
+
+function frameUrl(
   video: string,
   frame_number: number,
+  kind: "image" | "mask",
+  version: number | null,
   max_height: number,
   max_width: number
 ) {
+  const params = new URLSearchParams({
+    max_height: String(max_height),
+    max_width: String(max_width),
+    v: String(version),
+  });
+  if (kind === "mask") {
+    params.set("format", "polygons");
+  }
+  return `/api/videos/${video}/frame/${frame_number}/${kind}?${params}`;
+}
+
+function preloadImage(src: string) {
+  const image = new Image();
+  image.src = src;
+}
+
+export async function fetchVideoFrame(
+  video: string,
+  frame_number: number,
+  max_height: number,
+  max_width: number
+): Promise<VideoFrame> {
   try {
-    const res = await axios.get(`/api/videos/${video}/frame/${frame_number}`, {
-      params: { max_height: max_height, max_width: max_width },
-    });
-    return res.data;
+    const res = await axios.get<VideoFrameMeta>(
+      `/api/videos/${video}/frame/${frame_number}/meta`,
+      {
+        params: { max_height: max_height, max_width: max_width },
+      }
+    );
+    const meta = res.data;
+    const image = frameUrl(
+      video,
+      frame_number,
+      "image",
+      meta.version,
+      max_height,
+      max_width
+    );
+    // Warm the browser HTTP cache so prefetched frames are drawn without
+    // another download.
+    preloadImage(image);
+    // The overlay is drawn by the canvas from the mask polygons, which are a
+    // fraction of the size of an overlay image.
+    const mask =
+      meta.mask_version === null
+        ? null
+        : (
+            await axios.get<FrameMask>(
+              frameUrl(
+                video,
+                frame_number,
+                "mask",
+                meta.mask_version,
+                max_height,
+                max_width
+              )
+            )
+          ).data;
+
+    return {
+      frame_number: meta.frame_number,
+      image: image,
+      mask: mask,
+      annotation: meta.annotation,
+      width: meta.width,
+      height: meta.height,
+    };
   } catch (error: any) {
     throw new Error(error.response?.data?.message || error.message);
   }
 }
 
+interface StreamedVideoFrame extends VideoFrameMeta {
+  image: string;
+  mask: FrameMask | null;
+}
+
+export async function prefetchVideoFrames(
+  queryClient: QueryClient,
+  video: string,
+  start: number,
+  count: number,
+  max_height: number,
+  max_width: number
+) {
+  const params = new URLSearchParams({
+    start: String(start),
+    count: String(count),
+    max_height: String(max_height),
+    max_width: String(max_width),
+    mask_format: "polygons",
+  });
+  const res = await fetch(`/api/videos/${video}/frames?${params}`);
+  if (!res.ok || !res.body) return;
+
+  const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += value;
+    const lines = buffer.split("\n");
+    buffer = lines.pop() ?? "";
+    for (const line of lines) {
+      if (!line) continue;
+      const frame: StreamedVideoFrame = JSON.parse(line);
+      queryClient.setQueryData<VideoFrame>(
+        ["video_frames", video, frame.frame_number],
+        {
+          frame_number: frame.frame_number,
+          image: "data:image/webp;base64," + frame.image,
+          mask: frame.mask,
+          annotation: frame.annotation,
+          width: frame.width,
+          height: frame.height,
+        }
+      );
+    }
+  }
+}
+
 export function useVideoFrames(
   video: string,
   max_height: number = 480,
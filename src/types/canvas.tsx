@@ -10,10 +10,18 @@ export interface Point {
   y: number;
 }
 
+export interface ObjectAnnotation {
+  objectId: number;
+  box: Box | null;
+  positivePoints: Point[];
+  negativePoints: Point[];
+}
+
 export interface Annotation {
   videoName: string;
   frameNumber: number;
   box: Box | null;
   positivePoints: Point[];
   negativePoints: Point[];
+  objects?: ObjectAnnotation[];
 }